@@ -1,6 +1,7 @@
 import os
 from dotenv import load_dotenv
-import requests
+from cache import CachedHTTP
+from export import CSVTableWriter
 import pandas as pd
 import json  # Added for better error debugging
 import time  # Added for sleep functionality
@@ -12,9 +13,12 @@ load_dotenv()
 API_KEY = os.getenv('API_KEY')
 BASE_URL = "https://marketplace.api.healthcare.gov/api/v1"
 
+# Marketplace API responses are cached on disk; set MARKETPLACE_CACHE=off to bypass
+http = CachedHTTP()
+
 def get_marketplace_data(zipcode, age, gender, income, year, drug_query):
     # 1. Get county FIPS for ZIP code
-    fips_resp = requests.get(
+    fips_resp = http.get(
         f"{BASE_URL}/counties/by/zip/{zipcode}",
         params={"apikey": API_KEY}
     )
@@ -43,7 +47,7 @@ def get_marketplace_data(zipcode, age, gender, income, year, drug_query):
         },
         "year": year
     }
-    plans_resp = requests.post(
+    plans_resp = http.post(
         f"{BASE_URL}/plans/search",
         params={"apikey": API_KEY},
         json=search_payload,
@@ -55,7 +59,7 @@ def get_marketplace_data(zipcode, age, gender, income, year, drug_query):
     plan_id = first_plan['id']
 
     # 3. Get details for a specific plan
-    plan_details_resp = requests.get(
+    plan_details_resp = http.get(
         f"{BASE_URL}/plans/{plan_id}",
         params={"year": year, "apikey": API_KEY}
     )
@@ -63,7 +67,7 @@ def get_marketplace_data(zipcode, age, gender, income, year, drug_query):
     plan_details = plan_details_resp.json()
 
     # 4. Drug autocomplete to get RxCUI
-    drug_auto_resp = requests.get(
+    drug_auto_resp = http.get(
         f"{BASE_URL}/drugs/autocomplete",
         params={"q": drug_query, "apikey": API_KEY}
     )
@@ -72,7 +76,7 @@ def get_marketplace_data(zipcode, age, gender, income, year, drug_query):
     rxcui = drug_auto_data['drugs'][0]['rxcui']  # Take the first match
 
     # 5. Check if the drug is covered by the plan
-    drug_covered_resp = requests.get(
+    drug_covered_resp = http.get(
         f"{BASE_URL}/drugs/covered",
         params={
             "year": year,
@@ -95,7 +99,7 @@ def get_marketplace_data(zipcode, age, gender, income, year, drug_query):
 
 def get_marketplace_all_data(zipcode, age, gender, income, year, drug_query, state="NC", sleep_time=0.2):
     # 1. Get county FIPS for ZIP code
-    fips_resp = requests.get(
+    fips_resp = http.get(
         f"{BASE_URL}/counties/by/zip/{zipcode}",
         params={"apikey": API_KEY}
     )
@@ -124,7 +128,7 @@ def get_marketplace_all_data(zipcode, age, gender, income, year, drug_query, sta
         },
         "year": year
     }
-    plans_resp = requests.post(
+    plans_resp = http.post(
         f"{BASE_URL}/plans/search",
         params={"apikey": API_KEY},
         json=search_payload,
@@ -135,7 +139,7 @@ def get_marketplace_all_data(zipcode, age, gender, income, year, drug_query, sta
     plans = plans_data.get('plans', [])
 
     # 3. Get drug RxCUI
-    drug_auto_resp = requests.get(
+    drug_auto_resp = http.get(
         f"{BASE_URL}/drugs/autocomplete",
         params={"q": drug_query, "apikey": API_KEY}
     )
@@ -157,7 +161,7 @@ def get_marketplace_all_data(zipcode, age, gender, income, year, drug_query, sta
         plan_id = plan['id']
 
         # Get plan details
-        plan_details_resp = requests.get(
+        plan_details_resp = http.get(
             f"{BASE_URL}/plans/{plan_id}",
             params={"year": year, "apikey": API_KEY}
         )
@@ -165,7 +169,7 @@ def get_marketplace_all_data(zipcode, age, gender, income, year, drug_query, sta
         plan_details = plan_details_resp.json()
 
         # Check drug coverage
-        drug_covered_resp = requests.get(
+        drug_covered_resp = http.get(
             f"{BASE_URL}/drugs/covered",
             params={
                 "year": year,
@@ -192,25 +196,20 @@ def get_marketplace_all_data(zipcode, age, gender, income, year, drug_query, sta
         "all_plans": all_plan_details
     }
 
-    import csv
-import os
-
 def append_to_csv(data, filename="marketplace_data.csv"):
     # Flatten and select relevant fields for CSV
+    rows = []
     for plan in data['all_plans']:
-        row = {
+        rows.append({
             "county_fips": data['county_fips'],
             "plan_id": plan['plan_summary']['id'],
             "plan_name": plan['plan_summary']['name'],
             "drug_covered": plan['drug_coverage'].get('covered', False),
             # Add more fields as needed
-        }
-        file_exists = os.path.isfile(filename)
-        with open(filename, 'a', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=row.keys())
-            if not file_exists:
-                writer.writeheader()
-            writer.writerow(row)
+        })
+    # One handle for the whole batch; the header is only written to a new file
+    with CSVTableWriter(os.path.dirname(filename) or '.', append=True) as writer:
+        writer.write_dicts(os.path.basename(filename), rows)
 
 
 
@@ -0,0 +1,55 @@
+"""
+Benchmark get_marketplace_all_data against a local mock of the marketplace API.
+
+Compares the sequential collector (max_in_flight=1) with the concurrent
+worker pool at several max-in-flight limits.
+
+    python benchmarks/bench_collect.py --plans 150 --latency 0.05
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("API_KEY", "benchmark")
+
+import collect_marketplace_data  # noqa: E402
+from cache import CachedHTTP  # noqa: E402
+from mock_marketplace_api import MockMarketplaceAPI  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--plans", type=int, default=150)
+    parser.add_argument("--latency", type=float, default=0.05, help="mock API latency per request (s)")
+    parser.add_argument("--rate-limit", type=float, default=0, help="requests per second, 0 for unlimited")
+    parser.add_argument("--max-in-flight", default="1,4,8,16")
+    parser.add_argument("--drugs", default="ibuprof", help="comma-separated drug queries")
+    args = parser.parse_args()
+
+    # No response cache: every run must hit the mock API, and nothing is written to .cache/
+    collect_marketplace_data.http = CachedHTTP(enabled=False)
+
+    with MockMarketplaceAPI(plans=args.plans, latency=args.latency) as api:
+        collect_marketplace_data.BASE_URL = api.base_url
+        baseline = None
+        print(f"{'max_in_flight':>13} {'seconds':>8} {'plans/s':>8} {'requests':>9} {'speedup':>8}")
+        for max_in_flight in [int(n) for n in args.max_in_flight.split(",")]:
+            api.requests.clear()
+            start = time.perf_counter()
+            data = collect_marketplace_data.get_marketplace_all_data(
+                "27360", 27, "Female", 52000, 2019, args.drugs.split(","),
+                sleep_time=0, rate_limit=args.rate_limit or None, max_in_flight=max_in_flight
+            )
+            elapsed = time.perf_counter() - start
+            assert len(data["all_plans"]) == args.plans
+            baseline = baseline or elapsed
+            print(f"{max_in_flight:>13} {elapsed:>8.2f} {args.plans / elapsed:>8.1f} "
+                  f"{sum(api.requests.values()):>9} {baseline / elapsed:>7.1f}x")
+        print(f"requests by endpoint (last run): {dict(api.requests)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Benchmark the vectorized cost model (cost_model.CostModel): load plan cost
+structures from a synthetic database, then price random utilization
+profiles against every plan, both as a full (profiles, plans) matrix and as
+a streaming top-k ranking.
+
+    python benchmarks/bench_cost_model.py --plans 100000 --profiles 1000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np  # noqa: E402
+
+from cost_model import PROFILE_ALIASES, CostModel  # noqa: E402
+from db import MarketplaceDB  # noqa: E402
+from synthetic import iter_synthetic_plans  # noqa: E402
+
+# Mean yearly visits/fills per profile benefit
+MEAN_UTILIZATION = {
+    "primary_care": 3, "specialist": 2, "emergency_room": 0.3, "generic_drugs": 10,
+    "brand_drugs": 1, "lab": 2, "imaging": 0.5,
+}
+
+
+def random_profiles(count, seed=0):
+    """Profiles with Poisson visit counts around MEAN_UTILIZATION, scaled per profile."""
+    rng = np.random.default_rng(seed)
+    scale = rng.gamma(1.0, 1.0, size=count)
+    return [{benefit: int(rng.poisson(mean * s)) for benefit, mean in MEAN_UTILIZATION.items()}
+            for s in scale]
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    print(f"{label:<28} {time.perf_counter() - start:>8.2f}s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--plans", type=int, default=100000)
+    parser.add_argument("--profiles", type=int, default=1000)
+    parser.add_argument("--chunk-size", type=int, default=20000)
+    parser.add_argument("--top-k", type=int, default=10)
+    args = parser.parse_args()
+    assert set(MEAN_UTILIZATION) <= set(PROFILE_ALIASES)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        db = MarketplaceDB(db_path)
+        timed(f"build db ({args.plans} plans)", lambda: db.save_plans(iter_synthetic_plans(args.plans)))
+        db.close()
+
+        model = timed("CostModel.from_db", lambda: CostModel.from_db(db_path))
+        profiles = random_profiles(args.profiles)
+        costs = timed(f"estimate {args.profiles}x{len(model)}",
+                      lambda: model.estimate(profiles, chunk_size=args.chunk_size))
+        ranked = timed(f"rank top {args.top_k}",
+                       lambda: model.rank(profiles, top_k=args.top_k, chunk_size=args.chunk_size))
+
+    cells = costs.size
+    print(f"{cells / 1e6:.1f}M plan-profile costs, matrix {costs.nbytes / 1e6:.1f} MB, "
+          f"median {np.median(costs):.0f}, cheapest for profile 0: {ranked[0][0]}")
+
+
+if __name__ == "__main__":
+    main()
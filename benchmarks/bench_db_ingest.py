@@ -0,0 +1,103 @@
+"""
+Benchmark bulk ingestion (MarketplaceDB.save_plans) against the original
+per-plan write path on synthetic plans.
+
+    python benchmarks/bench_db_ingest.py --plans 100000
+
+`save_plan_data` now goes through `save_plans`, so the baseline is a copy of
+the original per-plan path: a connection per plan, one INSERT per row and a
+commit per plan. It is much slower, so by default it runs on the first
+--baseline-plans plans only; rows/sec is comparable either way.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from db import CHILD_COLUMNS, MarketplaceDB  # noqa: E402
+from synthetic import iter_synthetic_plans  # noqa: E402
+
+
+def count_rows(plans):
+    """Rows written per plan across all tables."""
+    return sum(len(rows) for plan in plans for rows in MarketplaceDB._plan_rows(plan).values())
+
+
+def save_plan_data_per_row(db_path, plan_data):
+    """The pre-bulk save_plan_data: row-by-row writes and one commit per plan."""
+    rows = MarketplaceDB._plan_rows(plan_data)
+    conn = sqlite3.connect(db_path)
+    try:
+        with conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM plans WHERE plan_id = ?', (plan_data['id'],))
+            if cursor.fetchone() is not None:
+                cursor.execute('''
+                    UPDATE plans SET
+                        name = COALESCE(?, name), premium = COALESCE(?, premium),
+                        metal_level = COALESCE(?, metal_level), type = COALESCE(?, type),
+                        state = COALESCE(?, state), product_division = COALESCE(?, product_division),
+                        insurance_market = COALESCE(?, insurance_market),
+                        hsa_eligible = COALESCE(?, hsa_eligible),
+                        has_national_network = COALESCE(?, has_national_network),
+                        max_age_child = COALESCE(?, max_age_child), updated_at = CURRENT_TIMESTAMP
+                    WHERE plan_id = ?
+                ''', rows['plans'][0][1:] + (plan_data['id'],))
+                for table in ('moops', 'deductibles', 'cost_sharings', 'benefits', 'issuers'):
+                    cursor.execute(f'DELETE FROM {table} WHERE plan_id = ?', (plan_data['id'],))
+            else:
+                cursor.execute('''
+                    INSERT INTO plans (
+                        plan_id, name, premium, metal_level, type, state, product_division,
+                        insurance_market, hsa_eligible, has_national_network, max_age_child
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', rows['plans'][0])
+            for table, columns in CHILD_COLUMNS.items():
+                for row in rows[table]:
+                    cursor.execute(
+                        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", row
+                    )
+    finally:
+        conn.close()
+
+
+def bench(label, db_path, plans, write):
+    rows = count_rows(plans)
+    start = time.perf_counter()
+    write(MarketplaceDB(db_path), plans)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<22} {len(plans):>8} plans {rows:>10} rows {elapsed:>8.2f}s "
+          f"{rows / elapsed:>12,.0f} rows/s {len(plans) / elapsed:>10,.0f} plans/s")
+    return rows / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--plans", type=int, default=100000)
+    parser.add_argument("--baseline-plans", type=int, default=5000,
+                        help="plans written through the per-plan baseline (0 = same as --plans)")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    plans = list(iter_synthetic_plans(args.plans))
+    baseline_plans = plans[:args.baseline_plans or args.plans]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        per_plan_path = os.path.join(tmp, "per_plan.db")
+        per_plan = bench("per-plan (original)", per_plan_path, baseline_plans,
+                         lambda db, ps: [save_plan_data_per_row(per_plan_path, p) for p in ps])
+        bulk = bench("save_plans", os.path.join(tmp, "bulk.db"), plans,
+                     lambda db, ps: db.save_plans(ps, batch_size=args.batch_size))
+        # Re-saving identical plans is skipped through the content hash
+        bench("save_plans (unchanged)", os.path.join(tmp, "bulk.db"), plans,
+              lambda db, ps: db.save_plans(ps, batch_size=args.batch_size))
+    print(f"speedup: {bulk / per_plan:.1f}x rows/sec")
+
+
+if __name__ == "__main__":
+    main()
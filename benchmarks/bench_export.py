@@ -0,0 +1,77 @@
+"""
+Benchmark exporting the database and loading it back for the dashboard:
+CSV (export_to_csv + pandas.read_csv) against Parquet and memory-mapped
+Arrow IPC (export.export_columnar + export.load_columnar, as DataFrames
+and as pyarrow Tables), plus an incremental CSV export with no new rows.
+
+    python benchmarks/bench_export.py --plans 20000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pandas as pd  # noqa: E402
+import pyarrow as pa  # noqa: E402
+
+from db import MarketplaceDB, export_to_csv  # noqa: E402
+from export import export_columnar, load_columnar  # noqa: E402
+from synthetic import iter_synthetic_plans  # noqa: E402
+
+
+def dir_size(path):
+    return sum(f.stat().st_size for f in Path(path).iterdir() if f.is_file())
+
+
+def load_csvs(path):
+    return {f.stem: pd.read_csv(f) for f in Path(path).glob("*.csv")}
+
+
+def bench(label, export, load, output_dir):
+    start = time.perf_counter()
+    export(output_dir)
+    export_seconds = time.perf_counter() - start
+    allocated = pa.total_allocated_bytes()
+    start = time.perf_counter()
+    data = load(output_dir)
+    load_seconds = time.perf_counter() - start
+    if all(isinstance(table, pa.Table) for table in data.values()):
+        # Memory-mapped buffers are not allocated; only what pyarrow had to copy counts
+        memory = pa.total_allocated_bytes() - allocated
+    else:
+        memory = sum(df.memory_usage(deep=True).sum() for df in data.values())
+    print(f"{label:<10} export {export_seconds:>7.2f}s  load {load_seconds:>7.3f}s  "
+          f"files {dir_size(output_dir) / 1e6:>8.1f} MB  in-memory {memory / 1e6:>8.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--plans", type=int, default=20000)
+    parser.add_argument("--chunk-size", type=int, default=50000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        db = MarketplaceDB(db_path)
+        db.save_plans(iter_synthetic_plans(args.plans))
+        db.close()
+
+        bench("csv", lambda out: export_to_csv(db_path, out), load_csvs, os.path.join(tmp, "csv"))
+        # A follow-up incremental export with nothing new only reads past the watermarks
+        start = time.perf_counter()
+        export_to_csv(db_path, os.path.join(tmp, "csv"), incremental=True)
+        print(f"{'csv incr':<10} export {time.perf_counter() - start:>7.2f}s")
+        bench("parquet", lambda out: export_columnar(db_path, out, "parquet", args.chunk_size),
+              load_columnar, os.path.join(tmp, "parquet"))
+        bench("arrow", lambda out: export_columnar(db_path, out, "arrow", args.chunk_size),
+              load_columnar, os.path.join(tmp, "arrow"))
+        # The same files as pyarrow Tables: memory-mapped, nothing copied
+        bench("arrow tbl", lambda out: None, lambda out: load_columnar(out, arrow=True), os.path.join(tmp, "arrow"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark the run-versioned history (history.PlanHistory): simulate nightly
+collection runs over synthetic plans where a small share of premiums and
+cost sharings change each night. Reports the database growth per run
+against the size of one full snapshot, the cost of recording history in
+`save_plans`, and the latency of trend and as-of queries.
+
+    python benchmarks/bench_history.py --plans 20000 --runs 10 --change-rate 0.05
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np  # noqa: E402
+
+from db import MarketplaceDB  # noqa: E402
+from history import PlanHistory  # noqa: E402
+from synthetic import iter_synthetic_plans  # noqa: E402
+
+
+def nightly_plans(count, night, change_rate):
+    """The synthetic plans as collected on `night`: a stable random share changes each night."""
+    rng = random.Random(night)
+    for plan in iter_synthetic_plans(count):
+        if night and rng.random() < change_rate:
+            plan["premium"] = round(plan["premium"] * (1 + rng.uniform(-0.05, 0.1)), 2)
+            if rng.random() < 0.5:
+                benefits = [dict(benefit) for benefit in plan["benefits"]]
+                benefit = benefits[rng.randrange(len(benefits))]
+                benefit["cost_sharings"] = [dict(sharing, copay_amount=float(rng.randrange(10, 80, 5)))
+                                            for sharing in benefit.get("cost_sharings") or []]
+                plan["benefits"] = benefits
+        yield plan
+
+
+def database_bytes(db_path):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("VACUUM")
+    return os.path.getsize(db_path)
+
+
+def latencies(func, args):
+    timings = []
+    for arg in args:
+        start = time.perf_counter()
+        func(arg)
+        timings.append(time.perf_counter() - start)
+    return np.percentile(timings, [50, 99]) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--plans", type=int, default=20000)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--change-rate", type=float, default=0.05)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "history.db")
+        plain_path = os.path.join(tmp, "plain.db")
+        db, plain = MarketplaceDB(db_path), MarketplaceDB(plain_path)
+
+        print(f"{'run':>4} {'changed':>8} {'save':>9} {'no history':>11} {'db size':>10}")
+        sizes = []
+        for night in range(args.runs):
+            start = time.perf_counter()
+            plain.save_plans(nightly_plans(args.plans, night, args.change_rate))
+            without = time.perf_counter() - start
+
+            start = time.perf_counter()
+            run_id = db.start_run("bench")
+            summary = db.save_plans(nightly_plans(args.plans, night, args.change_rate), run_id=run_id)
+            db.finish_run(run_id, summary)
+            seconds = time.perf_counter() - start
+
+            sizes.append(database_bytes(db_path))
+            print(f"{run_id:>4} {summary['inserted'] + summary['updated']:>8} {seconds:>8.2f}s {without:>10.2f}s "
+                  f"{sizes[-1] / 1e6:>7.1f} MB")
+        db.close()
+        plain.close()
+        snapshot = database_bytes(plain_path)
+
+        history = PlanHistory(db_path)
+        with sqlite3.connect(db_path) as conn:
+            plan_ids = [row[0] for row in conn.execute("SELECT plan_id FROM plans ORDER BY random() LIMIT 500")]
+            rows = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                    for table in ("plan_history", "cost_sharing_history")}
+        middle = max(1, args.runs // 2)
+        trend = latencies(history.premium_trend, plan_ids)
+        as_of = latencies(lambda plan_id: history.plan_as_of(plan_id, middle), plan_ids)
+        start = time.perf_counter()
+        everything = history.premiums_as_of(middle)
+        all_as_of = time.perf_counter() - start
+
+    growth = np.diff(sizes).mean() if len(sizes) > 1 else 0.0
+    print(f"history rows: {rows}")
+    print(f"growth per run {growth / 1e6:.2f} MB vs {snapshot / 1e6:.1f} MB per full snapshot "
+          f"({growth / snapshot:.1%})")
+    print(f"premium_trend p50 {trend[0]:.2f}ms p99 {trend[1]:.2f}ms; "
+          f"plan_as_of p50 {as_of[0]:.2f}ms p99 {as_of[1]:.2f}ms; "
+          f"premiums_as_of ({len(everything)} plans) {all_as_of * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Benchmark the normalized storage layout (MarketplaceDB(normalized=True))
+against the standard one: database size, ingest time, scans over every
+cost-sharing row (numeric columns only, filtered on strings, grouped by
+strings), one plan's rows by plan_id, and a CSV export.
+
+    python benchmarks/bench_normalized.py --plans 50000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from db import MarketplaceDB  # noqa: E402
+from export import export_csv  # noqa: E402
+from synthetic import iter_synthetic_plans  # noqa: E402
+
+SCANS = {
+    "numeric": "SELECT COUNT(*), AVG(copay_amount), MAX(coinsurance_rate) FROM cost_sharings",
+    "filtered": """
+        SELECT COUNT(*), AVG(copay_amount) FROM cost_sharings
+        WHERE benefit_name = 'Specialist Visit' AND network_tier = 'In-Network'
+    """,
+    "grouped": """
+        SELECT benefit_name, network_tier, COUNT(*), AVG(copay_amount)
+        FROM cost_sharings GROUP BY benefit_name, network_tier
+    """,
+}
+LOOKUP_SQL = "SELECT * FROM cost_sharings WHERE plan_id = ?"
+
+
+def timed(func, repeat=1):
+    """Best wall time of `repeat` calls, with the last result."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def run(db_path, plans, normalized, output_dir):
+    """Build one layout and time it; return the row of measurements."""
+    db = MarketplaceDB(db_path, normalized=normalized)
+    ingest, _ = timed(lambda: db.save_plans(iter_synthetic_plans(plans)))
+    db.close()
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("VACUUM")
+        plan_ids = [row[0] for row in conn.execute("SELECT plan_id FROM plans ORDER BY random() LIMIT 200")]
+        scans, results = {}, {}
+        for name, sql in SCANS.items():
+            scans[name], results[name] = timed(lambda: sorted(conn.execute(sql).fetchall()), repeat=3)
+        lookup, _ = timed(lambda: [conn.execute(LOOKUP_SQL, (plan_id,)).fetchall() for plan_id in plan_ids],
+                          repeat=3)
+    export, _ = timed(lambda: export_csv(db_path, output_dir))
+    return {"size": os.path.getsize(db_path), "ingest": ingest, "scans": scans,
+            "lookup": lookup / len(plan_ids), "export": export, "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--plans", type=int, default=50000)
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, normalized in (("standard", False), ("normalized", True)):
+            results[label] = run(os.path.join(tmp, f"{label}.db"), args.plans, normalized,
+                                 os.path.join(tmp, f"{label}_csv"))
+
+    assert results["standard"]["results"] == results["normalized"]["results"]
+    print(f"{args.plans} plans")
+    print(f"{'layout':<12} {'size':>10} {'ingest':>9} " + " ".join(f"{name:>9}" for name in SCANS)
+          + f" {'by plan':>9} {'export':>9}")
+    for label, r in results.items():
+        print(f"{label:<12} {r['size'] / 1e6:>7.1f} MB {r['ingest']:>8.2f}s "
+              + " ".join(f"{r['scans'][name] * 1000:>7.0f}ms" for name in SCANS)
+              + f" {r['lookup'] * 1000:>7.2f}ms {r['export']:>8.2f}s")
+    standard, normalized = results["standard"], results["normalized"]
+    print(f"normalized: {normalized['size'] / standard['size']:.0%} of the size, ingest "
+          f"{normalized['ingest'] / standard['ingest']:.2f}x the time")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark plan_search.PlanSearch latency on a large synthetic database:
+p50/p99 per query shape over the first pages of each result set, plus the
+one-off CostModel load behind estimated-cost sorting.
+
+    python benchmarks/bench_plan_search.py --plans 1000000 --db /tmp/search.db
+
+The database is built on the first run and reused when --db already exists.
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np  # noqa: E402
+
+from db import MarketplaceDB  # noqa: E402
+from plan_search import PlanSearch  # noqa: E402
+from synthetic import iter_synthetic_plans  # noqa: E402
+
+PROFILE = {"primary_care": 4, "specialist": 3, "generic_drugs": 12, "emergency_room": 0.2}
+
+# (label, sort, filters)
+QUERIES = [
+    ("all by premium", "premium", {}),
+    ("silver hsa ppo <400 copay", "premium", dict(
+        metal_level="Silver", plan_type="PPO", hsa_eligible=True, premium_max=400,
+        copay_max={"Specialist Visit": 50})),
+    ("state + covers by deductible", "deductible", dict(
+        state="TX", covers=["Specialist Visit", "Generic Drugs"])),
+    ("gold/platinum by moop", "moop", dict(metal_level=["Gold", "Platinum"], moop_max=9000)),
+    ("issuer + coinsurance", "premium", dict(
+        issuer="Blue Cross and Blue Shield of NC", coinsurance_max={"Emergency Room Services": 0.3})),
+    ("bronze by estimated cost", "estimated_cost", dict(metal_level="Bronze", state="NC")),
+    ("all by estimated cost", "estimated_cost", {}),
+]
+
+
+def walk(search, sort, filters, pages, limit):
+    """Fetch the first `pages` pages; return per-page latencies in seconds."""
+    timings, cursor = [], None
+    for _ in range(pages):
+        start = time.perf_counter()
+        _, cursor = search.search(sort=sort, limit=limit, after=cursor,
+                                  profile=PROFILE if sort == "estimated_cost" else None, **filters)
+        timings.append(time.perf_counter() - start)
+        if cursor is None:
+            break
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--plans", type=int, default=1000000)
+    parser.add_argument("--db", default=None, help="Database path (built if missing, default: temp file)")
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(Path(os.getenv("TMPDIR", "/tmp")), f"bench_search_{args.plans}.db")
+    if not os.path.exists(db_path):
+        start = time.perf_counter()
+        db = MarketplaceDB(db_path)
+        db.save_plans(iter_synthetic_plans(args.plans))
+        db.close()
+        print(f"built {args.plans} plans in {time.perf_counter() - start:.1f}s")
+
+    search = PlanSearch(db_path)
+    start = time.perf_counter()
+    model = search.cost_model()
+    print(f"CostModel load ({len(model)} plans): {time.perf_counter() - start:.1f}s")
+
+    print(f"{'query':<30} {'matches':>8} {'first page':>11} {'p50':>9} {'p99':>9}")
+    for label, sort, filters in QUERIES:
+        # The first walk includes pricing the matching plans for estimated-cost sorts
+        first = walk(search, sort, filters, 1, args.limit)[0]
+        timings = []
+        for _ in range(args.repeat):
+            timings.extend(walk(search, sort, filters, args.pages, args.limit))
+        p50, p99 = np.percentile(timings, [50, 99]) * 1000
+        print(f"{label:<30} {search.count(**filters):>8} {first * 1000:>9.1f}ms {p50:>7.2f}ms {p99:>7.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
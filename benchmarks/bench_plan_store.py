@@ -0,0 +1,95 @@
+"""
+Benchmark the memory of plans held as `get_plans` dicts against
+plan_store.PlanStore (slotted records + NumPy child tables), plus the time
+of one full scan over in-network cost sharings in each form.
+
+    python benchmarks/bench_plan_store.py --plans 20000
+"""
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np  # noqa: E402
+
+from db import MarketplaceDB  # noqa: E402
+from plan_store import PlanStore  # noqa: E402
+from synthetic import iter_synthetic_plans  # noqa: E402
+
+BENEFIT = "Specialist Visit"
+
+
+def measure(label, build):
+    """Build an object while tracing allocations; return it with its retained size."""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    obj = build()
+    seconds = time.perf_counter() - start
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<8} load {seconds:>6.2f}s (traced)  retained {retained / 1e6:>8.1f} MB  peak {peak / 1e6:>8.1f} MB")
+    return obj, retained
+
+
+def scan_dicts(plans):
+    """Lowest in-network copay for BENEFIT per plan, from the dicts."""
+    result = {}
+    for plan in plans:
+        copays = [row["copay_amount"] for row in plan["cost_sharings"]
+                  if row["benefit_name"] == BENEFIT and row["network_tier"] == "In-Network"
+                  and row["copay_amount"] is not None]
+        result[plan["plan_id"]] = min(copays) if copays else None
+    return result
+
+
+def scan_store(store):
+    """The same, vectorized over the cost_sharings columns."""
+    table = store.tables["cost_sharings"]
+    mask = table.where(benefit_name=BENEFIT, network_tier="In-Network")
+    copays = np.where(mask, table.columns["copay_amount"], np.nan)
+    lowest = np.full(len(store), np.nan)
+    np.fmin.at(lowest, table.row_plans(), copays)
+    return lowest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--plans", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        db = MarketplaceDB(db_path)
+        db.save_plans(iter_synthetic_plans(args.plans))
+
+        dicts, dict_bytes = measure("dicts", db.get_plans)
+        rows = sum(len(plan["cost_sharings"]) for plan in dicts)
+        start = time.perf_counter()
+        expected = scan_dicts(dicts)
+        dict_scan = time.perf_counter() - start
+        del dicts
+        gc.collect()
+
+        store, store_bytes = measure("store", lambda: PlanStore.from_db(db_path))
+        start = time.perf_counter()
+        lowest = scan_store(store)
+        store_scan = time.perf_counter() - start
+        db.close()
+
+    got = {plan.plan_id: (None if np.isnan(value) else float(value)) for plan, value in zip(store, lowest)}
+    assert got == expected
+    print(f"{args.plans} plans, {rows} cost-sharing rows: store uses {store_bytes / dict_bytes:.1%} of the dict "
+          f"memory ({dict_bytes / rows:.0f} vs {store_bytes / rows:.0f} bytes per cost-sharing row)")
+    print(f"scan in-network '{BENEFIT}' copays: dicts {dict_scan * 1000:.0f}ms, store {store_scan * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
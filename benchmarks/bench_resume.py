@@ -0,0 +1,81 @@
+"""
+Benchmark checkpointed, resumable collection against a local mock of the
+marketplace API that injects faults: a share of requests is answered with
+429 (retried with backoff by CachedHTTP), and the API goes down for good
+after a number of requests. The interrupted run is then resumed and
+compared with starting over.
+
+    python benchmarks/bench_resume.py --plans 150 --error-rate 0.05 --fail-at 0.9
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("API_KEY", "benchmark")
+
+import collect_marketplace_data  # noqa: E402
+from cache import CachedHTTP  # noqa: E402
+from checkpoint import CheckpointJournal  # noqa: E402
+from mock_marketplace_api import MockMarketplaceAPI  # noqa: E402
+
+PARAMS = dict(zipcode="27360", age=27, gender="Female", income=52000, year=2019, drug_query=["ibuprof"])
+
+
+def collect(api, journal_path, resume, max_in_flight):
+    """One collection run; returns (seconds, API requests, data)."""
+    api.requests.clear()
+    api.served = 0
+    journal = CheckpointJournal({"bench": PARAMS}, journal_path, resume=resume)
+    start = time.perf_counter()
+    try:
+        data = collect_marketplace_data.get_marketplace_all_data(
+            **PARAMS, sleep_time=0, max_in_flight=max_in_flight, journal=journal)
+    finally:
+        journal.close()
+    return time.perf_counter() - start, sum(api.requests.values()), data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--plans", type=int, default=150)
+    parser.add_argument("--latency", type=float, default=0.02, help="mock API latency per request (s)")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="share of requests answered with 429")
+    parser.add_argument("--fail-at", type=float, default=0.9,
+                        help="share of a clean run's requests after which the API goes down")
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    args = parser.parse_args()
+
+    # No response cache, so only the journal can save requests; short backoff to keep the run quick
+    collect_marketplace_data.http = CachedHTTP(enabled=False, backoff=0.01, max_backoff=0.1)
+
+    with tempfile.TemporaryDirectory() as tmp, MockMarketplaceAPI(plans=args.plans, latency=args.latency) as api:
+        collect_marketplace_data.BASE_URL = api.base_url
+        journal_path = os.path.join(tmp, "journal.db")
+
+        clean_seconds, clean_requests, _ = collect(api, journal_path, False, args.max_in_flight)
+
+        api.error_rate = args.error_rate
+        api.fail_after = int(clean_requests * args.fail_at)
+        collect_marketplace_data.http.retried = 0
+        seconds, requests, data = collect(api, journal_path, False, args.max_in_flight)
+        faults = {code: api.requests[code] for code in ("429", "503")}
+        print(f"clean run:        {clean_seconds:6.2f}s {clean_requests:>5} requests")
+        print(f"interrupted run:  {seconds:6.2f}s {requests:>5} requests, {faults}, "
+              f"{collect_marketplace_data.http.retried} retries, "
+              f"{len(data['all_plans'])} plans collected, {data['failed_plans']} failed")
+
+        api.fail_after = None
+        seconds, requests, data = collect(api, journal_path, True, args.max_in_flight)
+        assert len(data["all_plans"]) == args.plans and not data["failed_plans"]
+        print(f"resumed run:      {seconds:6.2f}s {requests:>5} requests, {len(data['all_plans'])} plans")
+
+        seconds, requests, data = collect(api, journal_path, False, args.max_in_flight)
+        print(f"starting over:    {seconds:6.2f}s {requests:>5} requests, {len(data['all_plans'])} plans")
+
+
+if __name__ == "__main__":
+    main()
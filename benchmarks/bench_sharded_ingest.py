@@ -0,0 +1,70 @@
+"""
+Benchmark sharded parallel ingest (ingest.ingest_sharded) against the
+sequential pipeline: synthetic plans are written as one JSON dump per state,
+then loaded into a fresh database once with a single writer and once per
+worker count, reporting the time spent in the workers and in the merge.
+
+    python benchmarks/bench_sharded_ingest.py --plans 40000 --shards 8 --workers 1 2 4 8
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from db import MarketplaceDB  # noqa: E402
+from ingest import SQLiteSink, ingest_sharded, run_pipeline  # noqa: E402
+from synthetic import STATES, iter_synthetic_plans  # noqa: E402
+
+
+def write_dumps(directory, plans, shards):
+    """One dump per state, like collections run per state; returns their paths."""
+    paths = []
+    per_shard = plans // shards
+    for i in range(shards):
+        state = STATES[i % len(STATES)] if shards <= len(STATES) else f"S{i}"
+        path = os.path.join(directory, f"plans_{state}.json")
+        with open(path, "w") as f:
+            json.dump({"all_plans": [{"plan": plan} for plan in
+                                     iter_synthetic_plans(per_shard, start=i * per_shard, states=[state])]}, f)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--plans", type=int, default=40000)
+    parser.add_argument("--shards", type=int, default=8)
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = write_dumps(tmp, args.plans, args.shards)
+        print(f"{args.plans} plans in {args.shards} dumps, {os.cpu_count()} CPUs")
+
+        # Baseline: the dumps one after another through a single writer
+        db_path = os.path.join(tmp, "sequential.db")
+        start = time.perf_counter()
+        count = sum(run_pipeline(path, [SQLiteSink(db_path, source="ingest")]) for path in paths)
+        sequential = time.perf_counter() - start
+        print(f"{'sequential':>10} {sequential:8.2f}s {count / sequential:>9.0f} plans/s")
+
+        print(f"{'workers':>10} {'total':>9} {'plans/s':>9} {'ingest':>8} {'merge':>8} {'speedup':>8}")
+        for workers in args.workers:
+            db_path = os.path.join(tmp, f"sharded_{workers}.db")
+            MarketplaceDB(db_path).close()
+            start = time.perf_counter()
+            stats = ingest_sharded(paths, db_path, workers=workers)
+            seconds = time.perf_counter() - start
+            print(f"{workers:>10} {seconds:8.2f}s {stats['plans'] / seconds:>9.0f} {stats['ingest_seconds']:7.2f}s "
+                  f"{stats['merge_seconds']:7.2f}s {sequential / seconds:7.2f}x")
+            os.remove(db_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Local mock of the healthcare.gov marketplace API used by the benchmarks.
+
+Serves the endpoints the collector talks to, with a configurable per-request
+latency, and counts how many requests hit each endpoint. Faults can be
+injected: a share of requests answered with 429 (`error_rate`), and an
+outage (every request answered with 503) after `fail_after` requests.
+"""
+import copy
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+SAMPLE_FILE = Path(__file__).resolve().parent.parent / "healthcare_plans.json"
+
+
+def _load_template_plan():
+    with open(SAMPLE_FILE) as f:
+        return json.load(f)["all_plans"][0]["plan"]
+
+
+def make_plans(count, state="NC"):
+    """Build `count` synthetic plans shaped like `/plans/search` results."""
+    template = _load_template_plan()
+    metals = ["Bronze", "Silver", "Gold", "Platinum", "Catastrophic"]
+    plans = []
+    for i in range(count):
+        plan = copy.deepcopy(template)
+        plan["id"] = f"{10000 + i % 90000:05d}{state}{i:07d}"
+        plan["name"] = f"Mock Plan {i}"
+        plan["premium"] = round(150 + (i % 400) * 1.5, 2)
+        plan["metal_level"] = metals[i % len(metals)]
+        plan["state"] = state
+        plans.append(plan)
+    return plans
+
+
+class MockMarketplaceAPI:
+    """
+    Threaded HTTP server imitating the marketplace API.
+
+    Usage:
+        with MockMarketplaceAPI(plans=150, latency=0.05) as api:
+            collect_marketplace_data.BASE_URL = api.base_url
+    """
+
+    def __init__(self, plans=150, latency=0.05, state="NC", error_rate=0.0, fail_after=None, seed=0):
+        self.plans = make_plans(plans, state) if isinstance(plans, int) else plans
+        self.latency = latency
+        self.state = state
+        self.error_rate = error_rate
+        self.fail_after = fail_after
+        self.requests = Counter()
+        self.served = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api/v1"
+
+    def _count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] += 1
+
+    def _fault(self):
+        """Status code of an injected failure for the next request, None to serve it."""
+        with self._lock:
+            self.served += 1
+            if self.fail_after is not None and self.served > self.fail_after:
+                self.requests["503"] += 1
+                return 503
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.requests["429"] += 1
+                return 429
+        return None
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                if status == 429:
+                    self.send_header("Retry-After", "0")
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                parts = url.path.split("/api/v1/", 1)[-1].split("/")
+                time.sleep(api.latency)
+                fault = api._fault()
+                if fault:
+                    return self._send(fault, {"error": "injected failure"})
+
+                if parts[:3] == ["counties", "by", "zip"]:
+                    api._count("counties")
+                    return self._send(200, {"counties": [
+                        {"fips": "37057", "name": "Davidson County", "state": api.state, "zipcode": parts[3]}
+                    ]})
+                if parts == ["drugs", "autocomplete"]:
+                    api._count("drugs/autocomplete")
+                    return self._send(200, [
+                        {"rxcui": str(1049589 + sum(map(ord, query.get("q", "")))), "name": query.get("q", ""),
+                         "strength": "", "route": "", "full_name": ""}
+                    ])
+                if parts == ["drugs", "covered"]:
+                    api._count("drugs/covered")
+                    coverage = [
+                        {"rxcui": rxcui, "plan_id": plan_id, "coverage": "DataNotProvided"}
+                        for plan_id in query.get("planids", "").split(",") if plan_id
+                        for rxcui in query.get("drugs", "").split(",") if rxcui
+                    ]
+                    return self._send(200, {"coverage": coverage})
+                if len(parts) == 2 and parts[0] == "plans":
+                    api._count("plans/{id}")
+                    plan = next((p for p in api.plans if p["id"] == parts[1]), None)
+                    if plan is None:
+                        return self._send(404, {"error": "plan not found"})
+                    return self._send(200, {"plan": plan})
+                self._send(404, {"error": "unknown endpoint"})
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.rfile.read(length)
+                time.sleep(api.latency)
+                fault = api._fault()
+                if fault:
+                    return self._send(fault, {"error": "injected failure"})
+                if urlparse(self.path).path.endswith("/plans/search"):
+                    api._count("plans/search")
+                    return self._send(200, {"plans": api.plans, "total": len(api.plans)})
+                self._send(404, {"error": "unknown endpoint"})
+
+        return Handler
+
+    def start(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,35 @@
+"""
+Synthetic marketplace plans for the database benchmarks.
+
+Plans are shallow copies of the sample plans in `healthcare_plans.json`
+with fresh IDs and varied premiums, generated lazily so 100k+ plans do not
+need to be held in memory at once.
+"""
+import json
+from pathlib import Path
+
+SAMPLE_FILE = Path(__file__).resolve().parent.parent / "healthcare_plans.json"
+METAL_LEVELS = ["Bronze", "Expanded Bronze", "Silver", "Gold", "Platinum", "Catastrophic"]
+STATES = ["NC", "TX", "FL", "GA", "OH", "PA", "AZ", "TN"]
+
+
+def sample_plans():
+    """Return the plans stored in the sample `healthcare_plans.json`."""
+    with open(SAMPLE_FILE) as f:
+        return [wrapper["plan"] for wrapper in json.load(f)["all_plans"]]
+
+
+def iter_synthetic_plans(count, start=0, states=None):
+    """Yield `count` plans shaped like marketplace API plan records."""
+    templates = sample_plans()
+    states = states or STATES
+    for i in range(start, start + count):
+        plan = dict(templates[i % len(templates)])
+        state = states[i % len(states)]
+        plan["id"] = f"{10000 + i % 90000:05d}{state}{i:07d}"
+        plan["name"] = f"Synthetic Plan {i}"
+        plan["premium"] = round(150 + (i * 7919 % 600) * 1.1, 2)
+        plan["metal_level"] = METAL_LEVELS[i % len(METAL_LEVELS)]
+        plan["state"] = state
+        plan["hsa_eligible"] = i % 4 == 0
+        yield plan
@@ -0,0 +1,332 @@
+"""
+Persistent caches backed by SQLite.
+
+`SQLiteCache` is a small key/value store with per-entry TTL, size-bounded
+LRU eviction and hit/miss counters. `CachedHTTP` uses it to cache
+marketplace API responses so re-running a collection hardly touches the
+network, and retries failed requests with exponential backoff and jitter.
+`CachedLLM` uses it to memoize local model completions.
+"""
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional
+
+import requests
+
+DEFAULT_CACHE_PATH = os.getenv('MARKETPLACE_CACHE_PATH', os.path.join('.cache', 'marketplace_cache.db'))
+
+DAY = 24 * 60 * 60
+
+# TTL (seconds) per marketplace API endpoint class; endpoints not listed are never cached
+ENDPOINT_TTLS = [
+    (re.compile(r'/counties/by/zip/[^/]+$'), 365 * DAY),
+    (re.compile(r'/drugs/autocomplete$'), 30 * DAY),
+    (re.compile(r'/drugs/covered$'), 7 * DAY),
+    (re.compile(r'/plans/search$'), 1 * DAY),
+    (re.compile(r'/plans/[^/]+$'), 7 * DAY),
+]
+
+# Request parameters that never take part in a cache key
+IGNORED_PARAMS = {'apikey'}
+
+# Responses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Retries per request after the first attempt, and the backoff bounds in seconds
+DEFAULT_RETRIES = int(os.getenv('MARKETPLACE_RETRIES', '5'))
+DEFAULT_BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+DEFAULT_TIMEOUT = 30.0
+
+
+class SQLiteCache:
+    """
+    Key/value cache stored in a SQLite table.
+
+    Values must be JSON-serializable. Each entry carries its own expiry time;
+    when the table grows past `max_entries` the least recently used entries
+    are evicted.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, table: str = 'cache', max_entries: int = 100000):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL,
+                accessed_at REAL NOT NULL
+            )
+        ''')
+        self._conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_accessed_at ON {table}(accessed_at)')
+        self._conn.commit()
+        self._size = self._conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value for `key`, or None if it is missing or expired."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f'SELECT value, expires_at FROM {self.table} WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None or (row[1] is not None and row[1] < now):
+                self.misses += 1
+                return None
+            self._conn.execute(f'UPDATE {self.table} SET accessed_at = ? WHERE key = ?', (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """Store `value` under `key`, expiring after `ttl` seconds (None = never)."""
+        now = time.time()
+        with self._lock:
+            # Refreshing an existing key replaces its row without adding an entry
+            exists = self._conn.execute(f'SELECT 1 FROM {self.table} WHERE key = ?', (key,)).fetchone()
+            self._conn.execute(
+                f'INSERT OR REPLACE INTO {self.table} (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value), now + ttl if ttl is not None else None, now)
+            )
+            if exists is None:
+                self._size += 1
+            if self._size > self.max_entries:
+                self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now: float) -> None:
+        # Drop expired entries first, then the least recently used ones
+        self._conn.execute(f'DELETE FROM {self.table} WHERE expires_at < ?', (now,))
+        self._size = self._conn.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+        excess = self._size - self.max_entries
+        if excess > 0:
+            self._conn.execute(f'''
+                DELETE FROM {self.table} WHERE key IN (
+                    SELECT key FROM {self.table} ORDER BY accessed_at LIMIT ?
+                )
+            ''', (excess,))
+            self.evictions += excess
+            self._size -= excess
+
+    def clear(self) -> None:
+        """Remove every entry and reset the counters."""
+        with self._lock:
+            self._conn.execute(f'DELETE FROM {self.table}')
+            self._conn.commit()
+            self._size = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss/eviction counters and the current number of entries."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": self._size,
+        }
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class CachedResponse:
+    """Minimal stand-in for `requests.Response` returned on a cache hit."""
+
+    def __init__(self, status_code: int, text: str, url: str):
+        self.status_code = status_code
+        self.text = text
+        self.url = url
+        self.ok = 200 <= status_code < 400
+        self.from_cache = True
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+
+class CachedHTTP:
+    """
+    `requests` wrapper that caches successful marketplace API responses.
+
+    Keys are built from the method, URL and normalized params/body with the
+    API key left out, and each endpoint class has its own TTL (see
+    `ENDPOINT_TTLS`).
+
+    Requests that time out, fail to connect or get a RETRY_STATUSES response
+    are retried up to `retries` times. The waits grow exponentially from
+    `backoff` up to `max_backoff` seconds, with full jitter, so clients
+    hitting the same limit do not retry in lockstep. A 429's Retry-After
+    header is honoured when it asks for a longer wait.
+
+    Usage:
+        http = CachedHTTP()
+        resp = http.get(f"{BASE_URL}/counties/by/zip/27360", params={"apikey": API_KEY})
+    """
+
+    def __init__(self, cache: Optional[SQLiteCache] = None, ttls=None, enabled: Optional[bool] = None,
+                 retries: int = DEFAULT_RETRIES, backoff: float = DEFAULT_BACKOFF,
+                 max_backoff: float = MAX_BACKOFF, timeout: Optional[float] = DEFAULT_TIMEOUT):
+        if enabled is None:
+            enabled = os.getenv('MARKETPLACE_CACHE', 'on').lower() not in ('0', 'off', 'false', 'no')
+        self.enabled = enabled
+        self.ttls = ttls if ttls is not None else ENDPOINT_TTLS
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.retried = 0
+        self._cache = cache
+        self._cache_lock = threading.Lock()
+
+    @property
+    def cache(self) -> SQLiteCache:
+        # Opened lazily so importing a module that uses the cache has no side effects
+        with self._cache_lock:
+            if self._cache is None:
+                self._cache = SQLiteCache(table='http_responses')
+            return self._cache
+
+    def ttl_for(self, url: str) -> Optional[float]:
+        """Return the TTL for a URL's endpoint class, or None if it is not cacheable."""
+        path = url.split('?', 1)[0].rstrip('/')
+        for pattern, ttl in self.ttls:
+            if pattern.search(path):
+                return ttl
+        return None
+
+    @staticmethod
+    def cache_key(method: str, url: str, params=None, json_body=None) -> str:
+        """Build the cache key for a request, ignoring the API key."""
+        normalized = {
+            "method": method.upper(),
+            "url": url.split('?', 1)[0].rstrip('/'),
+            "params": sorted(
+                (str(k), str(v)) for k, v in (params or {}).items() if k not in IGNORED_PARAMS
+            ),
+            "body": json_body,
+        }
+        return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+    def request(self, method: str, url: str, params=None, json=None, headers=None, limiter=None, **kwargs):
+        """
+        Send a request unless a fresh cached response exists.
+
+        Args:
+            limiter: Optional rate limiter with an `acquire()` method; it is
+                only consulted when the request actually goes to the network
+        """
+        ttl = self.ttl_for(url) if self.enabled and method.upper() in ('GET', 'POST') else None
+        key = None
+        if ttl is not None:
+            key = self.cache_key(method, url, params, json)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return CachedResponse(cached['status_code'], cached['text'], url)
+
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.retries + 1):
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                resp = requests.request(method, url, params=params, json=json, headers=headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+                resp = None
+            if resp is not None and (resp.status_code not in RETRY_STATUSES or attempt == self.retries):
+                break
+            self.retried += 1
+            time.sleep(self.retry_delay(attempt, resp))
+        if key is not None and resp.status_code == 200:
+            self.cache.set(key, {"status_code": resp.status_code, "text": resp.text}, ttl)
+        return resp
+
+    def retry_delay(self, attempt: int, resp=None) -> float:
+        """Seconds to wait before retry number `attempt + 1`: full jitter over the exponential backoff."""
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        retry_after = resp.headers.get('Retry-After') if resp is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(self.max_backoff, float(retry_after)))
+        return delay
+
+    def get(self, url: str, params=None, **kwargs):
+        return self.request('GET', url, params=params, **kwargs)
+
+    def post(self, url: str, params=None, json=None, **kwargs):
+        return self.request('POST', url, params=params, json=json, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.cache.stats() if self._cache is not None else {"hits": 0, "misses": 0, "entries": 0}
+        return {**stats, "retries": self.retried}
+
+
+class CachedLLM:
+    """
+    Memoizes completions of a local model in a `SQLiteCache`.
+
+    Keys are built from the model file, the prompt and the generation
+    parameters. Calls to the wrapped model are serialized with a lock, since
+    a model instance cannot generate for two threads at once (e.g. a
+    background pre-warm and a user question). `stream=True` is supported:
+    a hit is replayed as one piece, a miss is cached once fully consumed.
+
+    Usage:
+        llm = CachedLLM(model, model_id="llama-2-7b-chat.Q4_K_M.gguf")
+        text = llm(prompt, max_new_tokens=256)
+    """
+
+    def __init__(self, llm, model_id: str, cache: Optional[SQLiteCache] = None, ttl: Optional[float] = 30 * DAY):
+        self.llm = llm
+        self.model_id = model_id
+        self.ttl = ttl
+        self.cache = cache if cache is not None else SQLiteCache(table='llm_responses', max_entries=5000)
+        self.lock = threading.RLock()
+
+    def cache_key(self, prompt: str, params: Dict[str, Any]) -> str:
+        raw = json.dumps({"model": self.model_id, "prompt": prompt, "params": params}, sort_keys=True)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def __call__(self, prompt: str, stream: bool = False, **params):
+        key = self.cache_key(prompt, params)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return iter([cached]) if stream else cached
+        if stream:
+            return self._stream(key, prompt, params)
+        with self.lock:
+            text = self.llm(prompt, **params)
+        self.cache.set(key, text, self.ttl)
+        return text
+
+    def _stream(self, key: str, prompt: str, params: Dict[str, Any]) -> Iterator[str]:
+        pieces = []
+        with self.lock:
+            for piece in self.llm(prompt, stream=True, **params):
+                pieces.append(piece)
+                yield piece
+        self.cache.set(key, ''.join(pieces), self.ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        return self.cache.stats()
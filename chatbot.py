@@ -1,10 +1,24 @@
+import threading
+
 import streamlit as st
 from ctransformers import AutoModelForCausalLM
-from pathlib import Path
-import sqlite3
-from langchain_community.utilities import SQLDatabase
-from langchain_community.agent_toolkits import create_sql_agent
-from langchain.chains import create_sql_query_chain
+import pandas as pd
+
+from cache import CachedLLM, SQLiteCache
+from sql_qa import SQLQA
+
+DB_PATH = "marketplace.db"
+MODEL_REPO = "TheBloke/Llama-2-7B-Chat-GGUF"
+MODEL_FILE = "llama-2-7b-chat.Q4_K_M.gguf"
+
+# Sidebar example questions; their answers are pre-warmed into the caches at startup
+EXAMPLES = [
+    "What types of healthcare plans are available?",
+    "What are the benefits of gold plans?",
+    "How do deductibles work?",
+    "What's the difference between HMO and PPO plans?",
+    "How do I choose the right healthcare plan?"
+]
 
 # Set page config
 st.set_page_config(page_title="Healthcare Data Chatbot", page_icon="💬")
@@ -19,16 +33,40 @@ def load_llm():
     try:
         # Using a smaller model that works well locally
         model = AutoModelForCausalLM.from_pretrained(
-            "TheBloke/Llama-2-7B-Chat-GGUF",
-            model_file="llama-2-7b-chat.Q4_K_M.gguf",
+            MODEL_REPO,
+            model_file=MODEL_FILE,
             model_type="llama",
             context_length=2048
         )
-        return model
+        # Completions are memoized per prompt, model file and generation parameters
+        return CachedLLM(model, model_id=MODEL_FILE)
     except Exception as e:
         st.error(f"Error loading model: {str(e)}")
         st.stop()
 
+# Answers questions by generating SQL against marketplace.db; answers are cached per question and DB version
+@st.cache_resource
+def load_qa():
+    qa = SQLQA(load_llm(), DB_PATH, cache=SQLiteCache(table='sql_answers'), model_id=MODEL_FILE)
+    # Answer the examples in the background so clicking one is a cache hit; warming
+    # stops as soon as a question is asked, so it never holds up the conversation
+    threading.Thread(target=qa.warm, args=(EXAMPLES,), daemon=True).start()
+    return qa
+
+qa = load_qa()
+
+def show_result(result):
+    """Render the SQL and rows behind an answer"""
+    if result.get("sql"):
+        with st.expander("SQL and results"):
+            st.code(result["sql"], language="sql")
+            if result["rows"]:
+                st.dataframe(pd.DataFrame(result["rows"], columns=result["columns"]), hide_index=True)
+            if result["truncated"]:
+                st.caption(f"Showing the first {len(result['rows'])} rows")
+            if result["cached"]:
+                st.caption("Answered from cache")
+
 # Initialize session state for chat history
 if "messages" not in st.session_state:
     st.session_state.messages = []
@@ -38,8 +76,9 @@ for message in st.session_state.messages:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
-# Chat input
-if prompt := st.chat_input("Ask a question about the healthcare plans..."):
+# Chat input, or an example question clicked in the sidebar
+example = st.session_state.pop("pending_question", None)
+if prompt := st.chat_input("Ask a question about the healthcare plans...") or example:
     # Add user message to chat history
     st.session_state.messages.append({"role": "user", "content": prompt})
     
@@ -49,39 +88,65 @@ if prompt := st.chat_input("Ask a question about the healthcare plans..."):
     
     # Process the query
     with st.chat_message("assistant"):
-        with st.spinner("Analyzing data..."):
-            try:
-                # Simple LLM response without SQL for now
-                llm = load_llm()
-                response = llm(f"Answer the following question about healthcare plans: {prompt}")
-                
-                # Display the response
-                st.markdown(response)
-                
-                # Add assistant response to chat history
-                st.session_state.messages.append({"role": "assistant", "content": response})
-                
-            except Exception as e:
-                error_msg = f"Sorry, I encountered an error: {str(e)}"
-                st.error(error_msg)
-                st.session_state.messages.append({"role": "assistant", "content": error_msg})
+        try:
+            # Stream the SQL into an expander and the answer below it as tokens arrive
+            sql_box = st.expander("Generating SQL...").empty()
+            answer_box = st.empty()
+            streamed = {"sql": "", "answer": ""}
+
+            def on_token(kind, text):
+                streamed[kind] += text
+                if kind == "sql":
+                    sql_box.code(streamed["sql"], language="sql")
+                else:
+                    answer_box.markdown(streamed["answer"] + "▌")
+
+            # Earlier answered turns form the transcript the model already evaluated;
+            # examples are standalone questions, asked without history so they hit the warm cache
+            history = [] if prompt == example else [m["result"] for m in st.session_state.messages if m.get("result")]
+            result = qa.ask(prompt, history=history, on_token=on_token)
+            response = result["answer"]
+            
+            # Display the response
+            answer_box.markdown(response)
+            show_result(result)
+            st.session_state.last_timings = result["timings"]
+            
+            # Add assistant response to chat history
+            st.session_state.messages.append({"role": "assistant", "content": response, "result": result})
+            
+        except Exception as e:
+            error_msg = f"Sorry, I encountered an error: {str(e)}"
+            st.error(error_msg)
+            st.session_state.messages.append({"role": "assistant", "content": error_msg})
 
 # Add a sidebar with example questions
 with st.sidebar:
     st.subheader("Example Questions")
-    examples = [
-        "What types of healthcare plans are available?",
-        "What are the benefits of gold plans?",
-        "How do deductibles work?",
-        "What's the difference between HMO and PPO plans?",
-        "How do I choose the right healthcare plan?"
-    ]
-    
-    for example in examples:
+    for example in EXAMPLES:
         if st.button(example, key=example):
-            st.session_state.messages.append({"role": "user", "content": example})
+            st.session_state.pending_question = example
             st.rerun()
     
+    # Generation metrics of the last answer
+    timings = st.session_state.get("last_timings")
+    if timings:
+        st.markdown("---")
+        st.subheader("Last Response")
+        if timings.get("ttft") is not None:
+            st.metric("Time to first token", f"{timings['ttft']:.2f}s")
+        if timings.get("tokens_per_sec"):
+            st.metric("Tokens/sec", f"{timings['tokens_per_sec']:.1f}")
+        if timings.get("query") is not None:
+            st.metric("Query time", f"{timings['query'] * 1000:.0f}ms")
+
+    st.markdown("---")
+    st.subheader("Caches")
+    answer_stats, llm_stats = qa.cache.stats(), qa.llm.stats()
+    st.caption(f"Answers: {answer_stats['hit_rate']:.0%} hit rate, {answer_stats['entries']} entries")
+    st.caption(f"LLM: {llm_stats['hit_rate']:.0%} hit rate, {llm_stats['entries']} entries, "
+               f"{llm_stats['evictions']} evicted")
+
     st.markdown("---")
     st.markdown("### About")
-    st.markdown("This chatbot uses a local language model to answer questions about healthcare plans.")
\ No newline at end of file
+    st.markdown("This chatbot uses a local language model to turn questions into SQL over the marketplace database and summarize the results.")
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""
+Checkpoint journal for resumable collection runs, stored in SQLite.
+
+A run is identified by a hash of its parameters (profile, drugs, profile
+grid, ...). Every step that finishes (a county lookup, a search, a plan's
+details, a drug-coverage batch, a whole sweep payload) is written to the
+journal as it completes, with its result when later steps need it. A step
+that still fails after the HTTP retries is recorded as failed and the run
+carries on without it. A run started with `resume=True` skips every step
+already done, so a failure late in a large run only costs the failed
+requests; without it the run's previous checkpoints are discarded.
+
+Usage:
+    journal = CheckpointJournal({"zipcode": "27360", "year": 2019}, resume=True)
+    county = journal.get("county", "27360")
+    if county is None:
+        county = get_county_fips("27360")
+        journal.record("county", "27360", county)
+    journal.finish()
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+DEFAULT_JOURNAL_PATH = os.getenv('MARKETPLACE_JOURNAL_PATH', os.path.join('.cache', 'collection_journal.db'))
+
+DONE = 'done'
+FAILED = 'failed'
+
+
+class CheckpointJournal:
+    """
+    Completed and failed steps of one collection run.
+
+    Thread-safe: the collectors record steps from their worker pools. Each
+    record is committed on its own, so a crash loses at most the step in
+    progress.
+    """
+
+    def __init__(self, params: Dict[str, Any], path: str = DEFAULT_JOURNAL_PATH, resume: bool = False):
+        self.path = path
+        self.run_key = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+        self.resumed = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS runs (
+                run_key TEXT PRIMARY KEY,
+                params TEXT NOT NULL,
+                started_at REAL NOT NULL,
+                finished_at REAL
+            )
+        ''')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS steps (
+                run_key TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                status TEXT NOT NULL,
+                value TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 1,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (run_key, kind, key)
+            )
+        ''')
+        if not resume:
+            self._conn.execute('DELETE FROM steps WHERE run_key = ?', (self.run_key,))
+        self._conn.execute('''
+            INSERT INTO runs (run_key, params, started_at) VALUES (?, ?, ?)
+            ON CONFLICT(run_key) DO UPDATE SET started_at = excluded.started_at, finished_at = NULL
+        ''', (self.run_key, json.dumps(params, sort_keys=True, default=str), time.time()))
+        self._conn.commit()
+
+    @staticmethod
+    def _key(key: Any) -> str:
+        return key if isinstance(key, str) else json.dumps(key, sort_keys=True, default=str)
+
+    def get(self, kind: str, key: Any, default: Any = None) -> Any:
+        """The recorded result of a completed step, `default` if it has not completed."""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value FROM steps WHERE run_key = ? AND kind = ? AND key = ? AND status = ?',
+                (self.run_key, kind, self._key(key), DONE)
+            ).fetchone()
+            if row is None:
+                return default
+            self.resumed += 1
+        return json.loads(row[0])
+
+    def done(self, kind: str, key: Any) -> bool:
+        """Whether a step has completed."""
+        return self.get(kind, key, default=self) is not self
+
+    def record(self, kind: str, key: Any, value: Any = None) -> None:
+        """Mark a step completed, keeping `value` (JSON-serializable) for a resumed run."""
+        with self._lock:
+            self._conn.execute('''
+                INSERT INTO steps (run_key, kind, key, status, value, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(run_key, kind, key) DO UPDATE SET
+                    status = excluded.status, value = excluded.value, error = NULL,
+                    attempts = attempts + 1, updated_at = excluded.updated_at
+            ''', (self.run_key, kind, self._key(key), DONE, json.dumps(value), time.time()))
+            self._conn.commit()
+
+    def record_many(self, kind: str, values: Dict[Any, Any]) -> None:
+        """Mark many steps completed in one transaction, keeping each one's value."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany('''
+                INSERT INTO steps (run_key, kind, key, status, value, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(run_key, kind, key) DO UPDATE SET
+                    status = excluded.status, value = excluded.value, error = NULL,
+                    attempts = attempts + 1, updated_at = excluded.updated_at
+            ''', [(self.run_key, kind, self._key(key), DONE, json.dumps(value), now) for key, value in values.items()])
+            self._conn.commit()
+
+    def fail(self, kind: str, key: Any, error: Any) -> None:
+        """Mark a step failed; a resumed run tries it again."""
+        with self._lock:
+            self._conn.execute('''
+                INSERT INTO steps (run_key, kind, key, status, error, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(run_key, kind, key) DO UPDATE SET
+                    status = excluded.status, value = NULL, error = excluded.error,
+                    attempts = attempts + 1, updated_at = excluded.updated_at
+            ''', (self.run_key, kind, self._key(key), FAILED, str(error), time.time()))
+            self._conn.commit()
+
+    def failures(self) -> Dict[str, str]:
+        """Error per failed step, keyed "kind:key"."""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT kind, key, error FROM steps WHERE run_key = ? AND status = ?', (self.run_key, FAILED)
+            ).fetchall()
+        return {f"{kind}:{key}": error for kind, key, error in rows}
+
+    def finish(self) -> None:
+        """Mark the run finished."""
+        with self._lock:
+            self._conn.execute('UPDATE runs SET finished_at = ? WHERE run_key = ?', (time.time(), self.run_key))
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        """Steps completed and failed in this run, and steps skipped because an earlier attempt did them."""
+        with self._lock:
+            counts = dict(self._conn.execute(
+                'SELECT status, COUNT(*) FROM steps WHERE run_key = ? GROUP BY status', (self.run_key,)
+            ).fetchall())
+        return {"completed": counts.get(DONE, 0), "failed": counts.get(FAILED, 0), "resumed": self.resumed}
+
+    def close(self) -> None:
+        self._conn.close()
@@ -6,6 +6,10 @@ import json  # Added for better error debugging
 import time  # Added for sleep functionality
 import csv
 import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from cache import CachedHTTP
 
 # Load environment variables from .env file
 load_dotenv()
@@ -17,6 +21,16 @@ if not API_KEY:
 
 BASE_URL = "https://marketplace.api.healthcare.gov/api/v1"
 
+# Marketplace API responses are cached on disk; set MARKETPLACE_CACHE=off to bypass
+http = CachedHTTP()
+
+# Number of plan-detail/drug-coverage requests allowed in flight during collection
+MAX_IN_FLIGHT = int(os.getenv('MAX_IN_FLIGHT', '8'))
+
+# Maximum plan IDs and RxCUIs sent in a single /drugs/covered request
+COVERAGE_PLAN_BATCH_SIZE = 50
+COVERAGE_DRUG_BATCH_SIZE = 10
+
 plan_columns = [
     'id', 'name', 'premium', 'premium_w_credit', 'ehb_premium', 'pediatric_ehb_premium',
     'aptc_eligible_premium', 'metal_level', 'type', 'state', 'benefits', 'deductibles',
@@ -32,21 +46,158 @@ def extract_plan_columns(plan, columns):
     """Extract only the specified columns from a plan dictionary."""
     return {col: plan.get(col) for col in columns}
 
-def get_marketplace_all_data(zipcode, age, gender, income, year, drug_query, state="NC", sleep_time=0.2):
+class TokenBucket:
     """
-    Fetch marketplace data for the given parameters
+    Thread-safe token bucket used to pace requests to the marketplace API.
+
+    Args:
+        rate (float): Tokens added per second (sustained requests per second)
+        capacity (float): Maximum burst size; defaults to one second of tokens
     """
-    # 1. Get county FIPS for ZIP code
-    fips_resp = requests.get(
-        f"{BASE_URL}/counties/by/zip/{zipcode}",
-        params={"apikey": API_KEY}
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity is not None else max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` tokens are available, then consume them."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _api_get(path, params=None, limiter=None):
+    """GET a marketplace API endpoint and return the decoded JSON body."""
+    resp = http.get(f"{BASE_URL}{path}", params={**(params or {}), "apikey": API_KEY}, limiter=limiter)
+    resp.raise_for_status()
+    return resp.json()
+
+
+def _api_post(path, payload, limiter=None):
+    """POST a JSON payload to a marketplace API endpoint and return the decoded JSON body."""
+    resp = http.post(
+        f"{BASE_URL}{path}",
+        params={"apikey": API_KEY},
+        json=payload,
+        headers={"Content-Type": "application/json"},
+        limiter=limiter
     )
-    fips_resp.raise_for_status()
-    fips_data = fips_resp.json()
-    countyfips = fips_data['counties'][0]['fips']
+    resp.raise_for_status()
+    return resp.json()
 
-    # 2. Search for all plans
-    search_payload = {
+
+def _fetch_plan_details(plan, year, limiter=None):
+    """Fetch the plan-details record for a single plan from the search results."""
+    return _api_get(f"/plans/{plan['id']}", {"year": year}, limiter)
+
+
+def _batches(items, size):
+    """Split a list into consecutive chunks of at most `size` items."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def fetch_drug_coverage(plan_ids, rxcuis, year, limiter=None, max_in_flight=1,
+                        plan_batch_size=COVERAGE_PLAN_BATCH_SIZE, drug_batch_size=COVERAGE_DRUG_BATCH_SIZE,
+                        journal=None):
+    """
+    Look up drug coverage for many plans with as few `/drugs/covered` calls as possible.
+
+    Plan IDs and RxCUIs are split into batches of at most `plan_batch_size`
+    and `drug_batch_size`, one request is sent per (plan batch, drug batch)
+    pair, and the coverage entries are split back out per plan.
+
+    Args:
+        journal (CheckpointJournal): Optional; each batch's response is
+            checkpointed, and so is every plan's coverage once all of its
+            batches succeeded, so a resumed lookup only requests the plans
+            still missing however they are batched. A batch that fails is
+            recorded (as that batch) instead of aborting the lookup
+
+    Returns:
+        dict: plan_id -> {"coverage": [...]} in the shape `/drugs/covered`
+        returns for a single plan. With a journal, plans in a failed batch
+        are left out.
+    """
+    rxcuis = list(dict.fromkeys(rxcuis))
+    coverage = {}
+    if journal is not None:
+        drugs = ",".join(rxcuis)
+        for plan_id in plan_ids:
+            known = journal.get("plan_coverage", f"{year}:{plan_id}:{drugs}")
+            if known is not None:
+                coverage[plan_id] = known
+    pending = [plan_id for plan_id in dict.fromkeys(plan_ids) if plan_id not in coverage]
+    requests_to_send = [
+        (plan_batch, drug_batch)
+        for plan_batch in _batches(pending, plan_batch_size)
+        for drug_batch in _batches(list(rxcuis), drug_batch_size)
+    ]
+
+    def fetch(batch):
+        plan_batch, drug_batch = batch
+        params = {"year": year, "drugs": ",".join(drug_batch), "planids": ",".join(plan_batch)}
+        if journal is None:
+            return _api_get("/drugs/covered", params, limiter)
+        response = journal.get("coverage", params)
+        if response is None:
+            try:
+                response = _api_get("/drugs/covered", params, limiter)
+            except Exception as e:
+                journal.fail("coverage", params, e)
+                return None
+            journal.record("coverage", params, response)
+        return response
+
+    fetched = {plan_id: {"coverage": []} for plan_id in pending}
+    failed = set()
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as executor:
+        for batch, response in zip(requests_to_send, executor.map(fetch, requests_to_send)):
+            if response is None:
+                failed.update(batch[0])
+                continue
+            for entry in response.get('coverage', []):
+                if entry.get('plan_id') in fetched:
+                    fetched[entry['plan_id']]['coverage'].append(entry)
+    for plan_id in failed:
+        del fetched[plan_id]
+
+    # Keep entries in the order the drugs were requested, as a per-plan call would
+    order = {rxcui: i for i, rxcui in enumerate(rxcuis)}
+    for plan_coverage in fetched.values():
+        plan_coverage['coverage'].sort(key=lambda entry: order.get(entry.get('rxcui'), len(order)))
+    if journal is not None and fetched:
+        journal.record_many("plan_coverage", {f"{year}:{plan_id}:{drugs}": plan_coverage
+                                              for plan_id, plan_coverage in fetched.items()})
+    coverage.update(fetched)
+    return coverage
+
+
+def get_county_fips(zipcode, limiter=None, journal=None):
+    """Return the first county record (fips, state, ...) for a ZIP code."""
+    county = journal.get("county", zipcode) if journal is not None else None
+    if county is None:
+        counties = _api_get(f"/counties/by/zip/{zipcode}", limiter=limiter).get('counties') or []
+        if not counties:
+            raise ValueError(f"No county found for ZIP code: {zipcode}")
+        county = counties[0]
+        if journal is not None:
+            journal.record("county", zipcode, county)
+    return county
+
+
+def build_search_payload(zipcode, countyfips, age, gender, income, year, state="NC"):
+    """Build the `/plans/search` request body for a single-person household."""
+    return {
         "household": {
             "income": income,
             "people": [
@@ -66,74 +217,150 @@ def get_marketplace_all_data(zipcode, age, gender, income, year, drug_query, sta
         },
         "year": year
     }
-    plans_resp = requests.post(
-        f"{BASE_URL}/plans/search",
-        params={"apikey": API_KEY},
-        json=search_payload,
-        headers={"Content-Type": "application/json"}
-    )
-    plans_resp.raise_for_status()
-    plans_data = plans_resp.json()
-    
-    plans = plans_data.get('plans', [])
-    # print("PLANS:", plans)
 
-    # 3. Get drug RxCUI
-    drug_auto_resp = requests.get(
-        f"{BASE_URL}/drugs/autocomplete",
-        params={"q": drug_query, "apikey": API_KEY}
-    )
-    drug_auto_resp.raise_for_status()
-    drug_auto_data = drug_auto_resp.json()
-    
-    
-    
-    if not drug_auto_data or not isinstance(drug_auto_data, list) or len(drug_auto_data) == 0:
-        raise Exception(f"No drug found for query: {drug_query}")
-        
-    rxcui = drug_auto_data[0]['rxcui']  # Take the first match
 
-    # 4. For each plan, get details and drug coverage
-    all_plan_details = []
+def search_plans(search_payload, limiter=None, journal=None):
+    """Return every plan matching a `/plans/search` payload."""
+    plans = journal.get("search", search_payload) if journal is not None else None
+    if plans is None:
+        plans = _api_post("/plans/search", search_payload, limiter).get('plans', [])
+        if journal is not None:
+            journal.record("search", search_payload, plans)
+    return plans
+
+
+def resolve_rxcuis(drug_query, limiter=None, journal=None):
+    """Resolve one drug query or a list of them to RxCUIs (first match for each)."""
+    drug_queries = [drug_query] if isinstance(drug_query, str) else list(drug_query)
+    rxcuis = []
+    for query in drug_queries:
+        rxcui = journal.get("rxcui", query) if journal is not None else None
+        if rxcui is None:
+            drug_auto_data = _api_get("/drugs/autocomplete", {"q": query}, limiter)
+
+            if not drug_auto_data or not isinstance(drug_auto_data, list) or len(drug_auto_data) == 0:
+                raise Exception(f"No drug found for query: {query}")
+
+            rxcui = drug_auto_data[0]['rxcui']  # Take the first match
+            if journal is not None:
+                journal.record("rxcui", query, rxcui)
+        rxcuis.append(rxcui)
+    return rxcuis
+
+
+def collect_plans(plans, year, rxcuis, limiter=None, max_in_flight=1, known_coverage=None, journal=None,
+                  coverage_lock=None):
+    """
+    Fetch details and drug coverage for search results and build `all_plans` entries.
+
+    Args:
+        known_coverage (dict): Optional plan_id -> coverage map shared between
+            calls for the same year; plans already in it are not fetched again
+            and newly fetched coverage is added to it
+        journal (CheckpointJournal): Optional; plans whose details were
+            already fetched are skipped, and a plan whose details or coverage
+            fail after retries is recorded as failed and left out of the
+            result instead of aborting the whole collection
+        coverage_lock (threading.Lock): Guards `known_coverage` when calls
+            share it from several threads. A call claims the plans nobody has
+            fetched yet, and calls that need a claimed plan wait for its
+            coverage instead of fetching it again
+    """
+    if known_coverage is None:
+        known_coverage = {}
+    lock = coverage_lock or threading.Lock()
+    # Claim the plans no call has fetched or is fetching; the Future holds their coverage once fetched
+    with lock:
+        new_plans = list({plan['id']: plan for plan in plans if plan['id'] not in known_coverage}.values())
+        claimed = {plan['id']: Future() for plan in new_plans}
+        known_coverage.update(claimed)
+
+    def fetch_details(plan):
+        key = f"{year}:{plan['id']}"
+        if journal is None:
+            _fetch_plan_details(plan, year, limiter)
+        elif not journal.done("details", key):
+            try:
+                _fetch_plan_details(plan, year, limiter)
+            except Exception as e:
+                journal.fail("details", key, e)
+                return plan['id']
+            journal.record("details", key)
+        return None
+
+    coverage = {}
+    try:
+        # Get details for each plan
+        with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as executor:
+            failed = {plan_id for plan_id in executor.map(fetch_details, new_plans) if plan_id is not None}
+
+        # Check drug coverage for all plans in batched requests
+        if new_plans:
+            coverage = fetch_drug_coverage(list(claimed), rxcuis, year, limiter, max_in_flight, journal=journal)
+    finally:
+        # Publish the coverage; plans whose coverage failed are released for a later call to retry
+        with lock:
+            for plan_id in claimed:
+                if plan_id in coverage:
+                    known_coverage[plan_id] = coverage[plan_id]
+                else:
+                    del known_coverage[plan_id]
+        for plan_id, future in claimed.items():
+            future.set_result(coverage.get(plan_id))
+
+    all_plans = []
     for plan in plans:
-        
-        plan_id = plan['id']
-
-        # Get plan details
-        plan_details_resp = requests.get(
-            f"{BASE_URL}/plans/{plan_id}",
-            params={"year": year, "apikey": API_KEY}
-        )
-        plan_details_resp.raise_for_status()
-        plan_details = plan_details_resp.json()
-
-        # Check drug coverage
-        drug_covered_resp = requests.get(
-            f"{BASE_URL}/drugs/covered",
-            params={
-                "year": year,
-                "drugs": rxcui,
-                "planids": plan_id,
-                "apikey": API_KEY
-            }
-        )
-        drug_covered_resp.raise_for_status()
-        drug_covered_data = drug_covered_resp.json()
+        if plan['id'] in failed:
+            continue
+        with lock:
+            plan_coverage = known_coverage.get(plan['id'])
+        if isinstance(plan_coverage, Future):
+            plan_coverage = plan_coverage.result()
+        if plan_coverage is not None:
+            all_plans.append({"plan": plan, "coverage": plan_coverage})
+    return all_plans
+
+
+def get_marketplace_all_data(zipcode, age, gender, income, year, drug_query, state="NC", sleep_time=0.2,
+                             max_in_flight=1, rate_limit=None, journal=None):
+    """
+    Fetch marketplace data for the given parameters
 
-    
+    `drug_query` may be a single search string or a list of them. Plan-detail
+    requests and batched drug-coverage requests are spread over a pool of
+    `max_in_flight` worker threads and paced by a shared token bucket. When
+    `rate_limit` (requests per second) is not given it is derived from
+    `sleep_time`; pass `sleep_time=0` for no pacing at all.
 
-        all_plan_details.append({
-            "plan": plan,              
-            "coverage": drug_covered_data   
-        })
+    With a `journal` (checkpoint.CheckpointJournal) every completed step is
+    checkpointed, steps a resumed journal already holds are skipped, and
+    plans that still fail after retries are left out of `all_plans` and
+    counted in `failed_plans` instead of failing the whole run.
+    """
+    if rate_limit is None and sleep_time:
+        rate_limit = 1.0 / sleep_time
+    limiter = TokenBucket(rate_limit, capacity=max(1, max_in_flight)) if rate_limit else None
 
-        time.sleep(sleep_time)
-    # print(all_plan_details)
-    return {
+    # 1. Get county FIPS for ZIP code
+    countyfips = get_county_fips(zipcode, limiter, journal)['fips']
+
+    # 2. Search for all plans
+    search_payload = build_search_payload(zipcode, countyfips, age, gender, income, year, state)
+    plans = search_plans(search_payload, limiter, journal)
+
+    # 3. Get drug RxCUIs
+    rxcuis = resolve_rxcuis(drug_query, limiter, journal)
+
+    # 4. For each plan, get details and drug coverage
+    all_plan_details = collect_plans(plans, year, rxcuis, limiter, max_in_flight, journal=journal)
+    data = {
         "county_fips": countyfips,
         "plans_count": len(plans),
         "all_plans": all_plan_details
     }
+    if journal is not None:
+        data["failed_plans"] = len(plans) - len(all_plan_details)
+    return data
 
 
 def save_to_json(data, output_file="healthcare_plans.json"):
@@ -145,129 +372,52 @@ def save_to_json(data, output_file="healthcare_plans.json"):
         output_file (str): Path to the output JSON file
     """
     try:
-        with open(output_file, 'w') as f:
+        # Write to a temporary file first so an interrupted write never replaces the previous dump
+        with open(output_file + ".tmp", 'w') as f:
             json.dump(data, f, indent=2)
+        os.replace(output_file + ".tmp", output_file)
         print(f"Successfully saved data to {output_file}")
         return output_file
     except Exception as e:
         print(f"Error saving to JSON: {str(e)}")
         return None
 
-import os
-import csv
-import ast
-
 def extract_json_to_csvs(json_file_path, output_dir="exported_csvs"):
-    # Load JSON content (Python-style) safely
-    with open(json_file_path, "r") as f:
-        content = f.read()
-        data = ast.literal_eval(content)
-
-    # Ensure output directory exists
-    os.makedirs(output_dir, exist_ok=True)
-
-    # Initialize data containers
-    plans, benefits, cost_sharings = [], [], []
-    deductibles, moops, issuers = [], [], []
-
-    # Helper function to write CSVs
-    def save_csv(data_list, filename):
-        if not data_list:
-            return
-        keys = data_list[0].keys()
-        with open(os.path.join(output_dir, filename), "w", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=keys)
-            writer.writeheader()
-            writer.writerows(data_list)
-
-    # Parse all plans
-    for plan_wrapper in data["all_plans"]:
-        plan = plan_wrapper["plan"]
-        issuer = plan.get("issuer", {})
-
-        plans.append({
-            "plan_id": plan.get("id"),
-            "plan_name": plan.get("name"),
-            "premium": plan.get("premium"),
-            "metal_level": plan.get("metal_level"),
-            "type": plan.get("type"),
-            "state": plan.get("state"),
-            "product_division": plan.get("product_division"),
-            "insurance_market": plan.get("insurance_market"),
-            "hsa_eligible": plan.get("hsa_eligible"),
-            "has_national_network": plan.get("has_national_network"),
-            "max_age_child": plan.get("max_age_child"),
-        })
-
-        issuers.append({
-            "plan_id": plan.get("id"),
-            "issuer_id": issuer.get("id"),
-            "issuer_name": issuer.get("name"),
-            "state": issuer.get("state"),
-            "toll_free": issuer.get("toll_free"),
-        })
-
-        for benefit in plan.get("benefits", []):
-            benefits.append({
-                "plan_id": plan["id"],
-                "benefit_name": benefit["name"],
-                "covered": benefit.get("covered"),
-                "has_limits": benefit.get("has_limits"),
-                "limit_unit": benefit.get("limit_unit"),
-                "limit_quantity": benefit.get("limit_quantity"),
-            })
-
-            for sharing in benefit.get("cost_sharings", []):
-                cost_sharings.append({
-                    "plan_id": plan["id"],
-                    "benefit_name": benefit["name"],
-                    "network_tier": sharing.get("network_tier"),
-                    "copay_amount": sharing.get("copay_amount"),
-                    "coinsurance_rate": sharing.get("coinsurance_rate"),
-                    "display_string": sharing.get("display_string"),
-                    "csr": sharing.get("csr"),
-                })
-
-        for deductible in plan.get("deductibles", []):
-            deductibles.append({
-                "plan_id": plan["id"],
-                "type": deductible.get("type"),
-                "amount": deductible.get("amount"),
-                "network_tier": deductible.get("network_tier"),
-                "family_cost": deductible.get("family_cost"),
-            })
-
-        for moop in plan.get("moops", []):
-            moops.append({
-                "plan_id": plan["id"],
-                "type": moop.get("type"),
-                "amount": moop.get("amount"),
-                "network_tier": moop.get("network_tier"),
-                "family_cost": moop.get("family_cost"),
-            })
-
-    # Save all extracted tables
-    save_csv(plans, "plans.csv")
-    save_csv(issuers, "issuers.csv")
-    save_csv(benefits, "benefits.csv")
-    save_csv(cost_sharings, "cost_sharings.csv")
-    save_csv(deductibles, "deductibles.csv")
-    save_csv(moops, "moops.csv")
+    """
+    Export the plans in a marketplace JSON dump to per-table CSV files.
+
+    The file is streamed one plan at a time (see `ingest.py`), so memory use
+    does not depend on its size.
+    """
+    from ingest import CSVSink, run_pipeline
+    run_pipeline(json_file_path, [CSVSink(output_dir)])
 
     print(f"✅ Export complete. Files saved in: {output_dir}")
 
-def main():
-    """Main function to collect and store marketplace data"""
+def main(resume=False):
+    """
+    Main function to collect and store marketplace data
+
+    Progress is checkpointed in a journal (see checkpoint.py). With
+    `resume=True`, the steps an earlier, failed run completed are not
+    repeated. Plans that still fail are reported; the rest are saved to the
+    database (the JSON dump is only rewritten by a complete run), and the
+    run returns False so it can be resumed.
+    """
+    from checkpoint import CheckpointJournal
+
+    params = dict(zipcode="27360", age=27, gender="Female", income=52000, year=2019, drug_query="ibuprof")
+    journal = CheckpointJournal({"collect": params}, resume=resume)
     try:
         # Collect data from the marketplace API
-        print("Fetching marketplace data...")
-        data = get_marketplace_all_data("27360", 27, "Female", 52000, 2019, "ibuprof")
+        print("Fetching marketplace data..." + (" (resuming)" if resume else ""))
+        data = get_marketplace_all_data(**params, max_in_flight=MAX_IN_FLIGHT, journal=journal)
         
-        # Save raw JSON for reference
-        json_file = "healthcare_plans.json"
-        with open(json_file, 'w') as f:
-            json.dump(data, f, indent=2)
-        print(f"Saved raw data to {json_file}")
+        # Save raw JSON for reference; a partial run keeps the previous complete dump
+        if data["failed_plans"]:
+            print("Some plans failed; healthcare_plans.json is left unchanged")
+        else:
+            save_to_json(data, "healthcare_plans.json")
         
         # Save to SQLite database
         from db import save_marketplace_data, export_to_csv
@@ -275,6 +425,12 @@ def main():
         
         # Export to CSV for easy access
         export_to_csv()
+        print(f"HTTP cache: {http.stats()}")
+        print(f"Checkpoints: {journal.stats()}")
+        if data["failed_plans"]:
+            print(f"{data['failed_plans']} plans failed; rerun with --resume to fetch only those")
+            return False
+        journal.finish()
         print("Data collection and storage complete!")
         
         return True
@@ -285,16 +441,38 @@ def main():
             print("Error: Invalid or missing API key. Please check your .env file.")
         elif "404" in str(e):
             print("Error: The requested resource was not found. Please check the API endpoint and parameters.")
+        print("Completed steps are checkpointed; rerun with --resume to continue")
         return False
+    finally:
+        journal.close()
 
 if __name__ == "__main__":
-    import sys
-    
-    if len(sys.argv) > 1 and sys.argv[1] == "--export-csv":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Collect healthcare marketplace data")
+    parser.add_argument("--export-csv", action="store_true",
+                        help="only export the existing database to CSV")
+    parser.add_argument("--sweep", metavar="PROFILES",
+                        help="CSV or JSON file of (zipcode, age, income, year) profiles to sweep")
+    parser.add_argument("--drug", action="append",
+                        help="drug query to check coverage for (repeatable, default: ibuprof)")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="profiles collected in parallel during a sweep")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip the steps a previous, failed run with the same parameters completed")
+    args = parser.parse_args()
+
+    if args.export_csv:
         # Just export existing database to CSV
         from db import export_to_csv
         export_to_csv()
+    elif args.sweep:
+        # Sweep every profile in the grid file
+        from sweep import load_profiles, run_sweep
+        stats = run_sweep(load_profiles(args.sweep), args.drug or ["ibuprof"], max_workers=args.workers,
+                          max_in_flight=MAX_IN_FLIGHT, resume=args.resume)
+        sys.exit(1 if stats["failed_searches"] or stats["failed_zipcodes"] or stats["failed_drugs"] else 0)
     else:
         # Run full data collection
-        success = main()
-        sys.exit(0 if success else 1)
\ No newline at end of file
+        success = main(resume=args.resume)
+        sys.exit(0 if success else 1)
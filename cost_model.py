@@ -0,0 +1,325 @@
+"""
+Vectorized annual cost estimates for every plan at once.
+
+`CostModel.from_db` loads each plan's premium, in-network deductibles and
+MOOP, and the in-network cost sharing (copay, coinsurance, whether it
+applies after the deductible, whether the benefit is covered) per benefit
+into NumPy arrays. `estimate` then prices any number of utilization profiles
+(visits/fills per benefit per year) against all plans with a few matrix
+products, in chunks of plans so memory stays bounded:
+
+- allowed spend per benefit is visits x price (`DEFAULT_PRICES`, overridable)
+- spend on services that apply after the deductible is paid in full until
+  the deductible is met; the rest of those services then cost their copay /
+  coinsurance (medical and drug deductibles are separate unless the plan
+  has a combined one)
+- services without a deductible cost their copay / coinsurance from the start
+- covered out-of-pocket is capped at the MOOP; uncovered services are paid
+  in full and do not count toward it
+- the result is 12 x monthly premium + out-of-pocket
+
+Usage:
+    model = CostModel.from_db('marketplace.db', state='NC')
+    costs = model.estimate([{"primary_care": 4, "generic_drugs": 12}])   # shape (1, plans)
+    print(model.rank([{"specialist": 6}], top_k=5))
+"""
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from db import MarketplaceDB, PLAN_COLUMNS
+
+# Typical allowed amount per visit/fill, used when a profile does not give a price
+DEFAULT_PRICES = {
+    'Primary Care Visit to Treat an Injury or Illness': 150.0,
+    'Specialist Visit': 250.0,
+    'Emergency Room Services': 2500.0,
+    'Urgent Care Centers or Facilities': 200.0,
+    'Generic Drugs': 15.0,
+    'Preferred Brand Drugs': 350.0,
+    'Non-Preferred Brand Drugs': 600.0,
+    'Specialty Drugs': 3000.0,
+    'Inpatient Hospital Services (e.g., Hospital Stay)': 15000.0,
+    'X-rays and Diagnostic Imaging': 300.0,
+    'Laboratory Outpatient and Professional Services': 100.0,
+    'Preventive Care/Screening/Immunization': 200.0,
+    'Dental Check-Up for Children': 100.0,
+    'Basic Dental Care - Child': 150.0,
+    'Major Dental Care - Child': 1000.0,
+}
+FALLBACK_PRICE = 200.0
+
+# Short names accepted in utilization profiles
+PROFILE_ALIASES = {
+    'primary_care': 'Primary Care Visit to Treat an Injury or Illness',
+    'specialist': 'Specialist Visit',
+    'emergency_room': 'Emergency Room Services',
+    'urgent_care': 'Urgent Care Centers or Facilities',
+    'generic_drugs': 'Generic Drugs',
+    'brand_drugs': 'Preferred Brand Drugs',
+    'specialty_drugs': 'Specialty Drugs',
+    'inpatient': 'Inpatient Hospital Services (e.g., Hospital Stay)',
+    'imaging': 'X-rays and Diagnostic Imaging',
+    'lab': 'Laboratory Outpatient and Professional Services',
+}
+
+IN_NETWORK = 'In-Network'
+# Preferred cost-sharing variant when a plan lists several
+STANDARD_CSR = 'Exchange variant (no CSR)'
+
+
+def _is_drug(benefit_name: str) -> bool:
+    return 'Drug' in benefit_name
+
+
+class CostModel:
+    """
+    Plans' cost structure as arrays of shape (plans,) and (plans, benefits).
+
+    Build it with `from_db`; the constructor takes the arrays directly.
+    """
+
+    def __init__(self, plan_ids: Sequence[str], premiums: np.ndarray, benefit_names: Sequence[str],
+                 covered: np.ndarray, copay: np.ndarray, coinsurance: np.ndarray,
+                 after_deductible: np.ndarray, deductible: np.ndarray, drug_deductible: np.ndarray,
+                 combined_deductible: np.ndarray, moop: np.ndarray, row_ids: Optional[np.ndarray] = None):
+        self.plan_ids = list(plan_ids)
+        # plans.id of each plan when loaded from a database, in ascending order
+        self.row_ids = np.arange(len(self.plan_ids)) if row_ids is None else np.asarray(row_ids)
+        self.benefit_names = list(benefit_names)
+        self.benefit_index = {name: i for i, name in enumerate(self.benefit_names)}
+        self.premiums = np.asarray(premiums, dtype=np.float64)
+        self.covered = np.asarray(covered, dtype=bool)
+        self.copay = np.asarray(copay, dtype=np.float64)
+        self.coinsurance = np.asarray(coinsurance, dtype=np.float64)
+        self.after_deductible = np.asarray(after_deductible, dtype=bool)
+        self.deductible = np.nan_to_num(np.asarray(deductible, dtype=np.float64))
+        self.drug_deductible = np.nan_to_num(np.asarray(drug_deductible, dtype=np.float64))
+        self.combined_deductible = np.asarray(combined_deductible, dtype=bool)
+        # No MOOP on record means no cap
+        self.moop = np.nan_to_num(np.asarray(moop, dtype=np.float64), nan=np.inf)
+        self.is_drug = np.array([_is_drug(name) for name in self.benefit_names], dtype=bool)
+
+    def __len__(self) -> int:
+        return len(self.plan_ids)
+
+    @classmethod
+    def from_db(cls, db_path: str = 'marketplace.db', plan_ids: Optional[Iterable[str]] = None,
+                csr: str = STANDARD_CSR, **filters) -> 'CostModel':
+        """
+        Load the cost structure of all plans, or a filtered subset.
+
+        Args:
+            db_path: Path to the SQLite database file
+            plan_ids: Only load these plans
+            csr: Cost-sharing variant to use when a benefit lists several
+            **filters: Equality filters on `plans` columns, e.g. state='NC'
+        """
+        for column in filters:
+            if column not in PLAN_COLUMNS:
+                raise ValueError(f"Unknown plans column: {column}")
+        # Makes sure the schema, including plan_rollups, is up to date
+        MarketplaceDB(db_path)
+
+        conditions, params = [], []
+        for column, value in filters.items():
+            conditions.append(f'p.{column} = ?')
+            params.append(value)
+        with sqlite3.connect(db_path) as conn:
+            if plan_ids is not None:
+                conn.execute('CREATE TEMP TABLE IF NOT EXISTS cost_plan_filter (plan_id TEXT PRIMARY KEY)')
+                conn.execute('DELETE FROM cost_plan_filter')
+                conn.executemany('INSERT OR IGNORE INTO cost_plan_filter VALUES (?)', ((p,) for p in plan_ids))
+                conditions.append('p.plan_id IN (SELECT plan_id FROM cost_plan_filter)')
+            where = ' AND '.join(conditions) or '1'
+
+            plans = conn.execute(f'''
+                SELECT p.id, p.plan_id, p.premium, r.deductible, r.drug_deductible, r.moop,
+                       EXISTS (SELECT 1 FROM deductibles d WHERE d.plan_id = p.plan_id
+                               AND d.network_tier = '{IN_NETWORK}'
+                               AND d.type = 'Combined Medical and Drug EHB Deductible')
+                FROM plans p LEFT JOIN plan_rollups r ON r.plan_id = p.plan_id
+                WHERE {where} ORDER BY p.id
+            ''', params).fetchall()
+            index = {row[1]: i for i, row in enumerate(plans)}
+            plan_filter = f'plan_id IN (SELECT p.plan_id FROM plans p WHERE {where})'
+
+            benefit_names = sorted(name for (name,) in conn.execute(f'''
+                SELECT name FROM benefits WHERE name IS NOT NULL AND {plan_filter}
+                UNION SELECT benefit_name FROM cost_sharings WHERE benefit_name IS NOT NULL
+                AND network_tier = '{IN_NETWORK}' AND {plan_filter}
+            ''', params + params))
+            columns = {name: j for j, name in enumerate(benefit_names)}
+            shape = (len(plans), len(benefit_names))
+            covered = np.zeros(shape, dtype=bool)
+            copay = np.zeros(shape)
+            coinsurance = np.zeros(shape)
+            after_deductible = np.zeros(shape, dtype=bool)
+            has_sharing = np.zeros(shape, dtype=bool)
+            has_preferred = np.zeros(shape, dtype=bool)
+
+            # Child rows are streamed straight into the arrays
+            for plan_id, name, is_covered in conn.execute(
+                    f'SELECT plan_id, name, covered FROM benefits WHERE name IS NOT NULL AND {plan_filter}', params):
+                covered[index[plan_id], columns[name]] = bool(is_covered)
+            for plan_id, name, copay_amount, coinsurance_rate, display, row_csr in conn.execute(f'''
+                SELECT plan_id, benefit_name, copay_amount, coinsurance_rate, display_string, csr
+                FROM cost_sharings
+                WHERE benefit_name IS NOT NULL AND network_tier = '{IN_NETWORK}' AND {plan_filter}
+            ''', params):
+                i, j = index[plan_id], columns[name]
+                # Once the preferred variant is seen, other variants no longer overwrite it
+                preferred = row_csr == csr
+                if has_preferred[i, j] and not preferred:
+                    continue
+                has_preferred[i, j] |= preferred
+                copay[i, j] = copay_amount or 0.0
+                coinsurance[i, j] = coinsurance_rate or 0.0
+                after_deductible[i, j] = 'after deductible' in (display or '').lower()
+                has_sharing[i, j] = True
+        # A benefit without in-network cost sharing is treated as not covered
+        covered &= has_sharing
+
+        return cls(
+            plan_ids=[row[1] for row in plans],
+            premiums=np.array([row[2] or 0.0 for row in plans]),
+            benefit_names=benefit_names,
+            covered=covered,
+            copay=copay,
+            coinsurance=coinsurance,
+            after_deductible=after_deductible,
+            deductible=np.array([np.nan if row[3] is None else row[3] for row in plans]),
+            drug_deductible=np.array([np.nan if row[4] is None else row[4] for row in plans]),
+            combined_deductible=np.array([bool(row[6]) for row in plans]),
+            moop=np.array([np.nan if row[5] is None else row[5] for row in plans]),
+            row_ids=np.array([row[0] for row in plans], dtype=np.int64),
+        )
+
+    def utilization_matrix(self, profiles: Sequence[Dict[str, float]],
+                           prices: Optional[Dict[str, float]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Turn profiles into arrays over the model's benefits.
+
+        Profile keys are benefit names or `PROFILE_ALIASES`; benefits no plan
+        offers are added as uncovered columns by `estimate`.
+
+        Returns:
+            (visits of shape (profiles, benefits), price per benefit)
+        """
+        prices = {**DEFAULT_PRICES, **(prices or {})}
+        names = list(self.benefit_names)
+        columns = dict(self.benefit_index)
+        rows = []
+        for profile in profiles:
+            row = {}
+            for key, count in profile.items():
+                name = PROFILE_ALIASES.get(key, key)
+                if name not in columns:
+                    columns[name] = len(names)
+                    names.append(name)
+                row[columns[name]] = row.get(columns[name], 0.0) + float(count)
+            rows.append(row)
+        visits = np.zeros((len(profiles), len(names)))
+        for k, row in enumerate(rows):
+            for j, count in row.items():
+                visits[k, j] = count
+        price = np.array([prices.get(name, FALLBACK_PRICE) for name in names])
+        return visits, price
+
+    def estimate(self, profiles: Sequence[Dict[str, float]], prices: Optional[Dict[str, float]] = None,
+                 include_premium: bool = True, chunk_size: int = 20000,
+                 dtype=np.float32) -> np.ndarray:
+        """
+        Expected annual cost of every plan for every profile.
+
+        Returns:
+            Array of shape (profiles, plans)
+        """
+        visits, price = self.utilization_matrix(profiles, prices)
+        out = np.empty((len(profiles), len(self)), dtype=dtype)
+        for start, costs in self._iter_costs(visits, price, include_premium, chunk_size, dtype):
+            out[:, start:start + costs.shape[1]] = costs
+        return out
+
+    def rank(self, profiles: Sequence[Dict[str, float]], top_k: int = 10,
+             prices: Optional[Dict[str, float]] = None, chunk_size: int = 20000) -> List[List[Tuple[str, float]]]:
+        """
+        Cheapest `top_k` plans per profile, without materializing the full
+        (profiles, plans) matrix.
+
+        Returns:
+            Per profile, a list of (plan_id, annual cost) sorted by cost
+        """
+        visits, price = self.utilization_matrix(profiles, prices)
+        best_cost = np.full((len(profiles), 0), np.inf)
+        best_index = np.zeros((len(profiles), 0), dtype=np.int64)
+        for start, costs in self._iter_costs(visits, price, True, chunk_size):
+            cost = np.concatenate([best_cost, costs], axis=1)
+            index = np.concatenate([best_index, np.broadcast_to(
+                np.arange(start, start + costs.shape[1]), costs.shape)], axis=1)
+            keep = min(top_k, cost.shape[1])
+            part = np.argpartition(cost, keep - 1, axis=1)[:, :keep]
+            best_cost = np.take_along_axis(cost, part, axis=1)
+            best_index = np.take_along_axis(index, part, axis=1)
+
+        order = np.argsort(best_cost, axis=1)
+        best_cost = np.take_along_axis(best_cost, order, axis=1)
+        best_index = np.take_along_axis(best_index, order, axis=1)
+        return [[(self.plan_ids[i], round(float(c), 2)) for i, c in zip(indices, costs)]
+                for indices, costs in zip(best_index, best_cost)]
+
+    def _iter_costs(self, visits: np.ndarray, price: np.ndarray, include_premium: bool, chunk_size: int,
+                    dtype=np.float32):
+        """Yield (first plan index, costs of shape (profiles, chunk)) per chunk of plans."""
+        n_benefits = len(self.benefit_names)
+        spend = visits * price                                      # (K, B)
+        # Benefits only the profiles mention are uncovered everywhere
+        uncovered_extra = spend[:, n_benefits:].sum(axis=1, keepdims=True).astype(dtype)
+        visits = visits[:, :n_benefits].astype(dtype)
+        spend = spend[:, :n_benefits].astype(dtype)
+        price = price[:n_benefits]
+        is_drug = self.is_drug
+
+        for start in range(0, len(self), chunk_size):
+            end = min(start + chunk_size, len(self))
+            covered = self.covered[start:end]                       # (P, B)
+            ded = covered & self.after_deductible[start:end]
+            no_ded = covered & ~self.after_deductible[start:end]
+            # With a combined deductible, drugs count toward the medical one
+            combined = self.combined_deductible[start:end, None]
+            ded_med = ded & (~is_drug | combined)
+            ded_drug = ded & is_drug & ~combined
+            # Member cost per visit once cost sharing applies, never above the price
+            unit = np.minimum(self.copay[start:end] + self.coinsurance[start:end] * price, price)
+
+            # Per (profile, plan): spend subject to each deductible, and what those
+            # services would cost under cost sharing alone
+            costs = self._deductible_cost(spend @ ded_med.T.astype(dtype),
+                                          visits @ (unit * ded_med).T.astype(dtype),
+                                          self.deductible[start:end].astype(dtype))
+            costs += self._deductible_cost(spend @ ded_drug.T.astype(dtype),
+                                           visits @ (unit * ded_drug).T.astype(dtype),
+                                           self.drug_deductible[start:end].astype(dtype))
+            costs += visits @ (unit * no_ded).T.astype(dtype)
+            np.minimum(costs, self.moop[start:end].astype(dtype), out=costs)
+            costs += spend @ (~covered).T.astype(dtype)
+            costs += uncovered_extra
+            if include_premium:
+                costs += (12 * self.premiums[start:end]).astype(dtype)
+            yield start, costs
+
+    @staticmethod
+    def _deductible_cost(spend: np.ndarray, shared: np.ndarray, deductible: np.ndarray) -> np.ndarray:
+        """
+        Member cost of services subject to a deductible: spend up to the
+        deductible in full, then the share of `shared` for the spend beyond it.
+        Overwrites and returns `spend`.
+        """
+        paid = np.minimum(spend, deductible)
+        total = np.maximum(spend, np.finfo(spend.dtype).tiny)
+        spend -= paid
+        spend /= total
+        spend *= shared
+        spend += paid
+        return spend
@@ -1,8 +1,26 @@
 import streamlit as st
 import pandas as pd
 import plotly.express as px
-import os
-from pathlib import Path
+import plotly.graph_objects as go
+
+import dashboard_data
+
+DB_PATH = "marketplace.db"
+
+# Query results are cached per filter combination for a bounded time and number of entries
+CACHE_TTL = 300
+CACHE_MAX_ENTRIES = 64
+cached = st.cache_data(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+
+filter_options = cached(dashboard_data.filter_options)
+summary_metrics = cached(dashboard_data.summary_metrics)
+metal_level_counts = cached(dashboard_data.metal_level_counts)
+cheapest_plans = cached(dashboard_data.cheapest_plans)
+benefit_coverage = cached(dashboard_data.benefit_coverage)
+premium_stats = cached(dashboard_data.premium_stats)
+explorer_tables = cached(dashboard_data.explorer_tables)
+explorer_page = cached(dashboard_data.explorer_page)
+explorer_count = cached(dashboard_data.explorer_count)
 
 # Page config
 st.set_page_config(
@@ -11,98 +29,109 @@ st.set_page_config(
     layout="wide"
 )
 
-# Load data function
-@st.cache_data
-def load_data():
-    data_dir = Path("exported_csvs")
-    data = {}
-    for file in data_dir.glob("*.csv"):
-        name = file.stem
-        data[name] = pd.read_csv(file)
-    return data
-
-# Load all data
-data = load_data()
-
 # Sidebar filters
+options = filter_options(DB_PATH)
 st.sidebar.title("Filters")
-selected_plans = st.sidebar.multiselect(
-    "Select Plans",
-    options=data['plans']['name'].unique() if 'plans' in data else []
+selected_plans = st.sidebar.multiselect("Select Plans", options=options['plan_names'])
+selected_metals = st.sidebar.multiselect("Metal Level", options=options['metal_levels'])
+selected_states = st.sidebar.multiselect("State", options=options['states'])
+
+# Filters are pushed down into every query
+filters = dict(
+    plan_names=tuple(selected_plans),
+    metal_levels=tuple(selected_metals),
+    states=tuple(selected_states),
 )
 
 # Main dashboard
 st.title("Healthcare Marketplace Dashboard")
 
 # Summary cards
-if 'plans' in data:
-    col1, col2, col3 = st.columns(3)
-    with col1:
-        st.metric("Total Plans", len(data['plans']))
-    with col2:
-        st.metric("Unique Issuers", data['issuers']['name'].nunique() if 'issuers' in data else 0)
-    with col3:
-        st.metric("Avg Premium", f"${data['plans']['premium'].mean():.2f}" if 'plans' in data else "N/A")
+metrics = summary_metrics(DB_PATH, **filters)
+col1, col2, col3 = st.columns(3)
+with col1:
+    st.metric("Total Plans", int(metrics['total_plans']))
+with col2:
+    st.metric("Unique Issuers", int(metrics['unique_issuers']))
+with col3:
+    st.metric("Avg Premium", f"${metrics['avg_premium']:.2f}" if pd.notna(metrics['avg_premium']) else "N/A")
 
 # Plans by Metal Level
-if 'plans' in data:
-    st.subheader("Plans by Metal Level")
-    metal_counts = data['plans']['metal_level'].value_counts().reset_index()
-    metal_counts.columns = ['Metal Level', 'Count']
-    
-    col1, col2 = st.columns([3, 2])
-    
-    with col1:
-        fig = px.bar(
-            metal_counts,
-            x='Metal Level',
-            y='Count',
-            color='Metal Level',
-            title="Number of Plans by Metal Level"
-        )
-        st.plotly_chart(fig, use_container_width=True)
-    
-    with col2:
-        st.dataframe(
-            data['plans'][['name', 'metal_level', 'premium']].sort_values('premium'),
-            hide_index=True,
-            use_container_width=True
-        )
+st.subheader("Plans by Metal Level")
+metal_counts = metal_level_counts(DB_PATH, **filters)
 
-# Benefits Coverage
-if 'benefits' in data:
-    st.subheader("Benefits Coverage")
-    benefit_coverage = data['benefits'].groupby('name')['covered'].mean().reset_index()
-    benefit_coverage.columns = ['Benefit', 'Coverage Rate']
-    benefit_coverage['Coverage Rate'] = (benefit_coverage['Coverage Rate'] * 100).round(1)
-    
+col1, col2 = st.columns([3, 2])
+
+with col1:
     fig = px.bar(
-        benefit_coverage,
-        x='Coverage Rate',
-        y='Benefit',
-        orientation='h',
-        title="Percentage of Plans Covering Each Benefit"
+        metal_counts,
+        x='Metal Level',
+        y='Count',
+        color='Metal Level',
+        title="Number of Plans by Metal Level"
     )
     st.plotly_chart(fig, use_container_width=True)
 
-# Premium Distribution
-if 'plans' in data and 'metal_level' in data['plans']:
-    st.subheader("Premium Distribution by Metal Level")
-    fig = px.box(
-        data['plans'],
-        x='metal_level',
-        y='premium',
-        color='metal_level',
-        title="Premium Distribution by Metal Level"
+with col2:
+    st.dataframe(
+        cheapest_plans(DB_PATH, **filters),
+        hide_index=True,
+        use_container_width=True
     )
-    st.plotly_chart(fig, use_container_width=True)
 
-# Raw Data Explorer
+# Benefits Coverage
+st.subheader("Benefits Coverage")
+coverage = benefit_coverage(DB_PATH, **filters)
+coverage['Coverage Rate'] = (coverage['Coverage Rate'] * 100).round(1)
+
+fig = px.bar(
+    coverage,
+    x='Coverage Rate',
+    y='Benefit',
+    orientation='h',
+    title="Percentage of Plans Covering Each Benefit"
+)
+st.plotly_chart(fig, use_container_width=True)
+
+# Premium Distribution (box plot drawn from precomputed quartiles)
+st.subheader("Premium Distribution by Metal Level")
+fig = go.Figure()
+for _, stats in premium_stats(DB_PATH, **filters).iterrows():
+    fig.add_trace(go.Box(
+        name=str(stats['metal_level']),
+        q1=[stats['premium_q1']],
+        median=[stats['premium_median']],
+        q3=[stats['premium_q3']],
+        lowerfence=[stats['premium_min']],
+        upperfence=[stats['premium_max']],
+        mean=[stats['premium_mean']],
+    ))
+fig.update_layout(title="Premium Distribution by Metal Level", xaxis_title="metal_level", yaxis_title="premium")
+st.plotly_chart(fig, use_container_width=True)
+
+# Raw Data Explorer, one keyset-paginated page at a time
 st.subheader("Data Explorer")
 selected_table = st.selectbox(
     "Select Table to Explore",
-    list(data.keys())
+    explorer_tables(DB_PATH)
 )
 
-if selected_table in data:
-    st.dataframe(data[selected_table], use_container_width=True)
\ No newline at end of file
+if selected_table:
+    # Start rowids of the pages visited so far, per table and filter combination
+    page_key = f"explorer:{selected_table}:{sorted(filters.items())}"
+    pages = st.session_state.setdefault(page_key, [0])
+    page, next_rowid = explorer_page(DB_PATH, selected_table, pages[-1], **filters)
+
+    total = explorer_count(DB_PATH, selected_table, **filters)
+    st.caption(f"Page {len(pages)} · {total} rows")
+    st.dataframe(page, use_container_width=True)
+
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("Previous page", disabled=len(pages) == 1):
+            pages.pop()
+            st.rerun()
+    with col2:
+        if st.button("Next page", disabled=next_rowid is None):
+            pages.append(next_rowid)
+            st.rerun()
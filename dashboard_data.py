@@ -0,0 +1,185 @@
+"""
+Data access for `dashboard.py`.
+
+Every function runs a small SQL query against `marketplace.db` with the
+dashboard's filters (plan names, metal levels, states) pushed into the
+WHERE clause, so a Streamlit session only holds the rows it displays.
+Unfiltered charts read the summary tables maintained by `MarketplaceDB`;
+the data explorer pages through tables with keyset pagination on their
+integer `id` (rowid for tables without one).
+
+The functions take plain, hashable arguments so `dashboard.py` can cache
+them per filter combination with `st.cache_data`.
+"""
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import pandas as pd
+
+from db import MarketplaceDB, data_tables, get_pool
+
+DEFAULT_DB_PATH = 'marketplace.db'
+DEFAULT_PAGE_SIZE = 100
+
+_ready = set()
+
+
+def _connection(db_path: str):
+    if db_path not in _ready:
+        # Creates/migrates the schema once, including the summary tables
+        MarketplaceDB(db_path)
+        _ready.add(db_path)
+    return get_pool(db_path).connection()
+
+
+def _query(db_path: str, sql: str, params: Sequence[Any] = ()) -> pd.DataFrame:
+    with _connection(db_path) as conn:
+        return pd.read_sql_query(sql, conn, params=list(params))
+
+
+def _plan_filter(plan_names: Sequence[str] = (), metal_levels: Sequence[str] = (),
+                 states: Sequence[str] = (), alias: str = '') -> Tuple[str, List[Any]]:
+    """Build the WHERE conditions (joined with AND, '1' if none) on the plans table."""
+    prefix = f'{alias}.' if alias else ''
+    conditions, params = [], []
+    for column, values in (('name', plan_names), ('metal_level', metal_levels), ('state', states)):
+        if values:
+            conditions.append(f"{prefix}{column} IN ({','.join('?' * len(values))})")
+            params.extend(values)
+    return ' AND '.join(conditions) or '1', params
+
+
+def _has_filters(plan_names, metal_levels, states) -> bool:
+    return bool(plan_names or metal_levels or states)
+
+
+def filter_options(db_path: str = DEFAULT_DB_PATH) -> Dict[str, List[str]]:
+    """Distinct plan names, metal levels and states for the sidebar filters."""
+    options = {}
+    for key, column in (('plan_names', 'name'), ('metal_levels', 'metal_level'), ('states', 'state')):
+        df = _query(db_path, f'SELECT DISTINCT {column} AS value FROM plans '
+                             f'WHERE {column} IS NOT NULL ORDER BY {column}')
+        options[key] = df['value'].tolist()
+    return options
+
+
+def summary_metrics(db_path: str = DEFAULT_DB_PATH, plan_names: Tuple[str, ...] = (),
+                    metal_levels: Tuple[str, ...] = (), states: Tuple[str, ...] = ()) -> Dict[str, Any]:
+    """Total plans, unique issuers and average premium of the filtered plans."""
+    where, params = _plan_filter(plan_names, metal_levels, states, 'p')
+    df = _query(db_path, f'''
+        SELECT COUNT(*) AS total_plans, AVG(p.premium) AS avg_premium,
+               (SELECT COUNT(DISTINCT i.name) FROM issuers i
+                WHERE i.plan_id IN (SELECT p.plan_id FROM plans p WHERE {where})) AS unique_issuers
+        FROM plans p WHERE {where}
+    ''', params + params)
+    return df.iloc[0].to_dict()
+
+
+def metal_level_counts(db_path: str = DEFAULT_DB_PATH, plan_names: Tuple[str, ...] = (),
+                       metal_levels: Tuple[str, ...] = (), states: Tuple[str, ...] = ()) -> pd.DataFrame:
+    """Number of filtered plans per metal level."""
+    where, params = _plan_filter(plan_names, metal_levels, states)
+    return _query(db_path, f'''
+        SELECT metal_level AS "Metal Level", COUNT(*) AS "Count" FROM plans
+        WHERE {where} GROUP BY metal_level ORDER BY COUNT(*) DESC
+    ''', params)
+
+
+def cheapest_plans(db_path: str = DEFAULT_DB_PATH, plan_names: Tuple[str, ...] = (),
+                   metal_levels: Tuple[str, ...] = (), states: Tuple[str, ...] = (),
+                   limit: int = 500) -> pd.DataFrame:
+    """Name, metal level and premium of the `limit` cheapest filtered plans."""
+    where, params = _plan_filter(plan_names, metal_levels, states)
+    return _query(db_path, f'''
+        SELECT name, metal_level, premium FROM plans
+        WHERE {where} ORDER BY premium LIMIT ?
+    ''', params + [limit])
+
+
+def benefit_coverage(db_path: str = DEFAULT_DB_PATH, plan_names: Tuple[str, ...] = (),
+                     metal_levels: Tuple[str, ...] = (), states: Tuple[str, ...] = ()) -> pd.DataFrame:
+    """Share of filtered plans covering each benefit."""
+    if not _has_filters(plan_names, metal_levels, states):
+        return _query(db_path, '''
+            SELECT name AS "Benefit", CAST(covered_count AS REAL) / plan_count AS "Coverage Rate"
+            FROM benefit_coverage ORDER BY name
+        ''')
+    where, params = _plan_filter(plan_names, metal_levels, states)
+    return _query(db_path, f'''
+        SELECT name AS "Benefit", AVG(covered) AS "Coverage Rate" FROM benefits
+        WHERE plan_id IN (SELECT plan_id FROM plans WHERE {where})
+        GROUP BY name ORDER BY name
+    ''', params)
+
+
+def premium_stats(db_path: str = DEFAULT_DB_PATH, plan_names: Tuple[str, ...] = (),
+                  metal_levels: Tuple[str, ...] = (), states: Tuple[str, ...] = ()) -> pd.DataFrame:
+    """Premium min/quartiles/max/mean per metal level, shaped like metal_premium_stats."""
+    if not _has_filters(plan_names, metal_levels, states):
+        return _query(db_path, 'SELECT * FROM metal_premium_stats ORDER BY premium_median')
+    where, params = _plan_filter(plan_names, metal_levels, states)
+    premiums = _query(db_path, f'SELECT metal_level, premium FROM plans WHERE {where}', params)
+    grouped = premiums.groupby('metal_level', dropna=False)['premium']
+    stats = pd.DataFrame({
+        'plan_count': grouped.size(),
+        'premium_min': grouped.min(),
+        'premium_q1': grouped.quantile(0.25),
+        'premium_median': grouped.median(),
+        'premium_q3': grouped.quantile(0.75),
+        'premium_max': grouped.max(),
+        'premium_mean': grouped.mean(),
+    })
+    return stats.reset_index().sort_values('premium_median')
+
+
+def explorer_tables(db_path: str = DEFAULT_DB_PATH) -> List[str]:
+    """Tables (or, in the normalized layout, their views) that can be browsed in the data explorer."""
+    with _connection(db_path) as conn:
+        return sorted(name for name in data_tables(conn) if not name.startswith('sqlite_'))
+
+
+def _table_filter(db_path: str, table: str, plan_names, metal_levels, states) -> Tuple[str, List[Any]]:
+    """Plan filters applied to a table: directly on plans, via plan_id on child tables."""
+    if table == 'plans':
+        return _plan_filter(plan_names, metal_levels, states)
+    if not _has_filters(plan_names, metal_levels, states):
+        return '1', []
+    columns = _query(db_path, f'PRAGMA table_info({table})')['name'].tolist()
+    if 'plan_id' not in columns:
+        return '1', []
+    where, params = _plan_filter(plan_names, metal_levels, states)
+    return f'plan_id IN (SELECT plan_id FROM plans WHERE {where})', params
+
+
+def explorer_page(db_path: str, table: str, after_rowid: int = 0, page_size: int = DEFAULT_PAGE_SIZE,
+                  plan_names: Tuple[str, ...] = (), metal_levels: Tuple[str, ...] = (),
+                  states: Tuple[str, ...] = ()) -> Tuple[pd.DataFrame, Optional[int]]:
+    """
+    One page of a table, keyset-paginated on its `id` column, or on rowid
+    for tables without one (views of the normalized layout have no rowid).
+
+    Returns:
+        The page's rows and the key to pass as `after_rowid` for the next
+        page (None on the last page)
+    """
+    if table not in explorer_tables(db_path):
+        raise ValueError(f"Unknown table: {table}")
+    where, params = _table_filter(db_path, table, plan_names, metal_levels, states)
+    columns = _query(db_path, f'PRAGMA table_info({table})')['name'].tolist()
+    key = 'id' if 'id' in columns else 'rowid'
+    # One extra row tells whether there is a next page
+    page = _query(db_path, f'''
+        SELECT {key} AS _rowid, * FROM {table}
+        WHERE {key} > ? AND {where} ORDER BY {key} LIMIT ?
+    ''', [after_rowid] + params + [page_size + 1])
+    next_rowid = int(page['_rowid'].iloc[page_size - 1]) if len(page) > page_size else None
+    return page.head(page_size).drop(columns='_rowid'), next_rowid
+
+
+def explorer_count(db_path: str, table: str, plan_names: Tuple[str, ...] = (),
+                   metal_levels: Tuple[str, ...] = (), states: Tuple[str, ...] = ()) -> int:
+    """Number of rows of a table matching the filters."""
+    if table not in explorer_tables(db_path):
+        raise ValueError(f"Unknown table: {table}")
+    where, params = _table_filter(db_path, table, plan_names, metal_levels, states)
+    return int(_query(db_path, f'SELECT COUNT(*) AS n FROM {table} WHERE {where}', params)['n'].iloc[0])
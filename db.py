@@ -1,35 +1,826 @@
 import sqlite3
 from datetime import datetime
+import hashlib
+import io
 import json
-from typing import Dict, List, Any
+import os
+import queue
+import re
+import tempfile
+import threading
+from collections import Counter, OrderedDict
+from contextlib import closing, contextmanager, redirect_stdout
+from typing import Dict, List, Any, Callable, Iterable, Iterator, Optional
+
+# Full rebuild of benefit_coverage; save_plans applies deltas instead
+BENEFIT_COVERAGE_SQL = '''
+    INSERT INTO benefit_coverage (name, plan_count, covered_count)
+    SELECT name, COUNT(*), COALESCE(SUM(covered), 0) FROM benefits
+    WHERE name IS NOT NULL GROUP BY name
+'''
+
+# In-network copays rolled up per plan in plan_rollups, by benefit name
+ROLLUP_COPAYS = {
+    'primary_care_copay': 'Primary Care Visit to Treat an Injury or Illness',
+    'specialist_copay': 'Specialist Visit',
+    'generic_drugs_copay': 'Generic Drugs',
+    'emergency_room_copay': 'Emergency Room Services',
+}
+
+# Individual in-network amounts; every subquery is served by a plan_id index
+_IN_NETWORK = "network_tier = 'In-Network' AND (family_cost IS NULL OR family_cost = 'Individual')"
+PLAN_ROLLUP_SQL = f'''
+    INSERT OR REPLACE INTO plan_rollups (
+        plan_id, metal_level, state, premium, deductible, drug_deductible, moop,
+        {', '.join(ROLLUP_COPAYS)}, benefit_count, covered_benefit_count
+    )
+    SELECT
+        p.plan_id, p.metal_level, p.state, p.premium,
+        (SELECT MAX(amount) FROM deductibles d WHERE d.plan_id = p.plan_id AND {_IN_NETWORK}
+            AND type IN ('Combined Medical and Drug EHB Deductible', 'Medical EHB Deductible')),
+        (SELECT MAX(amount) FROM deductibles d WHERE d.plan_id = p.plan_id AND {_IN_NETWORK}
+            AND type IN ('Combined Medical and Drug EHB Deductible', 'Drug EHB Deductible')),
+        (SELECT MAX(amount) FROM moops m WHERE m.plan_id = p.plan_id AND {_IN_NETWORK}),
+        {', '.join(
+            f"(SELECT MIN(copay_amount) FROM cost_sharings c WHERE c.plan_id = p.plan_id "
+            f"AND c.benefit_name = '{benefit}' AND c.network_tier = 'In-Network')"
+            for benefit in ROLLUP_COPAYS.values()
+        )},
+        (SELECT COUNT(*) FROM benefits b WHERE b.plan_id = p.plan_id),
+        (SELECT COALESCE(SUM(covered), 0) FROM benefits b WHERE b.plan_id = p.plan_id)
+    FROM plans p
+'''
+
+# Schema migrations applied in order; PRAGMA user_version records how many have run.
+# In the normalized layout cost_sharings and benefits are views, so migrations must
+# not index or alter them directly.
+MIGRATIONS = [
+    # 1: indexes for the plan_id access paths on every child table
+    [
+        'CREATE INDEX IF NOT EXISTS idx_issuers_plan_id ON issuers(plan_id)',
+        'CREATE INDEX IF NOT EXISTS idx_benefits_plan_id_name ON benefits(plan_id, name)',
+        'CREATE INDEX IF NOT EXISTS idx_cost_sharings_plan_benefit_tier '
+        'ON cost_sharings(plan_id, benefit_name, network_tier)',
+        'CREATE INDEX IF NOT EXISTS idx_deductibles_plan_id_tier ON deductibles(plan_id, network_tier)',
+        'CREATE INDEX IF NOT EXISTS idx_moops_plan_id_tier ON moops(plan_id, network_tier)',
+    ],
+    # 2: content hash per plan for change detection
+    [
+        'ALTER TABLE plans ADD COLUMN content_hash TEXT',
+    ],
+    # 3: updated_at watermark lookups of the incremental CSV export
+    [
+        'CREATE INDEX IF NOT EXISTS idx_plans_updated_at ON plans(updated_at)',
+    ],
+    # 4: summary tables kept up to date by save_plans, backfilled from existing rows
+    [
+        '''CREATE TABLE IF NOT EXISTS plan_rollups (
+            plan_id TEXT PRIMARY KEY,
+            metal_level TEXT,
+            state TEXT,
+            premium REAL,
+            deductible REAL,
+            drug_deductible REAL,
+            moop REAL,
+            primary_care_copay REAL,
+            specialist_copay REAL,
+            generic_drugs_copay REAL,
+            emergency_room_copay REAL,
+            benefit_count INTEGER,
+            covered_benefit_count INTEGER
+        )''',
+        '''CREATE TABLE IF NOT EXISTS benefit_coverage (
+            name TEXT PRIMARY KEY,
+            plan_count INTEGER NOT NULL,
+            covered_count INTEGER NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS metal_premium_stats (
+            metal_level TEXT,
+            plan_count INTEGER NOT NULL,
+            premium_min REAL,
+            premium_q1 REAL,
+            premium_median REAL,
+            premium_q3 REAL,
+            premium_max REAL,
+            premium_mean REAL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_plans_metal_premium ON plans(metal_level, premium)',
+        'CREATE INDEX IF NOT EXISTS idx_plan_rollups_metal_premium ON plan_rollups(metal_level, premium)',
+        lambda cursor: _refresh_plan_rollups(cursor),
+        BENEFIT_COVERAGE_SQL,
+        lambda cursor: _refresh_metal_premium_stats(cursor),
+    ],
+    # 5: sort keys of plan_search.PlanSearch
+    [
+        'CREATE INDEX IF NOT EXISTS idx_plans_premium ON plans(premium)',
+        'CREATE INDEX IF NOT EXISTS idx_plan_rollups_deductible ON plan_rollups(deductible, plan_id)',
+        'CREATE INDEX IF NOT EXISTS idx_plan_rollups_moop ON plan_rollups(moop, plan_id)',
+    ],
+    # 6: run-versioned history (see HISTORY_TABLES), starting from the stored plans
+    [
+        '''CREATE TABLE IF NOT EXISTS collection_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source TEXT,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP,
+            inserted INTEGER,
+            updated INTEGER,
+            unchanged INTEGER
+        )''',
+        '''CREATE TABLE IF NOT EXISTS plan_history (
+            id INTEGER PRIMARY KEY,
+            run_id INTEGER NOT NULL REFERENCES collection_runs(id),
+            plan_id TEXT NOT NULL,
+            premium REAL,
+            deductible REAL,
+            drug_deductible REAL,
+            moop REAL,
+            removed INTEGER NOT NULL DEFAULT 0
+        )''',
+        '''CREATE TABLE IF NOT EXISTS cost_sharing_history (
+            id INTEGER PRIMARY KEY,
+            run_id INTEGER NOT NULL REFERENCES collection_runs(id),
+            plan_id TEXT NOT NULL,
+            benefit_name TEXT,
+            network_tier TEXT,
+            csr TEXT,
+            copay_amount REAL,
+            coinsurance_rate REAL,
+            display_string TEXT,
+            removed INTEGER NOT NULL DEFAULT 0
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_plan_history_plan_run ON plan_history(plan_id, run_id)',
+        'CREATE INDEX IF NOT EXISTS idx_cost_sharing_history_plan_run ON cost_sharing_history(plan_id, run_id)',
+        'CREATE INDEX IF NOT EXISTS idx_collection_runs_started_at ON collection_runs(started_at)',
+        lambda cursor: _record_baseline(cursor),
+    ],
+    # 7: strictly increasing change sequence per plan insert/update, the incremental
+    # CSV export's watermark (updated_at only has one-second resolution). The counter
+    # lives in its own row so values are never reused, even after deletes.
+    [
+        'CREATE TABLE IF NOT EXISTS change_counter (seq INTEGER NOT NULL)',
+        'INSERT INTO change_counter (seq) SELECT COALESCE(MAX(id), 0) FROM plans',
+        'ALTER TABLE plans ADD COLUMN change_seq INTEGER',
+        'UPDATE plans SET change_seq = id',
+        'CREATE INDEX IF NOT EXISTS idx_plans_change_seq ON plans(change_seq)',
+        '''CREATE TRIGGER IF NOT EXISTS plans_change_seq_insert AFTER INSERT ON plans
+        BEGIN
+            UPDATE change_counter SET seq = seq + 1;
+            UPDATE plans SET change_seq = (SELECT seq FROM change_counter) WHERE id = NEW.id;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS plans_change_seq_update AFTER UPDATE ON plans
+        WHEN NEW.change_seq IS OLD.change_seq
+        BEGIN
+            UPDATE change_counter SET seq = seq + 1;
+            UPDATE plans SET change_seq = (SELECT seq FROM change_counter) WHERE id = NEW.id;
+        END''',
+    ],
+    # 8: deletes bump the change sequence too, so it alone tells whether plans changed (see db_version)
+    [
+        '''CREATE TRIGGER IF NOT EXISTS plans_change_seq_delete AFTER DELETE ON plans
+        BEGIN
+            UPDATE change_counter SET seq = seq + 1;
+        END''',
+    ],
+    # 9: removals in plan_history (deleted plans, and plans a complete run no longer
+    # returned), and the plans each unfinished run returned (see finish_run)
+    [
+        # Databases migrated past 6 before plan_history had the column
+        lambda cursor: _add_column(cursor, 'plan_history', 'removed', 'INTEGER NOT NULL DEFAULT 0'),
+        '''CREATE TABLE IF NOT EXISTS run_plans (
+            run_id INTEGER NOT NULL REFERENCES collection_runs(id),
+            plan_id TEXT NOT NULL,
+            PRIMARY KEY (run_id, plan_id)
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_plans_state ON plans(state)',
+    ],
+]
+
+# Columns of the plans table that can be used as filters
+PLAN_COLUMNS = {
+    'id', 'plan_id', 'name', 'premium', 'metal_level', 'type', 'state', 'product_division',
+    'insurance_market', 'hsa_eligible', 'has_national_network', 'max_age_child',
+    'created_at', 'updated_at', 'content_hash', 'change_seq'
+}
+
+# Columns written to the plans table for each saved plan
+PLAN_ROW_COLUMNS = (
+    'plan_id', 'name', 'premium', 'metal_level', 'type', 'state', 'product_division',
+    'insurance_market', 'hsa_eligible', 'has_national_network', 'max_age_child', 'content_hash'
+)
+# A saved plan that already exists keeps the stored values its new row lacks
+PLAN_UPSERT = 'ON CONFLICT(plan_id) DO UPDATE SET ' + ', '.join(
+    [f'{column} = COALESCE(excluded.{column}, {column})' for column in PLAN_ROW_COLUMNS[1:-1]] +
+    ['content_hash = excluded.content_hash', 'updated_at = CURRENT_TIMESTAMP']
+)
+
+# Stored columns of the tables holding each plan's related rows
+CHILD_COLUMNS = {
+    'issuers': ('plan_id', 'issuer_id', 'name', 'state', 'toll_free'),
+    'benefits': ('plan_id', 'name', 'covered', 'has_limits', 'limit_unit', 'limit_quantity'),
+    'cost_sharings': ('plan_id', 'benefit_name', 'network_tier', 'copay_amount',
+                      'coinsurance_rate', 'display_string', 'csr'),
+    'deductibles': ('plan_id', 'type', 'amount', 'network_tier', 'family_cost'),
+    'moops': ('plan_id', 'type', 'amount', 'network_tier', 'family_cost'),
+}
+
+# Run-versioned history: per history table, (source table, key columns, value
+# columns). A collection run appends a row for a plan's key only when its values
+# differ from the latest recorded ones, and a `removed` row when a keyed row is gone.
+HISTORY_TABLES = {
+    'plan_history': ('plan_rollups', (), ('premium', 'deductible', 'drug_deductible', 'moop')),
+    'cost_sharing_history': ('cost_sharings', ('benefit_name', 'network_tier', 'csr'),
+                             ('copay_amount', 'coinsurance_rate', 'display_string')),
+}
+
+# Optional normalized layout (MarketplaceDB(normalized=True)): the repeated strings of
+# these tables move to lookup tables of (id, value) and their rows, kept in a storage
+# table, reference them by id. A view with the original name and columns, backed by
+# INSTEAD OF triggers, stands in for each table so readers and writers are unchanged.
+NORMALIZED_TABLES = {
+    'cost_sharings': ('cost_sharing_rows', {
+        'benefit_name': 'benefit_names',
+        'network_tier': 'network_tiers',
+        'display_string': 'display_strings',
+        'csr': 'csr_variants',
+    }),
+    'benefits': ('benefit_rows', {'name': 'benefit_names'}),
+}
+LOOKUP_TABLES = sorted({lookup for _, lookups in NORMALIZED_TABLES.values() for lookup in lookups.values()})
+
+# Sample plans replayed by traced_statements
+SAMPLE_PLANS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'healthcare_plans.json')
+
+# Statements whose query plans check_query_plans() looks at; literals in traced SQL become placeholders
+CHECKED_STATEMENT = re.compile(r'^(SELECT|WITH|INSERT|REPLACE|UPDATE|DELETE)\b.*\bWHERE\b', re.I | re.S)
+# Connection-local tables some of them use, recreated before they are checked
+TEMP_TABLE = re.compile(r'^CREATE TEMP(ORARY)? TABLE\b', re.I)
+# Summary tables with one row per metal level or benefit name, cheaper to scan than to index
+SMALL_TABLES = {'metal_premium_stats', 'benefit_coverage', 'sqlite_master'}
+SQL_LITERAL = re.compile(r"'(?:[^']|'')*'|\bX'[0-9A-Fa-f]*'|(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?(?![\w.])")
+PLACEHOLDER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+
+# Connections per database file and process (see get_pool)
+DEFAULT_POOL_SIZE = int(os.getenv('MARKETPLACE_DB_POOL_SIZE', '8'))
+
+# Pragmas applied to every pooled connection
+CONNECTION_PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -32000',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA busy_timeout = 30000',
+    'PRAGMA foreign_keys = ON',
+]
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of SQLite connections to one database file.
+
+    Each thread checks out one connection at a time; nested checkouts on the
+    same thread reuse it. When the outermost checkout ends, any open
+    transaction is committed (or rolled back on error) and the connection
+    goes back to the pool. A checkout waits up to `timeout` seconds for a
+    connection once `max_size` are in use, then raises
+    sqlite3.OperationalError.
+    """
+
+    def __init__(self, db_path: str, max_size: int = DEFAULT_POOL_SIZE, timeout: float = 30.0):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Called with every statement run on a checked-out connection (see traced_statements)
+        self.trace: Optional[Callable[[str], None]] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False,
+                               cached_statements=256)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.max_size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(
+                f"connection pool exhausted: all {self.max_size} connections to {self.db_path} "
+                f"stayed in use for {self.timeout}s (raise max_size with get_pool or MARKETPLACE_DB_POOL_SIZE)"
+            ) from None
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn = self._acquire()
+        conn.set_trace_callback(self.trace)
+        self._local.conn, self._local.depth = conn, 1
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            conn.row_factory = None
+            self._idle.put(conn)
+
+    def close(self) -> None:
+        """Checkpoint the WAL into the main database file and close idle connections"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            except sqlite3.Error:
+                pass
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+def _add_column(cursor: sqlite3.Cursor, table: str, column: str, definition: str) -> None:
+    """Add a column to a table unless it already has it"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def _chunks(items: List[Any], size: int = 500) -> Iterator[List[Any]]:
+    """Split a list into chunks small enough for an IN (...) parameter list"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _refresh_plan_rollups(cursor: sqlite3.Cursor, plan_ids: Optional[List[str]] = None) -> None:
+    """Recompute plan_rollups for the given plans (all plans when None)"""
+    if plan_ids is None:
+        cursor.execute(PLAN_ROLLUP_SQL)
+        return
+    for chunk in _chunks(plan_ids):
+        cursor.execute(f"{PLAN_ROLLUP_SQL} WHERE p.plan_id IN ({','.join('?' * len(chunk))})", chunk)
+
+
+def _apply_benefit_coverage_delta(cursor: sqlite3.Cursor, delta: Dict[str, List[int]]) -> None:
+    """Add per-benefit [plan_count, covered_count] changes to benefit_coverage"""
+    changes = [(name, counts[0], counts[1]) for name, counts in delta.items()
+               if name is not None and (counts[0] or counts[1])]
+    if not changes:
+        return
+    cursor.executemany('''
+        INSERT INTO benefit_coverage (name, plan_count, covered_count) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET
+            plan_count = plan_count + excluded.plan_count,
+            covered_count = covered_count + excluded.covered_count
+    ''', changes)
+    cursor.execute('DELETE FROM benefit_coverage WHERE plan_count <= 0')
+
+
+def _record_history(cursor: sqlite3.Cursor, run_id: int, plan_ids: List[str]) -> None:
+    """
+    Append the HISTORY_TABLES rows of the given plans that changed since their latest recorded values.
+
+    Recorded rows that are no longer in the source table (a deleted plan, or a
+    cost sharing a plan dropped) get a removal row.
+    """
+    for history, (source, keys, values) in HISTORY_TABLES.items():
+        columns = ('plan_id',) + keys + values
+        width = 1 + len(keys)
+        changes = []
+        for chunk in _chunks(plan_ids):
+            placeholders = ','.join('?' * len(chunk))
+            # Latest recorded values per (plan_id, *keys); None once removed
+            latest = {}
+            cursor.execute(
+                f"SELECT id, run_id, {', '.join(columns)}, removed FROM {history} "
+                f"WHERE plan_id IN ({placeholders})", chunk
+            )
+            for row in cursor.fetchall():
+                key = row[2:2 + width]
+                if key not in latest or row[:2] > latest[key][0]:
+                    latest[key] = (row[:2], None if row[-1] else row[2 + width:2 + len(columns)])
+
+            seen = set()
+            cursor.execute(f"SELECT {', '.join(columns)} FROM {source} WHERE plan_id IN ({placeholders})", chunk)
+            for row in cursor.fetchall():
+                key = row[:width]
+                seen.add(key)
+                if key not in latest or latest[key][1] != row[width:]:
+                    changes.append((run_id,) + row + (0,))
+            changes.extend((run_id,) + key + (None,) * len(values) + (1,)
+                           for key, (_, recorded) in latest.items() if recorded is not None and key not in seen)
+
+        names = ('run_id',) + columns + ('removed',)
+        cursor.executemany(
+            f"INSERT INTO {history} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})", changes
+        )
+
+
+def _record_removals(cursor: sqlite3.Cursor, run_id: int, plan_ids: List[str]) -> None:
+    """Append a removal row to the HISTORY_TABLES for every latest recorded value of the given plans"""
+    for history, (_, keys, _) in HISTORY_TABLES.items():
+        columns = ', '.join(('plan_id',) + keys)
+        for chunk in _chunks(plan_ids):
+            cursor.execute(f'''
+                INSERT INTO {history} (run_id, {columns}, removed)
+                SELECT ?, {columns}, 1 FROM (
+                    SELECT *, ROW_NUMBER() OVER (PARTITION BY {columns} ORDER BY run_id DESC, id DESC) AS rank
+                    FROM {history} WHERE plan_id IN ({','.join('?' * len(chunk))})
+                ) WHERE rank = 1 AND removed = 0
+            ''', [run_id] + chunk)
+
+
+def _unrecorded(cursor: sqlite3.Cursor, plan_ids: List[str]) -> List[str]:
+    """The given plans that have no plan_history yet, or whose latest entry is a removal"""
+    current = set()
+    for chunk in _chunks(plan_ids):
+        # SQLite takes the bare column from the row holding MAX(id), the plan's latest entry
+        cursor.execute(
+            f"SELECT plan_id, removed, MAX(id) FROM plan_history WHERE plan_id IN ({','.join('?' * len(chunk))}) "
+            f"GROUP BY plan_id", chunk
+        )
+        current.update(plan_id for plan_id, removed, _ in cursor.fetchall() if not removed)
+    return [plan_id for plan_id in plan_ids if plan_id not in current]
+
+
+def _record_baseline(cursor: sqlite3.Cursor) -> None:
+    """Start the history with the plans already stored, as a finished 'baseline' run"""
+    cursor.execute('SELECT plan_id FROM plans')
+    plan_ids = [row[0] for row in cursor.fetchall()]
+    if not plan_ids:
+        return
+    cursor.execute(
+        "INSERT INTO collection_runs (source, finished_at, unchanged) VALUES ('baseline', CURRENT_TIMESTAMP, ?)",
+        (len(plan_ids),)
+    )
+    _record_history(cursor, cursor.lastrowid, plan_ids)
+
+
+def _refresh_metal_premium_stats(cursor: sqlite3.Cursor, metal_levels: Optional[Iterable[Any]] = None) -> None:
+    """
+    Recompute metal_premium_stats for the given metal levels (all when None).
+
+    Counts come from idx_plans_metal_premium and each quartile is read with an
+    ordered OFFSET walk of the same index, so no premiums are loaded into Python.
+    """
+    if metal_levels is None:
+        cursor.execute('DELETE FROM metal_premium_stats')
+        cursor.execute('SELECT DISTINCT metal_level FROM plans')
+        metal_levels = [row[0] for row in cursor.fetchall()]
+
+    for metal_level in set(metal_levels):
+        cursor.execute('DELETE FROM metal_premium_stats WHERE metal_level IS ?', (metal_level,))
+        cursor.execute(
+            'SELECT COUNT(*), COUNT(premium), AVG(premium), MIN(premium), MAX(premium) '
+            'FROM plans WHERE metal_level IS ?', (metal_level,)
+        )
+        plan_count, priced, mean, low, high = cursor.fetchone()
+        if not plan_count:
+            continue
+
+        quartiles = []
+        for fraction in (0.25, 0.5, 0.75):
+            if not priced:
+                quartiles.append(None)
+                continue
+            # Linear interpolation between the two closest ranks, like pandas' quantile()
+            position = (priced - 1) * fraction
+            offset = int(position)
+            cursor.execute(
+                'SELECT premium FROM plans WHERE metal_level IS ? AND premium IS NOT NULL '
+                'ORDER BY premium LIMIT 2 OFFSET ?', (metal_level, offset)
+            )
+            values = [row[0] for row in cursor.fetchall()]
+            upper = values[1] if len(values) > 1 else values[0]
+            quartiles.append(values[0] + (upper - values[0]) * (position - offset))
+
+        cursor.execute('''
+            INSERT INTO metal_premium_stats (
+                metal_level, plan_count, premium_min, premium_q1, premium_median,
+                premium_q3, premium_max, premium_mean
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (metal_level, plan_count, low, *quartiles, high, mean))
+
+
+class PlanCache:
+    """Thread-safe LRU of decoded plans, keyed by (plan_id, updated_at, content_hash)"""
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.sql = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key[0])
+            if entry is None or entry[0] != key:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key[0])
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: tuple, plan: Dict[str, Any]) -> None:
+        with self._lock:
+            # One entry per plan_id, so a newer version replaces the stale one
+            self._entries[key[0]] = (key, plan)
+            self._entries.move_to_end(key[0])
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, plan_id: str) -> None:
+        with self._lock:
+            self._entries.pop(plan_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.sql = None
+
+
+def _normalize_table(cursor: sqlite3.Cursor, table: str, storage: str, lookups: Dict[str, str]) -> None:
+    """Move a table's rows into its normalized storage and replace it with a view."""
+    columns = cursor.execute(f'PRAGMA table_info({table})').fetchall()
+    indexes = [row[1] for row in cursor.execute(f'PRAGMA index_list({table})').fetchall() if row[3] == 'c']
+    indexes = {name: [row[2] for row in cursor.execute(f'PRAGMA index_info({name})').fetchall()]
+               for name in indexes}
+    names = [column[1] for column in columns]
+    stored = [f'{name}_id' if name in lookups else name for name in names]
+
+    definitions = []
+    for _, name, declared, notnull, default, _ in columns:
+        if name == 'id':
+            definitions.append('id INTEGER PRIMARY KEY AUTOINCREMENT')
+        elif name in lookups:
+            definitions.append(f'{name}_id INTEGER REFERENCES {lookups[name]}(id)')
+        else:
+            definitions.append(f"{name} {declared}{' NOT NULL' if notnull else ''}"
+                               f"{f' DEFAULT {default}' if default is not None else ''}")
+    if 'plan_id' in names:
+        definitions.append('FOREIGN KEY (plan_id) REFERENCES plans(plan_id) ON DELETE CASCADE')
+    for lookup in set(lookups.values()):
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {lookup} (id INTEGER PRIMARY KEY, value TEXT UNIQUE NOT NULL)')
+    cursor.execute(f"CREATE TABLE {storage} ({', '.join(definitions)})")
+
+    # Copy the rows with their ids, keeping the AUTOINCREMENT high-water mark
+    joins = ''.join(f' LEFT JOIN {lookup} l_{name} ON l_{name}.value = t.{name}' for name, lookup in lookups.items())
+    for name, lookup in lookups.items():
+        cursor.execute(f'INSERT OR IGNORE INTO {lookup} (value) '
+                       f'SELECT DISTINCT {name} FROM {table} WHERE {name} IS NOT NULL')
+    selected = [f'l_{name}.id' if name in lookups else f't.{name}' for name in names]
+    cursor.execute(f"INSERT INTO {storage} ({', '.join(stored)}) "
+                   f"SELECT {', '.join(selected)} FROM {table} t{joins} ORDER BY t.id")
+    sequence = cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+    if sequence:
+        cursor.execute('DELETE FROM sqlite_sequence WHERE name = ?', (storage,))
+        cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (storage, sequence[0]))
+    cursor.execute(f'DROP TABLE {table}')
+
+    # Indexed strings are joined so a filter on their value can search the lookup and
+    # then the index; the rest are scalar subqueries, only run when the column is read
+    indexed = {column for index_columns in indexes.values() for column in index_columns}
+    view_columns = []
+    for name in names:
+        if name not in lookups:
+            view_columns.append(f'r.{name} AS {name}')
+        elif name in indexed:
+            view_columns.append(f'l_{name}.value AS {name}')
+        else:
+            view_columns.append(f'(SELECT value FROM {lookups[name]} WHERE id = r.{name}_id) AS {name}')
+    view_joins = ''.join(f' LEFT JOIN {lookup} l_{name} ON l_{name}.id = r.{name}_id'
+                         for name, lookup in lookups.items() if name in indexed)
+    cursor.execute(f"CREATE VIEW {table} AS SELECT {', '.join(view_columns)} FROM {storage} r{view_joins}")
+
+    # Writes through the view: add unseen strings to the lookups, then store their ids
+    defaults = {name: default for _, name, _, _, default, _ in columns}
+    add_lookups = ''.join(f'INSERT OR IGNORE INTO {lookup} (value) SELECT NEW.{name} WHERE NEW.{name} IS NOT NULL; '
+                          for name, lookup in lookups.items())
+    values = []
+    for name in names:
+        if name in lookups:
+            values.append(f'(SELECT id FROM {lookups[name]} WHERE value = NEW.{name})')
+        elif defaults[name] is not None:
+            values.append(f'COALESCE(NEW.{name}, {defaults[name]})')
+        else:
+            values.append(f'NEW.{name}')
+    assignments = ', '.join(f'{column} = {value}' for column, value in zip(stored, values))
+    cursor.execute(f"CREATE TRIGGER {table}_insert INSTEAD OF INSERT ON {table} BEGIN {add_lookups}"
+                   f"INSERT INTO {storage} ({', '.join(stored)}) VALUES ({', '.join(values)}); END")
+    cursor.execute(f"CREATE TRIGGER {table}_update INSTEAD OF UPDATE ON {table} BEGIN {add_lookups}"
+                   f"UPDATE {storage} SET {assignments} WHERE id = OLD.id; END")
+    cursor.execute(f"CREATE TRIGGER {table}_delete INSTEAD OF DELETE ON {table} BEGIN "
+                   f"DELETE FROM {storage} WHERE id = OLD.id; END")
+
+    for name, index_columns in indexes.items():
+        index_name = name.replace(table, storage, 1) if table in name else f'{name}_{storage}'
+        index_columns = [f'{column}_id' if column in lookups else column for column in index_columns]
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {storage} ({', '.join(index_columns)})")
+
+
+def is_normalized(conn: sqlite3.Connection) -> bool:
+    """Whether the database uses the normalized layout (see NORMALIZED_TABLES)"""
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = ?",
+                        (next(iter(NORMALIZED_TABLES)),)).fetchone() is not None
+
+
+def data_tables(conn: sqlite3.Connection) -> List[str]:
+    """
+    Names of the tables holding data, in creation order, for exports and browsing.
+
+    In the normalized layout the compatibility views are listed instead of
+    their storage and lookup tables.
+    """
+    internal = set(LOOKUP_TABLES) | {storage for storage, _ in NORMALIZED_TABLES.values()}
+    rows = conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')").fetchall()
+    return [name for (name,) in rows if name not in internal]
+
+
+def statement_shape(sql: str) -> str:
+    """A traced statement with its literals replaced by placeholders and value lists cut to two"""
+    return PLACEHOLDER_LIST.sub('?, ?', ' '.join(SQL_LITERAL.sub('?', sql).split()))
+
+
+def traced_statements(normalized: bool = False, plans_file: str = SAMPLE_PLANS_FILE) -> List[str]:
+    """
+    Filtered statements the database code actually issues, for check_query_plans.
+
+    The sample plans are saved twice (the second time with changed premiums)
+    in complete history runs with an incremental CSV export after each, then read,
+    searched, queried as of a run and deleted, on a scratch database whose
+    pooled connections trace every statement. Each distinct statement_shape
+    is returned once.
+    """
+    from export import export_csv
+    from history import PlanHistory
+    from plan_search import PlanSearch
+
+    with open(plans_file) as f:
+        plans = [entry['plan'] for entry in json.load(f)['all_plans']]
+    shapes = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'trace.db')
+        db = MarketplaceDB(db_path, normalized=normalized)
+        pool = get_pool(db_path)
+        pool.trace = lambda sql: shapes.setdefault(statement_shape(sql), None)
+        try:
+            for premium_change in (0, 1):
+                run_id = db.start_run('trace')
+                summary = db.save_plans([dict(plan, premium=(plan.get('premium') or 0) + premium_change)
+                                         for plan in plans], run_id=run_id)
+                db.finish_run(run_id, summary, complete=True)
+                with redirect_stdout(io.StringIO()):
+                    export_csv(db_path, os.path.join(tmp, 'csv'), incremental=True)
+
+            plan_id = plans[0]['id']
+            db.get_plan(plan_id)
+            db.get_plans([plan_id])
+            list(db.iter_plan_chunks(chunk_size=2))
+
+            history = PlanHistory(db_path)
+            history.premium_trend(plan_id)
+            history.plan_as_of(plan_id, run_id)
+            history.premiums_as_of(datetime.utcnow().date())
+
+            search = PlanSearch(db_path)
+            for sort in ('premium', 'deductible', 'moop'):
+                _, cursor = search.search(sort, limit=2)
+                if cursor is not None:
+                    search.search(sort, limit=2, after=cursor)
+            search.search(metal_level='Silver', covers=['Specialist Visit'], copay_max={'Specialist Visit': 100})
+            search.search('estimated_cost', profile={'primary_care': 2}, limit=2, metal_level='Silver')
+
+            db.delete_plan(plan_id)
+        finally:
+            pool.trace = None
+            db.close()
+    return [shape for shape in shapes if CHECKED_STATEMENT.match(shape) or TEMP_TABLE.match(shape)]
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_plan_caches: Dict[str, PlanCache] = {}
+_schema_ready = set()
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path: str, max_size: Optional[int] = None) -> ConnectionPool:
+    """
+    Return the process-wide connection pool for a database file.
+
+    Args:
+        db_path: Path to the SQLite database file
+        max_size: Most connections the pool opens (default DEFAULT_POOL_SIZE);
+            given for an existing pool, it replaces that pool's limit
+    """
+    key = os.path.abspath(db_path)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(db_path, max_size or DEFAULT_POOL_SIZE)
+        elif max_size:
+            _pools[key].max_size = max_size
+        return _pools[key]
+
+
+def db_version(db_path: str) -> str:
+    """
+    Changes whenever plans are saved, updated or deleted, or the schema is migrated.
+
+    Built from the change_counter sequence, which the plans triggers bump on
+    every insert, update and delete, and PRAGMA user_version; both are
+    single-row reads. The database must be migrated (open it with
+    MarketplaceDB first).
+    """
+    with closing(sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)) as conn:
+        user_version = conn.execute('PRAGMA user_version').fetchone()[0]
+        seq = conn.execute('SELECT seq FROM change_counter').fetchone()[0]
+    return f"{user_version}:{seq}"
+
+
+def get_plan_cache(db_path: str) -> PlanCache:
+    """Return the process-wide get_plan cache for a database file"""
+    key = os.path.abspath(db_path)
+    with _pools_lock:
+        if key not in _plan_caches:
+            _plan_caches[key] = PlanCache()
+        return _plan_caches[key]
+
 
 class MarketplaceDB:
-    def __init__(self, db_path: str = 'marketplace.db'):
+    def __init__(self, db_path: str = 'marketplace.db', normalized: bool = False):
+        """
+        Args:
+            db_path: Path to the SQLite database file
+            normalized: Convert the database to the normalized layout (see
+                NORMALIZED_TABLES) if it is not already; the layout is kept
+                for later opens either way
+        """
         self.db_path = db_path
+        self.normalized = normalized
+        self._pool = get_pool(db_path)
+        self._plan_cache = get_plan_cache(db_path)
         self._init_db()
 
     def _get_connection(self):
-        return sqlite3.connect(self.db_path)
+        return self._pool.connection()
+
+    def close(self) -> None:
+        """Checkpoint and close pooled connections, e.g. before committing the database file"""
+        self._pool.close()
 
     def _init_db(self):
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Enable foreign key constraints
-            cursor.execute('PRAGMA foreign_keys = ON')
-            
-            self._create_tables()
-            
-            conn.commit()
+        # The schema DDL only needs to run once per database file per process
+        key = os.path.abspath(self.db_path)
+        with _pools_lock:
+            if key in _schema_ready and os.path.exists(self.db_path) and not self.normalized:
+                return
+        self._create_tables()
+        # A fresh or migrated schema invalidates the cached plans and plan query
+        self._plan_cache.clear()
+        with _pools_lock:
+            _schema_ready.add(key)
 
     def _create_tables(self):
         """Create database tables if they don't exist"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
             
-            # Enable foreign key constraints
-            cursor.execute('PRAGMA foreign_keys = ON')
-            
             # Create plans table with updated schema
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS plans (
@@ -131,274 +922,761 @@ class MarketplaceDB:
                 )
             ''')
 
+            self._migrate(cursor)
+
+            vacuum = False
+            if self.normalized and not is_normalized(conn):
+                vacuum = cursor.execute('SELECT EXISTS (SELECT 1 FROM cost_sharings)').fetchone()[0]
+                for table, (storage, lookups) in NORMALIZED_TABLES.items():
+                    _normalize_table(cursor, table, storage, lookups)
+
             conn.commit()
+            # Converting existing rows leaves the old pages free; give them back
+            if vacuum:
+                conn.execute('VACUUM')
+
+    def _migrate(self, cursor: sqlite3.Cursor):
+        """Apply any schema migrations the database has not seen yet"""
+        cursor.execute('PRAGMA user_version')
+        version = cursor.fetchone()[0]
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                # Data backfills are Python callables taking the cursor
+                if callable(statement):
+                    statement(cursor)
+                else:
+                    cursor.execute(statement)
+            cursor.execute(f'PRAGMA user_version = {number}')
+
+    def check_query_plans(self, queries: Optional[List[str]] = None) -> List[Dict[str, str]]:
+        """
+        Run EXPLAIN QUERY PLAN on the filtered statements the code issues.
+
+        Args:
+            queries: Statements to check (with `?` placeholders); by default
+                the ones recorded by traced_statements for this database's
+                layout. CREATE TEMP TABLE statements among them are run, so
+                the statements after them can use those tables.
+
+        Returns:
+            The queries whose plan contains a full table scan, with the
+            offending plan step; an empty list means every query uses an index
+        """
+        offenders = []
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            if queries is None:
+                queries = traced_statements(normalized=is_normalized(conn))
+            # Writes through a normalized view scan only the rows the view's search matched
+            views = {f'SCAN {name}' for (name,) in cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'view'").fetchall()}
+            allowed = views | {f'SCAN {table}' for table in SMALL_TABLES}
+            for query in queries:
+                if TEMP_TABLE.match(query):
+                    cursor.execute(query)
+                    continue
+                cursor.execute(f'EXPLAIN QUERY PLAN {query}', [None] * query.count('?'))
+                for row in cursor.fetchall():
+                    detail = row[-1]
+                    # SCAN (subquery-N) reads an already filtered subquery result, not a table
+                    if (detail.startswith('SCAN') and 'USING' not in detail and detail not in allowed
+                            and not detail.startswith('SCAN (')):
+                        offenders.append({'query': query, 'plan': detail})
+        return offenders
 
-    def save_plan_data(self, plan_data: Dict[str, Any]):
+    def save_plan_data(self, plan_data: Dict[str, Any]) -> Dict[str, int]:
         """Save or update a single plan's data in the database"""
+        return self.save_plans([plan_data])
+
+    @staticmethod
+    def _plan_rows(plan_data: Dict[str, Any]) -> Dict[str, List[tuple]]:
+        """Flatten one plan into the row tuples stored in each table"""
+        plan_id = plan_data['id']
+        rows = {
+            'plans': [(
+                plan_id,
+                plan_data.get('name'),
+                plan_data.get('premium'),
+                plan_data.get('metal_level'),
+                plan_data.get('type'),
+                plan_data.get('state'),
+                plan_data.get('product_division'),
+                plan_data.get('insurance_market'),
+                int(plan_data.get('hsa_eligible', False)) if 'hsa_eligible' in plan_data else None,
+                int(plan_data.get('has_national_network', False)) if 'has_national_network' in plan_data else None,
+                plan_data.get('max_age_child')
+            )],
+            'issuers': [],
+            'benefits': [],
+            'cost_sharings': [],
+            'deductibles': [],
+            'moops': [],
+        }
+
+        if 'issuer' in plan_data and plan_data['issuer']:
+            issuer = plan_data['issuer']
+            rows['issuers'].append((
+                plan_id,
+                issuer.get('id'),
+                issuer.get('name'),
+                issuer.get('state'),
+                issuer.get('toll_free')
+            ))
+
+        for benefit in plan_data.get('benefits', []):
+            rows['benefits'].append((
+                plan_id,
+                benefit.get('name'),
+                int(benefit.get('covered', False)) if 'covered' in benefit else None,
+                int(benefit.get('has_limits', False)) if 'has_limits' in benefit else None,
+                benefit.get('limit_unit'),
+                benefit.get('limit_quantity')
+            ))
+            for sharing in benefit.get('cost_sharings', []):
+                rows['cost_sharings'].append((
+                    plan_id,
+                    benefit.get('name'),
+                    sharing.get('network_tier'),
+                    sharing.get('copay_amount'),
+                    sharing.get('coinsurance_rate'),
+                    sharing.get('display_string'),
+                    sharing.get('csr')
+                ))
+
+        for deductible in plan_data.get('deductibles', []):
+            rows['deductibles'].append((
+                plan_id,
+                deductible.get('type'),
+                deductible.get('amount'),
+                deductible.get('network_tier'),
+                deductible.get('family_cost')
+            ))
+
+        for moop in plan_data.get('moops', []):
+            rows['moops'].append((
+                plan_id,
+                moop.get('type'),
+                moop.get('amount'),
+                moop.get('network_tier'),
+                moop.get('family_cost')
+            ))
+
+        return rows
+
+    @staticmethod
+    def _content_hash(rows: Dict[str, List[tuple]]) -> str:
+        """Hash of everything stored for a plan, used to skip unchanged plans"""
+        return hashlib.sha256(json.dumps(rows, sort_keys=True, default=str).encode()).hexdigest()
+
+    def start_run(self, source: Optional[str] = None) -> int:
+        """
+        Open a collection run; saves made with its id are recorded in the history tables.
+
+        Args:
+            source: What produced the run, e.g. 'collect' or 'sweep'
+
+        Returns:
+            The run id to pass to `save_plans` and `finish_run`
+        """
+        with self._get_connection() as conn:
+            cursor = conn.execute('INSERT INTO collection_runs (source) VALUES (?)', (source,))
+            conn.commit()
+            return cursor.lastrowid
+
+    def finish_run(self, run_id: int, summary: Optional[Dict[str, int]] = None, complete: bool = False) -> int:
+        """
+        Mark a run finished, with the plan counts `save_plans` returned for it.
+
+        Args:
+            run_id: The run from `start_run`
+            summary: Counts of plans 'inserted', 'updated' and 'unchanged'
+            complete: The run returned every current plan of the states it
+                returned plans for (e.g. a full dump per state). Stored plans
+                of those states it did not return get a removal row in the
+                history tables. Leave False for runs that only cover some
+                searches, like a sweep over a few ZIP codes.
+
+        Returns:
+            Number of plans recorded as removed
+        """
+        summary = summary or {}
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            
-            # Check if plan exists
-            cursor.execute('SELECT 1 FROM plans WHERE plan_id = ?', (plan_data['id'],))
-            plan_exists = cursor.fetchone() is not None
-            
-            if plan_exists:
-                # Update existing plan
+            missing = []
+            if complete:
                 cursor.execute('''
-                    UPDATE plans SET
-                        name = COALESCE(?, name),
-                        premium = COALESCE(?, premium),
-                        metal_level = COALESCE(?, metal_level),
-                        type = COALESCE(?, type),
-                        state = COALESCE(?, state),
-                        product_division = COALESCE(?, product_division),
-                        insurance_market = COALESCE(?, insurance_market),
-                        hsa_eligible = COALESCE(?, hsa_eligible),
-                        has_national_network = COALESCE(?, has_national_network),
-                        max_age_child = COALESCE(?, max_age_child),
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE plan_id = ?
-                ''', (
-                    plan_data.get('name'),
-                    plan_data.get('premium'),
-                    plan_data.get('metal_level'),
-                    plan_data.get('type'),
-                    plan_data.get('state'),
-                    plan_data.get('product_division'),
-                    plan_data.get('insurance_market'),
-                    int(plan_data.get('hsa_eligible', False)) if 'hsa_eligible' in plan_data else None,
-                    int(plan_data.get('has_national_network', False)) if 'has_national_network' in plan_data else None,
-                    plan_data.get('max_age_child'),
-                    plan_data['id']
-                ))
-                
-                # Delete existing related data to avoid duplicates
-                cursor.execute('DELETE FROM moops WHERE plan_id = ?', (plan_data['id'],))
-                cursor.execute('DELETE FROM deductibles WHERE plan_id = ?', (plan_data['id'],))
-                cursor.execute('DELETE FROM cost_sharings WHERE plan_id = ?', (plan_data['id'],))
-                cursor.execute('DELETE FROM benefits WHERE plan_id = ?', (plan_data['id'],))
-                cursor.execute('DELETE FROM issuers WHERE plan_id = ?', (plan_data['id'],))
-            else:
-                # Insert new plan
+                    SELECT plan_id FROM plans
+                    WHERE state IN (SELECT p.state FROM run_plans r JOIN plans p ON p.plan_id = r.plan_id
+                                    WHERE r.run_id = ?)
+                    AND plan_id NOT IN (SELECT plan_id FROM run_plans WHERE run_id = ?)
+                ''', (run_id, run_id))
+                candidates = [row[0] for row in cursor.fetchall()]
+                # Plans without history, or already removed, have nothing to remove
+                unrecorded = set(_unrecorded(cursor, candidates))
+                missing = [plan_id for plan_id in candidates if plan_id not in unrecorded]
+                _record_removals(cursor, run_id, missing)
+            cursor.execute('DELETE FROM run_plans WHERE run_id = ?', (run_id,))
+            cursor.execute('''
+                UPDATE collection_runs SET finished_at = CURRENT_TIMESTAMP,
+                    inserted = ?, updated = ?, unchanged = ?
+                WHERE id = ?
+            ''', (summary.get('inserted'), summary.get('updated'), summary.get('unchanged'), run_id))
+            conn.commit()
+        return len(missing)
+
+    def save_plans(self, plans: Iterable[Dict[str, Any]], batch_size: int = 1000,
+                   run_id: Optional[int] = None) -> Dict[str, int]:
+        """
+        Save or update many plans in bulk.
+
+        Rows are collected per table and written with `executemany`, one
+        transaction per batch of `batch_size` plans, over a single connection.
+        Each plan's content hash is stored in `plans.content_hash`: unchanged
+        plans are skipped completely, new plans are inserted, and changed
+        plans are upserted with `INSERT ... ON CONFLICT DO UPDATE` and only the
+        related rows that differ are deleted or inserted.
+
+        The summary tables (plan_rollups, benefit_coverage and
+        metal_premium_stats) are refreshed in the same transaction, only for
+        the plans, benefits and metal levels the batch changed.
+
+        With a `run_id` from `start_run`, the premiums, deductibles, MOOPs and
+        cost sharings of the changed plans (and of plans not yet in the
+        history) are appended to the HISTORY_TABLES where they differ from
+        their latest recorded values, in the same transaction.
+
+        Returns:
+            Counts of plans 'inserted', 'updated' and 'unchanged'
+        """
+        summary = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        with self._get_connection() as conn:
+            batch = {}
+            for plan_data in plans:
+                # A plan repeated within a batch keeps only its last version
+                batch[plan_data['id']] = plan_data
+                if len(batch) >= batch_size:
+                    self._add_counts(summary, self._write_plan_batch(conn, batch.values(), run_id))
+                    batch = {}
+            if batch:
+                self._add_counts(summary, self._write_plan_batch(conn, batch.values(), run_id))
+        return summary
+
+    @staticmethod
+    def _add_counts(total: Dict[str, int], counts: Dict[str, int]) -> None:
+        for key, value in counts.items():
+            total[key] = total.get(key, 0) + value
+
+    def _write_plan_batch(self, conn: sqlite3.Connection, plans: Iterable[Dict[str, Any]],
+                          run_id: Optional[int] = None) -> Dict[str, int]:
+        """Write one batch of plans in a single transaction"""
+        plan_rows = {}
+        hashes = {}
+        for plan_data in plans:
+            rows = self._plan_rows(plan_data)
+            plan_rows[plan_data['id']] = rows
+            hashes[plan_data['id']] = self._content_hash(rows)
+        plan_ids = list(plan_rows)
+
+        cursor = conn.cursor()
+        try:
+            existing = {}
+            old_metals = {}
+            for chunk in _chunks(plan_ids):
+                cursor.execute(
+                    f"SELECT plan_id, content_hash, metal_level FROM plans "
+                    f"WHERE plan_id IN ({','.join('?' * len(chunk))})",
+                    chunk
+                )
+                for plan_id, content_hash, metal_level in cursor.fetchall():
+                    existing[plan_id] = content_hash
+                    old_metals[plan_id] = metal_level
+
+            inserted = [plan_id for plan_id in plan_ids if plan_id not in existing]
+            updated = [plan_id for plan_id in plan_ids
+                       if plan_id in existing and existing[plan_id] != hashes[plan_id]]
+            unchanged = len(plan_ids) - len(inserted) - len(updated)
+
+            cursor.executemany(
+                f"INSERT INTO plans ({', '.join(PLAN_ROW_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(PLAN_ROW_COLUMNS))}) {PLAN_UPSERT}",
+                [plan_rows[plan_id]['plans'][0] + (hashes[plan_id],) for plan_id in inserted + updated]
+            )
+
+            # Benefit name -> [plan_count, covered_count] change for benefit_coverage
+            coverage_delta = {}
+            for table, columns in CHILD_COLUMNS.items():
+                new_rows = [row for plan_id in inserted for row in plan_rows[plan_id][table]]
+
+                # Changed plans: only delete/insert the related rows that differ
+                if updated:
+                    stale_ids = []
+                    wanted = Counter(row for plan_id in updated for row in plan_rows[plan_id][table])
+                    for chunk in _chunks(updated):
+                        cursor.execute(
+                            f"SELECT id, {', '.join(columns)} FROM {table} "
+                            f"WHERE plan_id IN ({','.join('?' * len(chunk))})",
+                            chunk
+                        )
+                        for row in cursor.fetchall():
+                            if wanted[row[1:]] > 0:
+                                wanted[row[1:]] -= 1
+                            else:
+                                stale_ids.append((row[0],))
+                                if table == 'benefits':
+                                    counts = coverage_delta.setdefault(row[2], [0, 0])
+                                    counts[0] -= 1
+                                    counts[1] -= row[3] or 0
+                    cursor.executemany(f'DELETE FROM {table} WHERE id = ?', stale_ids)
+                    new_rows.extend(wanted.elements())
+
+                if table == 'benefits':
+                    for row in new_rows:
+                        counts = coverage_delta.setdefault(row[1], [0, 0])
+                        counts[0] += 1
+                        counts[1] += row[2] or 0
+
+                cursor.executemany(
+                    f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                    new_rows
+                )
+
+            changed = inserted + updated
+            if changed:
+                _refresh_plan_rollups(cursor, changed)
+                _apply_benefit_coverage_delta(cursor, coverage_delta)
+                _refresh_metal_premium_stats(
+                    cursor,
+                    [old_metals[plan_id] for plan_id in updated] +
+                    [plan_rows[plan_id]['plans'][0][3] for plan_id in changed]
+                )
+            if run_id is not None:
+                # Unchanged plans only need recording if no run has seen them yet, or they were removed
+                unchanged_ids = [plan_id for plan_id in plan_ids if existing.get(plan_id) == hashes[plan_id]]
+                _record_history(cursor, run_id, changed + _unrecorded(cursor, unchanged_ids))
+                cursor.executemany('INSERT OR IGNORE INTO run_plans (run_id, plan_id) VALUES (?, ?)',
+                                   [(run_id, plan_id) for plan_id in plan_ids])
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        return {'inserted': len(inserted), 'updated': len(updated), 'unchanged': unchanged}
+
+    def merge_shard(self, shard_path: str, run_id: Optional[int] = None) -> Dict[str, int]:
+        """
+        Merge the plans of another database (a shard written by a parallel
+        ingest worker) into this one.
+
+        The shard is ATTACHed and its rows are copied with INSERT ... SELECT in
+        one transaction, so no plan is decoded in Python. Plans are matched on
+        plan_id and compared by content hash, like `save_plans`: unchanged
+        plans are skipped, new plans are inserted, and changed plans are
+        upserted with all of their related rows replaced. The summary tables
+        and, with a `run_id`, the history tables are updated for the merged
+        plans only. The shard's own summary and history tables are ignored.
+
+        Args:
+            shard_path: Database with the same schema, e.g. written by `save_plans`
+            run_id: Collection run (see `start_run`) to record the merged plans in
+
+        Returns:
+            Counts of plans 'inserted', 'updated' and 'unchanged'
+        """
+        changed_ids = "SELECT plan_id FROM temp.merge_plans WHERE status != 'unchanged'"
+        with self._get_connection() as conn:
+            # ATTACH cannot run inside a transaction
+            if conn.in_transaction:
+                conn.commit()
+            conn.execute('ATTACH DATABASE ? AS shard', (shard_path,))
+            cursor = conn.cursor()
+            try:
+                cursor.execute('DROP TABLE IF EXISTS temp.merge_plans')
                 cursor.execute('''
-                    INSERT INTO plans (
-                        plan_id, name, premium, metal_level, type, state,
-                        product_division, insurance_market, hsa_eligible,
-                        has_national_network, max_age_child
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    plan_data['id'],
-                    plan_data.get('name'),
-                    plan_data.get('premium'),
-                    plan_data.get('metal_level'),
-                    plan_data.get('type'),
-                    plan_data.get('state'),
-                    plan_data.get('product_division'),
-                    plan_data.get('insurance_market'),
-                    int(plan_data.get('hsa_eligible', False)) if 'hsa_eligible' in plan_data else None,
-                    int(plan_data.get('has_national_network', False)) if 'has_national_network' in plan_data else None,
-                    plan_data.get('max_age_child')
-                ))
-            
-            # Save issuer
-            if 'issuer' in plan_data and plan_data['issuer']:
-                issuer = plan_data['issuer']
+                    CREATE TEMP TABLE merge_plans (
+                        plan_id TEXT PRIMARY KEY, status TEXT NOT NULL, old_metal TEXT, recorded INTEGER
+                    )
+                ''')
                 cursor.execute('''
-                    INSERT INTO issuers (plan_id, issuer_id, name, state, toll_free)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (
-                    plan_data['id'],
-                    issuer.get('id'),
-                    issuer.get('name'),
-                    issuer.get('state'),
-                    issuer.get('toll_free')
-                ))
+                    INSERT INTO temp.merge_plans (plan_id, status, old_metal)
+                    SELECT s.plan_id,
+                        CASE WHEN p.plan_id IS NULL THEN 'inserted'
+                             WHEN p.content_hash IS s.content_hash THEN 'unchanged'
+                             ELSE 'updated' END,
+                        p.metal_level
+                    FROM shard.plans s LEFT JOIN main.plans p ON p.plan_id = s.plan_id
+                ''')
+                summary = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+                summary.update(cursor.execute('SELECT status, COUNT(*) FROM temp.merge_plans GROUP BY status'))
 
-            # Save benefits and cost sharings
-            for benefit in plan_data.get('benefits', []):
+                # Changed plans lose their old related rows (and their share of benefit_coverage)
+                coverage_delta = {}
                 cursor.execute('''
-                    INSERT INTO benefits (
-                        plan_id, name, covered, has_limits, limit_unit, limit_quantity
-                    ) VALUES (?, ?, ?, ?, ?, ?)
-                ''', (
-                    plan_data['id'],
-                    benefit.get('name'),
-                    int(benefit.get('covered', False)) if 'covered' in benefit else None,
-                    int(benefit.get('has_limits', False)) if 'has_limits' in benefit else None,
-                    benefit.get('limit_unit'),
-                    benefit.get('limit_quantity')
-                ))
+                    SELECT name, COUNT(*), COALESCE(SUM(covered), 0) FROM main.benefits
+                    WHERE plan_id IN (SELECT plan_id FROM temp.merge_plans WHERE status = 'updated')
+                    GROUP BY name
+                ''')
+                for name, plan_count, covered_count in cursor.fetchall():
+                    coverage_delta[name] = [-plan_count, -covered_count]
+                for table in reversed(list(CHILD_COLUMNS)):
+                    cursor.execute(f'''
+                        DELETE FROM main.{table}
+                        WHERE plan_id IN (SELECT plan_id FROM temp.merge_plans WHERE status = 'updated')
+                    ''')
 
-                for sharing in benefit.get('cost_sharings', []):
+                columns = ', '.join(PLAN_ROW_COLUMNS)
+                cursor.execute(
+                    f"INSERT INTO main.plans ({columns}) SELECT {columns} FROM shard.plans "
+                    f"WHERE plan_id IN ({changed_ids}) ORDER BY id {PLAN_UPSERT}"
+                )
+                for table, table_columns in CHILD_COLUMNS.items():
+                    columns = ', '.join(table_columns)
+                    cursor.execute(
+                        f"INSERT INTO main.{table} ({columns}) SELECT {columns} FROM shard.{table} "
+                        f"WHERE plan_id IN ({changed_ids}) ORDER BY id"
+                    )
+
+                cursor.execute(f'''
+                    SELECT name, COUNT(*), COALESCE(SUM(covered), 0) FROM shard.benefits
+                    WHERE plan_id IN ({changed_ids}) GROUP BY name
+                ''')
+                for name, plan_count, covered_count in cursor.fetchall():
+                    counts = coverage_delta.setdefault(name, [0, 0])
+                    counts[0] += plan_count
+                    counts[1] += covered_count
+                _apply_benefit_coverage_delta(cursor, coverage_delta)
+                cursor.execute(f'{PLAN_ROLLUP_SQL} WHERE p.plan_id IN ({changed_ids})')
+                cursor.execute(f'''
+                    SELECT old_metal FROM temp.merge_plans WHERE status = 'updated'
+                    UNION SELECT metal_level FROM shard.plans WHERE plan_id IN ({changed_ids})
+                ''')
+                _refresh_metal_premium_stats(cursor, [row[0] for row in cursor.fetchall()])
+
+                if run_id is not None:
+                    # As in save_plans, unchanged plans only need recording if no run has seen
+                    # them yet, or they were removed
                     cursor.execute('''
-                        INSERT INTO cost_sharings (
-                            plan_id, benefit_name, network_tier, copay_amount,
-                            coinsurance_rate, display_string, csr
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        plan_data['id'],
-                        benefit.get('name'),
-                        sharing.get('network_tier'),
-                        sharing.get('copay_amount'),
-                        sharing.get('coinsurance_rate'),
-                        sharing.get('display_string'),
-                        sharing.get('csr')
-                    ))
-
-            # Save deductibles
-            for deductible in plan_data.get('deductibles', []):
-                cursor.execute('''
-                    INSERT INTO deductibles (
-                        plan_id, type, amount, network_tier, family_cost
-                    ) VALUES (?, ?, ?, ?, ?)
-                ''', (
-                    plan_data['id'],
-                    deductible.get('type'),
-                    deductible.get('amount'),
-                    deductible.get('network_tier'),
-                    deductible.get('family_cost')
-                ))
+                        UPDATE temp.merge_plans SET recorded = COALESCE((
+                            SELECT NOT h.removed FROM plan_history h WHERE h.plan_id = merge_plans.plan_id
+                            ORDER BY h.run_id DESC, h.id DESC LIMIT 1
+                        ), 0)
+                    ''')
+                    # Plans without any current history take their current rows as they are, in SQL
+                    fresh_ids = "SELECT plan_id FROM temp.merge_plans WHERE recorded = 0"
+                    for history, (source, keys, values) in HISTORY_TABLES.items():
+                        columns = ', '.join(('plan_id',) + keys + values)
+                        cursor.execute(
+                            f"INSERT INTO {history} (run_id, {columns}) SELECT ?, {columns} FROM main.{source} "
+                            f"WHERE plan_id IN ({fresh_ids})", (run_id,)
+                        )
+                    cursor.execute(f"{changed_ids} AND recorded = 1")
+                    _record_history(cursor, run_id, [row[0] for row in cursor.fetchall()])
+                    cursor.execute('INSERT OR IGNORE INTO run_plans (run_id, plan_id) '
+                                   'SELECT ?, plan_id FROM temp.merge_plans', (run_id,))
+                cursor.execute('DROP TABLE temp.merge_plans')
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+            finally:
+                conn.execute('DETACH DATABASE shard')
+        return summary
 
-            # Save MOOPs
-            for moop in plan_data.get('moops', []):
-                cursor.execute('''
-                    INSERT INTO moops (
-                        plan_id, type, amount, network_tier, family_cost
-                    ) VALUES (?, ?, ?, ?, ?)
-                ''', (
-                    plan_data['id'],
-                    moop.get('type'),
-                    moop.get('amount'),
-                    moop.get('network_tier'),
-                    moop.get('family_cost')
-                ))
+    def get_plan(self, plan_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Retrieve a single plan's data from the database
 
-            conn.commit()
+        The nested plan is built by SQLite in one query with `json_object` /
+        `json_group_array` (related rows in insertion order). Decoded plans
+        are kept in a process-wide LRU keyed by (plan_id, updated_at,
+        content_hash), so a repeat lookup costs one indexed probe.
 
-    def get_plan(self, plan_id: str) -> Dict[str, Any]:
-        """Retrieve a single plan's data from the database"""
+        The returned dict is shared with the cache: copy it before modifying it.
+        """
         with self._get_connection() as conn:
-            conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
-            
-            # Get plan details
-            cursor.execute('SELECT * FROM plans WHERE plan_id = ?', (plan_id,))
-            plan = dict(cursor.fetchone()) if cursor.fetchone() else None
-            
-            if not plan:
+            cursor.execute('SELECT updated_at, content_hash FROM plans WHERE plan_id = ?', (plan_id,))
+            version = cursor.fetchone()
+            if version is None:
+                self._plan_cache.discard(plan_id)
                 return None
-                
-            # Get related data
-            cursor.execute('SELECT * FROM issuers WHERE plan_id = ?', (plan_id,))
-            plan['issuer'] = dict(cursor.fetchone()) if cursor.fetchone() else {}
-            
-            cursor.execute('SELECT * FROM benefits WHERE plan_id = ?', (plan_id,))
-            plan['benefits'] = [dict(row) for row in cursor.fetchall()]
-            
-            cursor.execute('SELECT * FROM cost_sharings WHERE plan_id = ?', (plan_id,))
-            plan['cost_sharings'] = [dict(row) for row in cursor.fetchall()]
-            
-            cursor.execute('SELECT * FROM deductibles WHERE plan_id = ?', (plan_id,))
-            plan['deductibles'] = [dict(row) for row in cursor.fetchall()]
-            
-            cursor.execute('SELECT * FROM moops WHERE plan_id = ?', (plan_id,))
-            plan['moops'] = [dict(row) for row in cursor.fetchall()]
-            
-            return plan
+
+            key = (plan_id, *version)
+            cached = self._plan_cache.get(key)
+            if cached is not None:
+                return cached
+
+            cursor.execute(self._plan_json_sql(conn), (plan_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            updated_at, content_hash, plan_json = row
+
+        plan = json.loads(plan_json)
+        plan['issuer'] = plan['issuer'] or {}
+        self._plan_cache.put((plan_id, updated_at, content_hash), plan)
+        return plan
+
+    def _plan_json_sql(self, conn: sqlite3.Connection) -> str:
+        """Build (once per database) the query returning a plan as one JSON document"""
+        if self._plan_cache.sql is None:
+            def columns(table):
+                return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+            def json_row(table, alias):
+                return 'json_object(' + ', '.join(
+                    f"'{column}', {alias}.{column}" for column in columns(table)
+                ) + ')'
+
+            related = [f"'issuer', (SELECT json({json_row('issuers', 'c')}) FROM issuers c "
+                       f"WHERE c.plan_id = p.plan_id ORDER BY c.id LIMIT 1)"]
+            for table in ('benefits', 'cost_sharings', 'deductibles', 'moops'):
+                related.append(
+                    f"'{table}', (SELECT json_group_array(json(row_json)) FROM ("
+                    f"SELECT {json_row(table, 'c')} AS row_json FROM {table} c "
+                    f"WHERE c.plan_id = p.plan_id ORDER BY c.id))"
+                )
+            plan_fields = ', '.join(f"'{column}', p.{column}" for column in columns('plans'))
+            self._plan_cache.sql = (
+                f"SELECT p.updated_at, p.content_hash, json_object({plan_fields}, {', '.join(related)}) "
+                f"FROM plans p WHERE p.plan_id = ?"
+            )
+        return self._plan_cache.sql
 
     def get_all_plans(self) -> List[Dict[str, Any]]:
         """Retrieve all plans from the database"""
+        return self.get_plans()
+
+    def get_plans(self, plan_ids: Optional[Iterable[str]] = None, **filters) -> List[Dict[str, Any]]:
+        """
+        Retrieve all plans, or a filtered subset, with one query per table.
+
+        Args:
+            plan_ids: Only load these plans
+            **filters: Equality filters on `plans` columns, e.g. metal_level='Silver'
+
+        Returns:
+            Plans in the same nested shape as `get_plan`
+        """
+        plans = []
+        for chunk in self.iter_plan_chunks(chunk_size=None, plan_ids=plan_ids, **filters):
+            plans.extend(chunk)
+        return plans
+
+    def iter_plan_chunks(self, chunk_size: Optional[int] = 1000, plan_ids: Optional[Iterable[str]] = None,
+                         **filters) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Stream plans in chunks so memory stays flat on large databases.
+
+        Plans are paged by `plans.id` (keyset pagination); each chunk loads its
+        related rows with one query per table and groups them by plan_id in
+        memory. `chunk_size=None` loads everything as a single chunk.
+        """
+        for column in filters:
+            if column not in PLAN_COLUMNS:
+                raise ValueError(f"Unknown plans column: {column}")
+
+        with self._get_connection() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+
+            conditions = [f'{column} = ?' for column in filters]
+            params = list(filters.values())
+            if plan_ids is not None:
+                # Load the wanted IDs into a temp table instead of a huge IN (...) list
+                cursor.execute('CREATE TEMP TABLE IF NOT EXISTS plan_filter (plan_id TEXT PRIMARY KEY)')
+                cursor.execute('DELETE FROM temp.plan_filter')
+                cursor.executemany('INSERT OR IGNORE INTO temp.plan_filter VALUES (?)',
+                                   ((plan_id,) for plan_id in plan_ids))
+                conditions.append('plan_id IN (SELECT plan_id FROM temp.plan_filter)')
+
+            last_id = 0
+            while True:
+                where = ' AND '.join(['id > ?'] + conditions)
+                limit = ' LIMIT ?' if chunk_size else ''
+                cursor.execute(
+                    f'SELECT * FROM plans WHERE {where} ORDER BY id{limit}',
+                    [last_id] + params + ([chunk_size] if chunk_size else [])
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+
+                plans = {}
+                for row in rows:
+                    plan = dict(row)
+                    plan.update(issuer={}, benefits=[], cost_sharings=[], deductibles=[], moops=[])
+                    plans[plan['plan_id']] = plan
+                last_id = rows[-1]['id']
+
+                # Related rows for this chunk: one query per table
+                chunk_filter = 'SELECT plan_id FROM plans WHERE id BETWEEN ? AND ?'
+                if conditions:
+                    chunk_filter += ' AND ' + ' AND '.join(conditions)
+                chunk_params = [rows[0]['id'], last_id] + params
+                for table in ('issuers', 'benefits', 'cost_sharings', 'deductibles', 'moops'):
+                    cursor.execute(
+                        f'SELECT * FROM {table} WHERE plan_id IN ({chunk_filter}) ORDER BY id',
+                        chunk_params
+                    )
+                    for child in cursor:
+                        plan = plans[child['plan_id']]
+                        if table == 'issuers':
+                            plan['issuer'] = plan['issuer'] or dict(child)
+                        else:
+                            plan[table].append(dict(child))
+
+                yield list(plans.values())
+                if not chunk_size or len(rows) < chunk_size:
+                    break
+
+    def get_metal_premium_stats(self) -> List[Dict[str, Any]]:
+        """Premium count, mean and quartiles per metal level from metal_premium_stats"""
+        with self._get_connection() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM metal_premium_stats ORDER BY premium_median')
+            return [dict(row) for row in cursor.fetchall()]
+
+    def get_benefit_coverage(self) -> List[Dict[str, Any]]:
+        """Share of plans covering each benefit from benefit_coverage"""
+        with self._get_connection() as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT name, plan_count, covered_count,
+                       CAST(covered_count AS REAL) / plan_count AS coverage_rate
+                FROM benefit_coverage ORDER BY name
+            ''')
+            return [dict(row) for row in cursor.fetchall()]
+
+    def rebuild_summaries(self) -> None:
+        """Recompute every summary table from scratch, e.g. after editing rows by hand"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT plan_id FROM plans')
-            plan_ids = [row[0] for row in cursor.fetchall()]
-            return [self.get_plan(plan_id) for plan_id in plan_ids]
+            cursor.execute('DELETE FROM plan_rollups')
+            _refresh_plan_rollups(cursor)
+            cursor.execute('DELETE FROM benefit_coverage')
+            cursor.execute(BENEFIT_COVERAGE_SQL)
+            _refresh_metal_premium_stats(cursor)
+
+    def delete_plan(self, plan_id: str, run_id: Optional[int] = None) -> bool:
+        """
+        Delete a plan and all its related data from the database.
 
-    def delete_plan(self, plan_id: str) -> bool:
-        """Delete a plan and all its related data from the database"""
+        A plan with history gets a removal row in the history tables, in
+        `run_id` or else in a new, finished 'delete' run.
+        """
         with self._get_connection() as conn:
             cursor = conn.cursor()
             try:
+                # Take the plan out of the summary tables before its rows go
+                cursor.execute('SELECT metal_level FROM plans WHERE plan_id = ?', (plan_id,))
+                metal_levels = [row[0] for row in cursor.fetchall()]
+                cursor.execute('SELECT name, covered FROM benefits WHERE plan_id = ?', (plan_id,))
+                coverage_delta = {}
+                for name, covered in cursor.fetchall():
+                    counts = coverage_delta.setdefault(name, [0, 0])
+                    counts[0] -= 1
+                    counts[1] -= covered or 0
+                _apply_benefit_coverage_delta(cursor, coverage_delta)
+                cursor.execute('DELETE FROM plan_rollups WHERE plan_id = ?', (plan_id,))
+
                 cursor.execute('DELETE FROM moops WHERE plan_id = ?', (plan_id,))
                 cursor.execute('DELETE FROM deductibles WHERE plan_id = ?', (plan_id,))
                 cursor.execute('DELETE FROM cost_sharings WHERE plan_id = ?', (plan_id,))
                 cursor.execute('DELETE FROM benefits WHERE plan_id = ?', (plan_id,))
                 cursor.execute('DELETE FROM issuers WHERE plan_id = ?', (plan_id,))
                 cursor.execute('DELETE FROM plans WHERE plan_id = ?', (plan_id,))
+                deleted = cursor.rowcount > 0
+                _refresh_metal_premium_stats(cursor, metal_levels)
+                if deleted and not _unrecorded(cursor, [plan_id]):
+                    if run_id is None:
+                        cursor.execute("INSERT INTO collection_runs (source, finished_at) "
+                                       "VALUES ('delete', CURRENT_TIMESTAMP)")
+                        run_id = cursor.lastrowid
+                    _record_history(cursor, run_id, [plan_id])
                 conn.commit()
-                return cursor.rowcount > 0
+                return deleted
             except sqlite3.Error:
                 conn.rollback()
                 return False
 
-def save_marketplace_data(data: dict, db_path: str = 'marketplace.db') -> None:
+def save_marketplace_data(data: dict, db_path: str = 'marketplace.db') -> Dict[str, int]:
     """
     Save marketplace data to the SQLite database
     
     Args:
         data: Dictionary containing marketplace data
         db_path: Path to the SQLite database file
+    
+    Returns:
+        Counts of plans inserted, updated and unchanged
     """
     db = MarketplaceDB(db_path)
     
-    # Save each plan's data
-    for plan_wrapper in data.get('all_plans', []):
-        plan = plan_wrapper.get('plan', {})
-        if plan:
-            db.save_plan_data(plan)
+    # Save all plans in bulk over a single connection, as one collection run of the history
+    run_id = db.start_run('collect')
+    summary = db.save_plans(
+        (plan_wrapper['plan'] for plan_wrapper in data.get('all_plans', []) if plan_wrapper.get('plan')),
+        run_id=run_id
+    )
+    db.finish_run(run_id, summary)
     
-    print(f"Successfully saved {len(data.get('all_plans', []))} plans to database")
+    # Fold the WAL back into the database file so it can be committed as-is
+    db.close()
+    
+    print(f"Successfully saved {sum(summary.values())} plans to database "
+          f"({summary['inserted']} inserted, {summary['updated']} updated, {summary['unchanged']} unchanged)")
+    return summary
 
-def export_to_csv(db_path: str = 'marketplace.db', output_dir: str = 'exported_csvs') -> None:
+def export_to_csv(db_path: str = 'marketplace.db', output_dir: str = 'exported_csvs',
+                  incremental: bool = False) -> Dict[str, int]:
     """
     Export database tables to CSV files
     
     Args:
         db_path: Path to the SQLite database file
         output_dir: Directory to save CSV files
-    """
-    import os
-    import csv
-    import sqlite3
+        incremental: Only append rows added since the previous export
+            (see export.export_csv)
     
-    os.makedirs(output_dir, exist_ok=True)
-    
-    with sqlite3.connect(db_path) as conn:
-        cursor = conn.cursor()
-        
-        # Get list of tables
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        tables = [table[0] for table in cursor.fetchall()]
-        
-        for table in tables:
-            cursor.execute(f"SELECT * FROM {table}")
-            rows = cursor.fetchall()
-            
-            if not rows:
-                continue
-                
-            # Get column names
-            col_names = [description[0] for description in cursor.description]
-            
-            # Write to CSV
-            csv_path = os.path.join(output_dir, f"{table}.csv")
-            with open(csv_path, 'w', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerow(col_names)
-                writer.writerows(rows)
+    Returns:
+        Rows written per table
+    """
+    from export import export_csv
     
-    print(f"Exported {len(tables)} tables to {output_dir}")
+    return export_csv(db_path, output_dir, incremental=incremental)
 
 if __name__ == "__main__":
-    # Example usage
-    import json
+    import sys
+    
+    if len(sys.argv) > 1 and sys.argv[1] == "--check-indexes":
+        # Confirm every filtered query the code issues is served by an index. Run through the
+        # importable module: export, history and plan_search share its pools, which get traced
+        import db
+        database = db.MarketplaceDB()
+        with database._get_connection() as conn:
+            queries = db.traced_statements(normalized=db.is_normalized(conn))
+        offenders = database.check_query_plans(queries)
+        for offender in offenders:
+            print(f"Full table scan: {offender['query']} -> {offender['plan']}")
+        print(f"{len(queries) - len({o['query'] for o in offenders})}/{len(queries)} queries use an index")
+        sys.exit(1 if offenders else 0)
+    
+    if len(sys.argv) > 1 and sys.argv[1] == "--normalize":
+        # Convert a database to the normalized layout in place
+        db_path = sys.argv[2] if len(sys.argv) > 2 else 'marketplace.db'
+        before = os.path.getsize(db_path) if os.path.exists(db_path) else 0
+        MarketplaceDB(db_path, normalized=True).close()
+        print(f"Normalized {db_path}: {before / 1e6:.1f} MB -> {os.path.getsize(db_path) / 1e6:.1f} MB")
+        sys.exit(0)
     
-    # Load sample data
-    with open('healthcare_plans.json', 'r') as f:
-        data = json.load(f)
+    # Example usage: stream the sample data into the database
+    from ingest import SQLiteSink, run_pipeline
     
-    # Save to database
-    save_marketplace_data(data)
+    sink = SQLiteSink()
+    count = run_pipeline('healthcare_plans.json', [sink])
+    print(f"Successfully saved {count} plans to database ({sink.summary['inserted']} inserted, "
+          f"{sink.summary['updated']} updated, {sink.summary['unchanged']} unchanged)")
     
     # Export to CSV
     export_to_csv()
@@ -0,0 +1,441 @@
+"""
+Export of the marketplace database to CSV and columnar files.
+
+`export_csv` streams each table out of SQLite with `fetchmany` through a
+`CSVTableWriter`, which keeps one open handle per file. In incremental mode
+only rows newer than the watermark stored with the previous export (by `id`,
+and by `change_seq` for re-saved plans) are appended, so an export costs as
+much as the new data rather than the whole history. Only the plan data
+tables are exported; summary, history and bookkeeping tables are not.
+
+`export_columnar` streams each table into Parquet or Arrow IPC files with
+explicit column types. Repeated strings such as `benefit_name`,
+`network_tier` and `metal_level` are dictionary-encoded, and Arrow IPC files
+are written uncompressed so `load_columnar` can memory-map them instead of
+re-parsing CSVs. It requires the optional `pyarrow` package, which is not
+in requirements.txt: `pip install pyarrow`.
+
+Usage:
+    python export.py --format csv --incremental
+    python export.py --format arrow
+"""
+import csv
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+from db import data_tables, get_pool
+
+DEFAULT_OUTPUT_DIR = 'exported_columnar'
+DEFAULT_CSV_DIR = 'exported_csvs'
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+# Per-table watermarks of the last CSV export, kept next to the CSVs
+WATERMARK_FILE = '.export_watermarks.json'
+
+
+class CSVTableWriter:
+    """
+    Writes rows to per-table CSV files, keeping one open handle per file.
+
+    Files are only created once they get a row. In append mode existing
+    files are extended and the header is only written to new or empty files.
+
+    Usage:
+        with CSVTableWriter("exported_csvs", append=True) as writer:
+            writer.write_dicts("plans.csv", rows)
+    """
+
+    def __init__(self, output_dir: str = DEFAULT_CSV_DIR, append: bool = False):
+        self.output_dir = output_dir
+        self.append = append
+        self._files = {}
+        self._writers = {}
+        os.makedirs(output_dir, exist_ok=True)
+
+    def _writer(self, filename: str, fieldnames: Sequence[str]):
+        writer = self._writers.get(filename)
+        if writer is None:
+            path = os.path.join(self.output_dir, filename)
+            f = open(path, 'a' if self.append else 'w', newline='')
+            writer = csv.writer(f)
+            if f.tell() == 0:
+                writer.writerow(fieldnames)
+            self._files[filename], self._writers[filename] = f, writer
+        return writer
+
+    def write(self, filename: str, fieldnames: Sequence[str], rows: Sequence[Sequence[Any]]) -> None:
+        """Write rows given as sequences in `fieldnames` order."""
+        if rows:
+            self._writer(filename, fieldnames).writerows(rows)
+
+    def write_dicts(self, filename: str, rows: Sequence[Dict[str, Any]]) -> None:
+        """Write dict rows; the first row's keys are the header."""
+        if rows:
+            fieldnames = list(rows[0].keys())
+            self.write(filename, fieldnames, [[row.get(name) for name in fieldnames] for row in rows])
+
+    def close(self) -> None:
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+        self._writers.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _load_watermarks(output_dir: str) -> Dict[str, Any]:
+    try:
+        with open(os.path.join(output_dir, WATERMARK_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _save_watermarks(output_dir: str, watermarks: Dict[str, Any]) -> None:
+    path = os.path.join(output_dir, WATERMARK_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(watermarks, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def export_tables(conn: sqlite3.Connection) -> List[str]:
+    """The plan data tables (TABLE_COLUMNS) present in the database, in creation order."""
+    return [table for table in data_tables(conn) if table in TABLE_COLUMNS]
+
+
+def _incremental_query(table: str, columns: List[str], mark: Dict[str, Any]):
+    """Build the SELECT for rows added (or, for plans, re-saved) since `mark`."""
+    if 'change_seq' in columns:
+        return f'SELECT * FROM {table} WHERE change_seq > ? ORDER BY change_seq', [mark['change_seq']]
+    return f'SELECT * FROM {table} WHERE id > ? ORDER BY id', [mark['id']]
+
+
+def _can_append(conn: sqlite3.Connection, table: str, columns: List[str], mark: Optional[Dict[str, Any]],
+                path: str) -> bool:
+    """
+    Whether the CSV can be extended from `mark`: same columns, file present,
+    and no row it holds has been deleted since (the live rows up to the
+    watermark id still number `rows`).
+    """
+    if (mark is None or 'rows' not in mark or mark.get('columns') != columns
+            or ('change_seq' in columns) != ('change_seq' in mark) or not os.path.exists(path)):
+        return False
+    live = conn.execute(f'SELECT COUNT(*) FROM {table} WHERE id <= ?', (mark['id'],)).fetchone()[0]
+    return live == mark['rows']
+
+
+def export_csv(db_path: str = 'marketplace.db', output_dir: str = DEFAULT_CSV_DIR,
+               incremental: bool = False, chunk_size: int = 10000) -> Dict[str, int]:
+    """
+    Export the plan data tables (see TABLE_COLUMNS) to `<table>.csv`,
+    streaming rows with `fetchmany`.
+
+    Args:
+        db_path: Path to the SQLite database file
+        output_dir: Directory to save CSV files
+        incremental: Append only rows added since the previous export's
+            watermark: by `id`, and for plans by `change_seq`, which every
+            insert or update bumps. Re-saved plans are appended again, so
+            plans.csv then holds one row per plan version; the latest row per
+            `plan_id` is current. A table is rewritten instead when rows it
+            exported were deleted (re-saving a changed plan replaces its
+            changed related rows), or when its columns changed or its CSV is
+            missing.
+        chunk_size: Rows fetched from SQLite at a time
+
+    Returns:
+        Rows written per table
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    watermarks = _load_watermarks(output_dir) if incremental else {}
+    new_watermarks = {}
+    written = {}
+
+    with get_pool(db_path).connection() as conn:
+        tables = export_tables(conn)
+        for table in tables:
+            filename = f"{table}.csv"
+            path = os.path.join(output_dir, filename)
+            cursor = conn.cursor()
+            columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+            mark = watermarks.get(table)
+            if _can_append(conn, table, columns, mark, path):
+                cursor.execute(*_incremental_query(table, columns, mark))
+            else:
+                cursor.execute(f'SELECT * FROM {table} ORDER BY id')
+                # Start the file over; as before, empty tables get no file
+                mark = {'id': 0, 'rows': 0}
+                if 'change_seq' in columns:
+                    mark['change_seq'] = 0
+                if os.path.exists(path):
+                    os.remove(path)
+            last_id = mark['id']
+            mark = {**mark, 'columns': columns}
+
+            id_index = columns.index('id')
+            seq_index = columns.index('change_seq') if 'change_seq' in columns else None
+            count = 0
+            with CSVTableWriter(output_dir, append=True) as writer:
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    writer.write(filename, columns, rows)
+                    count += len(rows)
+                    for row in rows:
+                        # Re-saved plans keep their id; only new rows add to the live count
+                        if row[id_index] > last_id:
+                            mark['rows'] += 1
+                            mark['id'] = max(mark['id'], row[id_index])
+                        if seq_index is not None and row[seq_index] is not None:
+                            mark['change_seq'] = max(mark['change_seq'], row[seq_index])
+            written[table] = count
+            new_watermarks[table] = mark
+
+    _save_watermarks(output_dir, new_watermarks)
+    print(f"Exported {len(tables)} tables to {output_dir}"
+          + (f" ({sum(written.values())} rows written)" if incremental else ''))
+    return written
+
+# Column kinds per table: 'dict' columns are dictionary-encoded strings
+TABLE_COLUMNS = {
+    'plans': {
+        'id': 'int64', 'plan_id': 'string', 'name': 'string', 'premium': 'float64',
+        'metal_level': 'dict', 'type': 'dict', 'state': 'dict', 'product_division': 'dict',
+        'insurance_market': 'dict', 'hsa_eligible': 'int8', 'has_national_network': 'int8',
+        'max_age_child': 'int32', 'created_at': 'timestamp', 'updated_at': 'timestamp',
+        'content_hash': 'string', 'change_seq': 'int64',
+    },
+    'issuers': {
+        'id': 'int64', 'plan_id': 'dict', 'issuer_id': 'dict', 'name': 'dict', 'state': 'dict',
+        'toll_free': 'dict', 'created_at': 'timestamp',
+    },
+    'benefits': {
+        'id': 'int64', 'plan_id': 'dict', 'name': 'dict', 'covered': 'int8', 'has_limits': 'int8',
+        'limit_unit': 'dict', 'limit_quantity': 'int64', 'created_at': 'timestamp',
+    },
+    'cost_sharings': {
+        'id': 'int64', 'plan_id': 'dict', 'benefit_name': 'dict', 'network_tier': 'dict',
+        'copay_amount': 'float64', 'coinsurance_rate': 'float64', 'display_string': 'dict',
+        'csr': 'dict', 'created_at': 'timestamp',
+    },
+    'deductibles': {
+        'id': 'int64', 'plan_id': 'dict', 'type': 'dict', 'amount': 'float64', 'network_tier': 'dict',
+        'family_cost': 'dict', 'created_at': 'timestamp',
+    },
+    'moops': {
+        'id': 'int64', 'plan_id': 'dict', 'type': 'dict', 'amount': 'float64', 'network_tier': 'dict',
+        'family_cost': 'dict', 'created_at': 'timestamp',
+    },
+}
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError as e:
+        raise ImportError("Columnar export needs pyarrow: pip install pyarrow") from e
+
+
+def _arrow_type(pa, kind: str):
+    return {
+        'int64': pa.int64(),
+        'int32': pa.int32(),
+        'int8': pa.int8(),
+        'float64': pa.float64(),
+        'string': pa.string(),
+        'dict': pa.dictionary(pa.int32(), pa.string()),
+        'timestamp': pa.timestamp('s'),
+    }[kind]
+
+
+def _number(value: Any, cast):
+    if value is None or value == '':
+        return None
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class _ColumnBuilder:
+    """Converts chunks of one SQLite column into Arrow arrays of a fixed type."""
+
+    def __init__(self, pa, pc, kind: Optional[str]):
+        self.pa, self.pc, self.kind = pa, pc, kind
+        # Dictionary columns share one growing dictionary so batches only add deltas
+        self.codes: Dict[str, int] = {}
+        self.values: List[str] = []
+
+    def build(self, values: List[Any]):
+        pa, kind = self.pa, self.kind
+        if kind is None:
+            return pa.array(values)
+        if kind == 'dict':
+            indices = []
+            for value in values:
+                if value is None:
+                    indices.append(None)
+                    continue
+                value = str(value)
+                code = self.codes.get(value)
+                if code is None:
+                    code = self.codes[value] = len(self.values)
+                    self.values.append(value)
+                indices.append(code)
+            return pa.DictionaryArray.from_arrays(pa.array(indices, pa.int32()), pa.array(self.values, pa.string()))
+        if kind == 'timestamp':
+            strings = pa.array([None if v is None else str(v)[:19] for v in values], pa.string())
+            return self.pc.strptime(strings, format='%Y-%m-%d %H:%M:%S', unit='s', error_is_null=True)
+        if kind == 'float64':
+            return pa.array([_number(v, float) for v in values], pa.float64())
+        if kind == 'string':
+            return pa.array([None if v is None else str(v) for v in values], pa.string())
+        return pa.array([_number(v, lambda x: int(float(x))) for v in values], _arrow_type(pa, kind))
+
+
+def export_table(conn: sqlite3.Connection, table: str, path: str, fmt: str = 'parquet',
+                 chunk_size: int = 50000) -> int:
+    """
+    Stream one table into a Parquet or Arrow IPC file.
+
+    Returns:
+        Number of rows written
+    """
+    _require_pyarrow()
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT * FROM {table}')
+    columns = [description[0] for description in cursor.description]
+    kinds = TABLE_COLUMNS.get(table, {})
+    builders = [_ColumnBuilder(pa, pc, kinds.get(column)) for column in columns]
+
+    schema = None
+    writer = None
+    sink = None
+    rows_written = 0
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows and writer is not None:
+                break
+            arrays = [builder.build(list(values)) for builder, values in
+                      zip(builders, zip(*rows) if rows else [[] for _ in columns])]
+            if schema is None:
+                schema = pa.schema([
+                    pa.field(column, _arrow_type(pa, kinds[column]) if column in kinds else array.type)
+                    for column, array in zip(columns, arrays)
+                ])
+                if fmt == 'arrow':
+                    sink = pa.OSFile(path, 'wb')
+                    writer = pa.ipc.new_file(sink, schema,
+                                             options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+                else:
+                    writer = pq.ParquetWriter(path, schema, compression='zstd')
+            batch = pa.record_batch([array.cast(field.type) for array, field in zip(arrays, schema)],
+                                    schema=schema)
+            writer.write_batch(batch)
+            rows_written += len(rows)
+            if not rows:
+                break
+    finally:
+        if writer is not None:
+            writer.close()
+        if sink is not None:
+            sink.close()
+    return rows_written
+
+
+def export_columnar(db_path: str = 'marketplace.db', output_dir: str = DEFAULT_OUTPUT_DIR,
+                    fmt: str = 'parquet', chunk_size: int = 50000) -> Dict[str, int]:
+    """
+    Export the plan data tables (see TABLE_COLUMNS) to columnar files.
+
+    Args:
+        db_path: Path to the SQLite database file
+        output_dir: Directory to write `<table>.parquet` / `<table>.arrow` files to
+        fmt: 'parquet' or 'arrow' (Arrow IPC, memory-mappable)
+        chunk_size: Rows fetched from SQLite per record batch
+
+    Returns:
+        Rows written per table
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt!r}, expected one of {sorted(FORMATS)}")
+    _require_pyarrow()
+    os.makedirs(output_dir, exist_ok=True)
+
+    written = {}
+    with get_pool(db_path).connection() as conn:
+        tables = export_tables(conn)
+        for table in tables:
+            path = os.path.join(output_dir, f"{table}{FORMATS[fmt]}")
+            written[table] = export_table(conn, table, path, fmt, chunk_size)
+
+    print(f"Exported {len(written)} tables to {output_dir} ({fmt})")
+    return written
+
+
+def load_columnar(data_dir: str = DEFAULT_OUTPUT_DIR, tables: Optional[List[str]] = None,
+                  arrow: bool = False) -> Dict[str, Any]:
+    """
+    Load exported tables as pandas DataFrames, or as pyarrow Tables.
+
+    Arrow IPC files are memory-mapped; Parquet files are read with
+    `memory_map=True`. With `arrow=True` the `pyarrow.Table`s are returned
+    as they are, so an Arrow IPC table stays backed by the mapped file and
+    costs no copy. DataFrames are always a copy into pandas' own memory;
+    `to_pandas(split_blocks=True, self_destruct=True)` keeps it to about one
+    copy of the data by freeing each Arrow column once converted.
+    Dictionary-encoded columns come back as categoricals.
+    """
+    _require_pyarrow()
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    data = {}
+    if not os.path.isdir(data_dir):
+        return data
+    for filename in sorted(os.listdir(data_dir)):
+        name, ext = os.path.splitext(filename)
+        if tables is not None and name not in tables:
+            continue
+        path = os.path.join(data_dir, filename)
+        if ext == '.arrow':
+            table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+        elif ext == '.parquet':
+            table = pq.read_table(path, memory_map=True)
+        else:
+            continue
+        data[name] = table if arrow else table.to_pandas(split_blocks=True, self_destruct=True)
+        del table
+    return data
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export the marketplace database to CSV, Parquet or Arrow files")
+    parser.add_argument("--db", default="marketplace.db")
+    parser.add_argument("--output-dir", help="defaults to exported_csvs for CSV, exported_columnar otherwise")
+    parser.add_argument("--format", choices=['csv'] + sorted(FORMATS), default="parquet")
+    parser.add_argument("--incremental", action="store_true", help="CSV only: append rows added since the last export")
+    parser.add_argument("--chunk-size", type=int, default=50000)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.format == 'csv':
+        export_csv(args.db, args.output_dir or DEFAULT_CSV_DIR, args.incremental, args.chunk_size)
+    else:
+        export_columnar(args.db, args.output_dir or DEFAULT_OUTPUT_DIR, args.format, args.chunk_size)
+    print(f"Done in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,198 @@
+"""
+Run-versioned history of premiums and cost sharing in marketplace.db.
+
+Each collection run (`MarketplaceDB.start_run`) gets an id in
+`collection_runs`. When plans are saved with that id, `save_plans` appends a
+row to `plan_history` (premium, deductible, drug deductible, MOOP) and
+`cost_sharing_history` (one row per benefit, network tier and CSR variant)
+only for the values that changed since the plan's latest recorded run. The
+database therefore grows with the changes rather than with one snapshot per
+night. A deleted plan, or one a complete run no longer returned (see
+`MarketplaceDB.finish_run`), gets a row with `removed = 1`. Both history tables are indexed on (plan_id, run_id), so the state
+of a plan as of a run or date is one index range per plan.
+
+Usage:
+    history = PlanHistory('marketplace.db')
+    history.premium_trend('11512NC0100031')
+    history.plan_as_of('11512NC0100031', '2026-09-30')
+    history.premiums_as_of('2026-09-30', metal_level='Silver')
+
+    python history.py runs
+    python history.py trend 11512NC0100031
+    python history.py as-of 2026-09-30 --plan 11512NC0100031
+"""
+import argparse
+import datetime
+import sqlite3
+from typing import Any, Dict, List, Optional, Union
+
+from db import HISTORY_TABLES, PLAN_COLUMNS, MarketplaceDB, get_pool
+
+# A run id, or a date/timestamp meaning the last run started by then
+AsOf = Union[int, str, datetime.date]
+
+PLAN_VALUES = HISTORY_TABLES['plan_history'][2]
+_, COST_SHARING_KEYS, COST_SHARING_VALUES = HISTORY_TABLES['cost_sharing_history']
+
+
+class PlanHistory:
+    """As-of and trend queries over the history tables."""
+
+    def __init__(self, db_path: str = 'marketplace.db'):
+        self.db_path = db_path
+        # Creates/migrates the schema, including the history tables
+        MarketplaceDB(db_path)
+
+    def _query(self, sql: str, params: List[Any] = ()) -> List[Dict[str, Any]]:
+        with get_pool(self.db_path).connection() as conn:
+            conn.row_factory = sqlite3.Row
+            return [dict(row) for row in conn.execute(sql, list(params)).fetchall()]
+
+    def runs(self) -> List[Dict[str, Any]]:
+        """Every collection run, oldest first."""
+        return self._query('SELECT * FROM collection_runs ORDER BY id')
+
+    def run_id(self, as_of: AsOf) -> Optional[int]:
+        """
+        Resolve `as_of` to a run id.
+
+        Args:
+            as_of: A run id, or a date or timestamp; a date covers the runs
+                started on that day (UTC, like CURRENT_TIMESTAMP)
+
+        Returns:
+            The last run started by then, None if there was none
+        """
+        if isinstance(as_of, int):
+            return as_of
+        if isinstance(as_of, datetime.datetime):
+            as_of = as_of.strftime('%Y-%m-%d %H:%M:%S')
+        elif isinstance(as_of, datetime.date):
+            as_of = as_of.isoformat()
+        if len(as_of) == 10:
+            as_of += ' 23:59:59'
+        rows = self._query('SELECT MAX(id) AS run_id FROM collection_runs WHERE started_at <= ?', [as_of])
+        return rows[0]['run_id']
+
+    def premium_trend(self, plan_id: str) -> List[Dict[str, Any]]:
+        """
+        The recorded changes of a plan's premium, deductibles and MOOP.
+
+        Returns:
+            One dict per run that changed them, oldest first, with the run's
+            id and start time; the values hold until the next entry. Entries
+            with `removed` set mark the plan's removal (their values are None)
+        """
+        return self._query(f'''
+            SELECT h.run_id, r.started_at, {', '.join(f'h.{column}' for column in PLAN_VALUES)}, h.removed
+            FROM plan_history h JOIN collection_runs r ON r.id = h.run_id
+            WHERE h.plan_id = ? ORDER BY h.run_id, h.id
+        ''', [plan_id])
+
+    def plan_as_of(self, plan_id: str, as_of: AsOf) -> Optional[Dict[str, Any]]:
+        """
+        A plan's premium, deductibles, MOOP and cost sharings as of a run or date.
+
+        Returns:
+            The values with the run they were recorded in, and the
+            `cost_sharings` rows in effect; None if no run by then saw the
+            plan, or it had been removed
+        """
+        run_id = self.run_id(as_of)
+        if run_id is None:
+            return None
+        rows = self._query(f'''
+            SELECT run_id, {', '.join(PLAN_VALUES)}, removed FROM plan_history
+            WHERE plan_id = ? AND run_id <= ? ORDER BY run_id DESC, id DESC LIMIT 1
+        ''', [plan_id, run_id])
+        if not rows or rows[0].pop('removed'):
+            return None
+        plan = {'plan_id': plan_id, 'as_of_run': run_id, **rows[0]}
+
+        # Latest row per benefit, tier and CSR variant, without the removed ones
+        partition = ', '.join(COST_SHARING_KEYS)
+        plan['cost_sharings'] = self._query(f'''
+            SELECT run_id, {partition}, {', '.join(COST_SHARING_VALUES)} FROM (
+                SELECT *, ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY run_id DESC, id DESC) AS rank
+                FROM cost_sharing_history WHERE plan_id = ? AND run_id <= ?
+            ) WHERE rank = 1 AND removed = 0 ORDER BY {partition}
+        ''', [plan_id, run_id])
+        return plan
+
+    def premiums_as_of(self, as_of: AsOf, **filters) -> List[Dict[str, Any]]:
+        """
+        Every plan's premium, deductibles and MOOP as of a run or date.
+
+        Args:
+            as_of: Run id, date or timestamp (see `run_id`)
+            **filters: Equality filters on current plans columns, e.g. metal_level='Silver'
+
+        Returns:
+            One dict per plan recorded by then and not removed, ordered by plan_id
+        """
+        run_id = self.run_id(as_of)
+        if run_id is None:
+            return []
+        conditions, params = ['h.run_id <= ?'], [run_id]
+        for column, value in filters.items():
+            if column not in PLAN_COLUMNS:
+                raise ValueError(f"Unknown plan filter: {column}")
+            conditions.append(f'h.plan_id IN (SELECT plan_id FROM plans WHERE {column} = ?)')
+            params.append(value)
+        # SQLite takes the bare columns from the row holding MAX(run_id)
+        return self._query(f'''
+            SELECT plan_id, run_id, {', '.join(PLAN_VALUES)} FROM (
+                SELECT h.plan_id, MAX(h.run_id) AS run_id, {', '.join(f'h.{column}' for column in PLAN_VALUES)},
+                    h.removed
+                FROM plan_history h WHERE {' AND '.join(conditions)}
+                GROUP BY h.plan_id
+            ) WHERE removed = 0 ORDER BY plan_id
+        ''', params)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the premium and cost-sharing history')
+    parser.add_argument('--db', default='marketplace.db', help='SQLite database path')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('runs', help='List the collection runs')
+    trend = commands.add_parser('trend', help="A plan's premium, deductible and MOOP changes")
+    trend.add_argument('plan_id')
+    as_of = commands.add_parser('as-of', help='Premiums (or one plan) as of a run id or date')
+    as_of.add_argument('when', help='Run id, YYYY-MM-DD or "YYYY-MM-DD HH:MM:SS"')
+    as_of.add_argument('--plan', help='Show this plan with its cost sharings')
+    as_of.add_argument('--metal-level')
+    args = parser.parse_args()
+
+    history = PlanHistory(args.db)
+    if args.command == 'runs':
+        for run in history.runs():
+            print(f"{run['id']:>5}  {run['started_at']}  {run['source'] or '':<10} finished={run['finished_at']}  "
+                  f"inserted={run['inserted']} updated={run['updated']} unchanged={run['unchanged']}")
+    elif args.command == 'trend':
+        for row in history.premium_trend(args.plan_id):
+            if row['removed']:
+                print(f"run {row['run_id']:>5}  {row['started_at']}  removed")
+                continue
+            print(f"run {row['run_id']:>5}  {row['started_at']}  premium={row['premium']}  "
+                  f"deductible={row['deductible']}  moop={row['moop']}")
+    else:
+        when = int(args.when) if args.when.isdigit() else args.when
+        if args.plan:
+            plan = history.plan_as_of(args.plan, when)
+            if plan is None:
+                print(f"{args.plan} was not recorded by {args.when}, or had been removed")
+                return
+            print(f"{plan['plan_id']} as of run {plan['as_of_run']}: premium={plan['premium']} "
+                  f"deductible={plan['deductible']} moop={plan['moop']}")
+            for row in plan['cost_sharings']:
+                print(f"  {row['benefit_name']:<50} {row['network_tier']:<15} {row['display_string']}")
+        else:
+            filters = {'metal_level': args.metal_level} if args.metal_level else {}
+            rows = history.premiums_as_of(when, **filters)
+            for row in rows:
+                print(f"{row['plan_id']}  premium={row['premium']}  (run {row['run_id']})")
+            print(f"{len(rows)} plans")
+
+
+if __name__ == '__main__':
+    main()
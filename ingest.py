@@ -0,0 +1,387 @@
+"""
+Streaming ingestion of marketplace JSON dumps.
+
+`iter_json_plans` walks `all_plans[*]` in a file such as
+`healthcare_plans.json` one entry at a time, reading the file in fixed-size
+chunks, so multi-county dumps of hundreds of MB are never loaded whole.
+`run_pipeline` feeds the plans in batches to one or more sinks:
+
+- `SQLiteSink` saves them with `MarketplaceDB.save_plans`
+- `CSVSink` appends them to the CSVs written by `extract_json_to_csvs`
+
+SQLite takes one writer at a time, so `ingest_sharded` loads several dumps
+(e.g. one per state or year) in parallel instead: each worker process
+streams one dump into its own shard database, and the shards are merged
+into the main database with `MarketplaceDB.merge_shard` (ATTACH +
+INSERT ... SELECT) as they finish.
+
+Usage:
+    python ingest.py healthcare_plans.json --db marketplace.db --csv exported_csvs
+    python ingest.py dumps/*.json --db marketplace.db --workers 4
+"""
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+from db import MarketplaceDB
+from export import CSVTableWriter
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+class _JSONStream:
+    """Character buffer over a file that is refilled on demand."""
+
+    def __init__(self, f, chunk_size: int):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        """Read another chunk, dropping consumed text; False at end of file."""
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Return the next non-whitespace character without consuming it ('' at EOF)."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char: str) -> None:
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} but found {found!r}")
+        self.pos += 1
+
+    def value(self) -> Any:
+        """Decode the next complete JSON value, reading more input as needed."""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # A number at the very end of the buffer may continue in the next chunk
+            if end == len(self.buf) and not self.eof:
+                self.fill()
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_plans(path: str, chunk_size: int = 1 << 16) -> Iterator[Dict[str, Any]]:
+    """
+    Yield each `all_plans` entry ({"plan": ..., "coverage": ...}) of a dump.
+
+    Only the current entry (plus one read chunk) is held in memory.
+    """
+    with open(path, 'r') as f:
+        stream = _JSONStream(f, chunk_size)
+        stream.expect('{')
+        while stream.peek() not in ('}', ''):
+            key = stream.value()
+            stream.expect(':')
+            if key != 'all_plans':
+                stream.value()
+            else:
+                stream.expect('[')
+                while stream.peek() != ']':
+                    yield stream.value()
+                    if stream.peek() == ',':
+                        stream.pos += 1
+                stream.expect(']')
+            if stream.peek() == ',':
+                stream.pos += 1
+        stream.expect('}')
+
+
+def plan_csv_rows(plan: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    """Flatten one plan into the rows of each CSV written by `extract_json_to_csvs`."""
+    issuer = plan.get("issuer", {})
+    rows = {
+        "plans.csv": [{
+            "plan_id": plan.get("id"),
+            "plan_name": plan.get("name"),
+            "premium": plan.get("premium"),
+            "metal_level": plan.get("metal_level"),
+            "type": plan.get("type"),
+            "state": plan.get("state"),
+            "product_division": plan.get("product_division"),
+            "insurance_market": plan.get("insurance_market"),
+            "hsa_eligible": plan.get("hsa_eligible"),
+            "has_national_network": plan.get("has_national_network"),
+            "max_age_child": plan.get("max_age_child"),
+        }],
+        "issuers.csv": [{
+            "plan_id": plan.get("id"),
+            "issuer_id": issuer.get("id"),
+            "issuer_name": issuer.get("name"),
+            "state": issuer.get("state"),
+            "toll_free": issuer.get("toll_free"),
+        }],
+        "benefits.csv": [],
+        "cost_sharings.csv": [],
+        "deductibles.csv": [],
+        "moops.csv": [],
+    }
+
+    for benefit in plan.get("benefits", []):
+        rows["benefits.csv"].append({
+            "plan_id": plan["id"],
+            "benefit_name": benefit["name"],
+            "covered": benefit.get("covered"),
+            "has_limits": benefit.get("has_limits"),
+            "limit_unit": benefit.get("limit_unit"),
+            "limit_quantity": benefit.get("limit_quantity"),
+        })
+
+        for sharing in benefit.get("cost_sharings", []):
+            rows["cost_sharings.csv"].append({
+                "plan_id": plan["id"],
+                "benefit_name": benefit["name"],
+                "network_tier": sharing.get("network_tier"),
+                "copay_amount": sharing.get("copay_amount"),
+                "coinsurance_rate": sharing.get("coinsurance_rate"),
+                "display_string": sharing.get("display_string"),
+                "csr": sharing.get("csr"),
+            })
+
+    for deductible in plan.get("deductibles", []):
+        rows["deductibles.csv"].append({
+            "plan_id": plan["id"],
+            "type": deductible.get("type"),
+            "amount": deductible.get("amount"),
+            "network_tier": deductible.get("network_tier"),
+            "family_cost": deductible.get("family_cost"),
+        })
+
+    for moop in plan.get("moops", []):
+        rows["moops.csv"].append({
+            "plan_id": plan["id"],
+            "type": moop.get("type"),
+            "amount": moop.get("amount"),
+            "network_tier": moop.get("network_tier"),
+            "family_cost": moop.get("family_cost"),
+        })
+
+    return rows
+
+
+class SQLiteSink:
+    """
+    Saves each batch of plans to the database with `MarketplaceDB.save_plans`.
+
+    With a `source`, the saves are recorded as one collection run of the
+    plan history (see `MarketplaceDB.start_run`). With `complete`, the dump
+    is taken to hold every plan of its states: once it was read to the end,
+    stored plans of those states it lacks are recorded as removed (see
+    `MarketplaceDB.finish_run`).
+    """
+
+    def __init__(self, db_path: str = 'marketplace.db', source: Optional[str] = None, complete: bool = False):
+        self.db = MarketplaceDB(db_path)
+        self.summary = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        self.run_id = self.db.start_run(source) if source else None
+        self.complete = complete
+        self.removed = 0
+        self._read_all = False
+
+    def write(self, plans: List[Dict[str, Any]]) -> None:
+        for key, count in self.db.save_plans(plans, batch_size=len(plans) or 1, run_id=self.run_id).items():
+            self.summary[key] += count
+
+    def finish(self) -> None:
+        self._read_all = True
+
+    def close(self) -> None:
+        if self.run_id is not None:
+            self.removed = self.db.finish_run(self.run_id, self.summary, complete=self.complete and self._read_all)
+        self.db.close()
+
+
+class CSVSink:
+    """Writes plans to per-table CSV files through a shared `CSVTableWriter`."""
+
+    def __init__(self, output_dir: str = "exported_csvs"):
+        self.writer = CSVTableWriter(output_dir)
+
+    def write(self, plans: List[Dict[str, Any]]) -> None:
+        for plan in plans:
+            for filename, rows in plan_csv_rows(plan).items():
+                self.writer.write_dicts(filename, rows)
+
+    def finish(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+def run_pipeline(json_path: str, sinks: Iterable[Any], batch_size: int = 500,
+                 limit: Optional[int] = None) -> int:
+    """
+    Stream the plans in a JSON dump into every sink in batches.
+
+    Sinks have `write(plans)` and `close()`, and `finish()`, which is only
+    called once the whole dump was read (not when stopped by `limit` or an
+    error).
+
+    Returns:
+        Number of plans processed
+    """
+    sinks = list(sinks)
+    batch = []
+    count = 0
+    read_all = True
+    try:
+        for plan_wrapper in iter_json_plans(json_path):
+            plan = plan_wrapper.get('plan')
+            if not plan:
+                continue
+            batch.append(plan)
+            count += 1
+            if len(batch) >= batch_size:
+                for sink in sinks:
+                    sink.write(batch)
+                batch = []
+            if limit is not None and count >= limit:
+                read_all = False
+                break
+        if batch:
+            for sink in sinks:
+                sink.write(batch)
+        if read_all:
+            for sink in sinks:
+                sink.finish()
+    finally:
+        for sink in sinks:
+            sink.close()
+    return count
+
+
+def _ingest_shard(json_path: str, shard_path: str, batch_size: int) -> int:
+    """Worker process: stream one dump into its own shard database."""
+    return run_pipeline(json_path, [SQLiteSink(shard_path)], batch_size=batch_size)
+
+
+def ingest_sharded(json_paths: Sequence[str], db_path: str = 'marketplace.db', workers: Optional[int] = None,
+                   batch_size: int = 500, source: Optional[str] = 'ingest', complete: bool = False) -> Dict[str, Any]:
+    """
+    Ingest several JSON dumps in parallel through per-dump shard databases.
+
+    Shards are written next to `db_path` (so the merge reads from the same
+    disk) and deleted once merged. They are merged in the order of
+    `json_paths` while later dumps are still being ingested, so when a plan
+    appears in several dumps the last one wins, as with sequential ingests.
+
+    Args:
+        json_paths: Dumps to ingest, one shard each
+        db_path: Main database the shards are merged into
+        workers: Worker processes (default: one per CPU, at most one per dump)
+        batch_size: Plans per `save_plans` batch in the workers
+        source: Source of the collection run the merge is recorded as; None
+            to skip the plan history
+        complete: The dumps hold every plan of their states; once all are
+            merged, stored plans of those states they lack are recorded as
+            removed (see `MarketplaceDB.finish_run`)
+
+    Returns:
+        Plans ingested and 'inserted'/'updated'/'unchanged' counts, plus
+        'ingest_seconds' (until the last shard was written), 'merge_seconds'
+        (spent merging) and 'removed'
+    """
+    json_paths = list(json_paths)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(json_paths)))
+    db = MarketplaceDB(db_path)
+    run_id = db.start_run(source) if source else None
+    summary = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    stats = {'plans': 0, 'shards': len(json_paths), 'workers': workers, 'merge_seconds': 0.0, 'removed': 0}
+    merged_all = False
+
+    start = time.perf_counter()
+    shard_dir = tempfile.mkdtemp(prefix='shards-', dir=os.path.dirname(os.path.abspath(db_path)))
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            shard_paths = [os.path.join(shard_dir, f'shard-{i:04d}.db') for i in range(len(json_paths))]
+            futures = [pool.submit(_ingest_shard, json_path, shard_path, batch_size)
+                       for json_path, shard_path in zip(json_paths, shard_paths)]
+            for json_path, shard_path, future in zip(json_paths, shard_paths, futures):
+                stats['plans'] += future.result()
+                merge_start = time.perf_counter()
+                for key, count in db.merge_shard(shard_path, run_id).items():
+                    summary[key] += count
+                stats['merge_seconds'] += time.perf_counter() - merge_start
+                os.remove(shard_path)
+                print(f"Merged {json_path}")
+        stats['ingest_seconds'] = time.perf_counter() - start - stats['merge_seconds']
+        merged_all = True
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+        if run_id is not None:
+            stats['removed'] = db.finish_run(run_id, summary, complete=complete and merged_all)
+        db.close()
+    stats.update(summary)
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Stream marketplace JSON dumps into SQLite and/or CSV")
+    parser.add_argument("json_files", nargs="*", default=["healthcare_plans.json"])
+    parser.add_argument("--db", help="SQLite database to save plans to")
+    parser.add_argument("--csv", help="directory to write per-table CSVs to")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--workers", type=int,
+                        help="ingest the dumps in parallel through per-dump shard databases")
+    parser.add_argument("--complete", action="store_true",
+                        help="the dumps hold every plan of their states: record the stored plans of "
+                             "those states they lack as removed in the plan history")
+    args = parser.parse_args()
+
+    if args.workers or len(args.json_files) > 1:
+        if not args.db or args.csv:
+            parser.error("several dumps or --workers need --db and no --csv; export CSVs with export.py")
+        stats = ingest_sharded(args.json_files, args.db, workers=args.workers, batch_size=args.batch_size,
+                               complete=args.complete)
+        print(f"✅ Ingested {stats['plans']} plans from {stats['shards']} dumps with {stats['workers']} workers "
+              f"({stats['ingest_seconds']:.1f}s ingest, {stats['merge_seconds']:.1f}s merge)")
+        print(f"Plans: {stats['inserted']} inserted, {stats['updated']} updated, {stats['unchanged']} unchanged, "
+              f"{stats['removed']} removed")
+    else:
+        sinks = []
+        if args.db:
+            db_sink = SQLiteSink(args.db, source='ingest', complete=args.complete)
+            sinks.append(db_sink)
+        if args.csv:
+            sinks.append(CSVSink(args.csv))
+        if not sinks:
+            parser.error("nothing to do: pass --db and/or --csv")
+
+        json_file = args.json_files[0]
+        count = run_pipeline(json_file, sinks, batch_size=args.batch_size)
+        print(f"✅ Ingested {count} plans from {json_file}")
+        if args.db:
+            print(f"Plans: {db_sink.summary['inserted']} inserted, {db_sink.summary['updated']} updated, "
+                  f"{db_sink.summary['unchanged']} unchanged, {db_sink.removed} removed")
@@ -0,0 +1,337 @@
+"""
+Structured plan search over marketplace.db.
+
+`PlanSearch.search` compiles keyword filters into one SQL query over
+`plans` joined with `plan_rollups`; benefit and cost-sharing conditions
+become EXISTS subqueries served by the (plan_id, name) and
+(plan_id, benefit_name, network_tier) indexes. Results are sorted by
+premium, deductible or MOOP and paged with a keyset on (sort key, unique
+tie-breaker), so page N costs the same as page 1. Sorting by estimated annual cost prices
+the matching plans for a utilization profile with `cost_model.CostModel`.
+
+    search = PlanSearch('marketplace.db')
+    plans, cursor = search.search(metal_level='Silver', plan_type='PPO', hsa_eligible=True,
+                                  premium_max=400, copay_max={'Specialist Visit': 50})
+    more, cursor = search.search(metal_level='Silver', ..., after=cursor)
+
+    python plan_search.py --metal-level Silver --type PPO --hsa --premium-max 400 \
+        --copay-max "Specialist Visit=50" --sort premium
+"""
+import argparse
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from cost_model import IN_NETWORK, CostModel
+from db import MarketplaceDB, ROLLUP_COPAYS, get_pool
+
+DEFAULT_LIMIT = 20
+
+# Columns returned for each matching plan
+RESULT_COLUMNS = [
+    'p.plan_id', 'p.name', 'p.metal_level', 'p.type', 'p.state', 'p.hsa_eligible', 'p.premium',
+    'r.deductible', 'r.drug_deductible', 'r.moop',
+] + [f'r.{column}' for column in ROLLUP_COPAYS]
+
+# Sort keys computed in SQL, with the unique column breaking ties that their
+# index already orders by; 'estimated_cost' is computed with CostModel
+SORT_KEYS = {
+    'premium': ('p.premium', 'p.id'),
+    'deductible': ('r.deductible', 'r.plan_id'),
+    'moop': ('r.moop', 'r.plan_id'),
+}
+ESTIMATED_COST = 'estimated_cost'
+
+# filter name -> plans column; values may be a single value or a sequence (IN)
+VALUE_FILTERS = {
+    'metal_level': 'p.metal_level',
+    'plan_type': 'p.type',
+    'state': 'p.state',
+    'insurance_market': 'p.insurance_market',
+    'product_division': 'p.product_division',
+}
+BOOLEAN_FILTERS = {
+    'hsa_eligible': 'p.hsa_eligible',
+    'has_national_network': 'p.has_national_network',
+}
+# filter name -> (column, operator)
+RANGE_FILTERS = {
+    'premium_min': ('p.premium', '>='),
+    'premium_max': ('p.premium', '<='),
+    'deductible_max': ('r.deductible', '<='),
+    'moop_max': ('r.moop', '<='),
+}
+
+COVERS_SQL = 'EXISTS (SELECT 1 FROM benefits b WHERE b.plan_id = p.plan_id AND b.name = ? AND b.covered = 1)'
+# A copay limit means paying at most that much per visit, so coinsurance must not apply
+COPAY_SQL = (f"EXISTS (SELECT 1 FROM cost_sharings c WHERE c.plan_id = p.plan_id AND c.benefit_name = ? "
+             f"AND c.network_tier = '{IN_NETWORK}' AND c.copay_amount <= ? "
+             f"AND COALESCE(c.coinsurance_rate, 0) = 0)")
+COINSURANCE_SQL = (f"EXISTS (SELECT 1 FROM cost_sharings c WHERE c.plan_id = p.plan_id AND c.benefit_name = ? "
+                   f"AND c.network_tier = '{IN_NETWORK}' AND COALESCE(c.coinsurance_rate, 0) <= ?)")
+ISSUER_SQL = 'EXISTS (SELECT 1 FROM issuers i WHERE i.plan_id = p.plan_id AND i.name IN ({}))'
+
+FROM_SQL = 'FROM plans p JOIN plan_rollups r ON r.plan_id = p.plan_id'
+
+
+def _as_list(value: Any) -> List[Any]:
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return list(value)
+    return [value]
+
+
+def compile_filters(sort: Optional[str] = None, **filters) -> Tuple[str, List[Any]]:
+    """
+    Compile search filters into a WHERE clause over `plans p` and `plan_rollups r`.
+
+    The (metal_level, premium) index only helps a sorted page when it also
+    yields the sort order, i.e. one metal level sorted by premium. Otherwise
+    the metal level condition is written as `+p.metal_level` so SQLite walks
+    the sort key's index and stops after one page, instead of sorting every
+    plan of those metal levels.
+
+    Args:
+        sort: Sort key of the search (see SORT_KEYS), None for unordered queries
+        metal_level, plan_type, state, insurance_market, product_division:
+            A value or a sequence of accepted values
+        hsa_eligible, has_national_network: Required flag value
+        premium_min, premium_max, deductible_max, moop_max: Bounds (inclusive)
+        issuer: Issuer name, or a sequence of names
+        covers: Benefit names the plan must cover
+        copay_max: Benefit name -> highest in-network copay, without coinsurance
+        coinsurance_max: Benefit name -> highest in-network coinsurance rate
+
+    Returns:
+        The conditions joined with AND ('1' if none) and their parameters
+
+    Raises:
+        ValueError: On an unknown filter name
+    """
+    conditions, params = [], []
+    for name, value in filters.items():
+        if value is None:
+            continue
+        if name in VALUE_FILTERS:
+            values = _as_list(value)
+            column = VALUE_FILTERS[name]
+            if name == 'metal_level' and sort is not None and not (sort == 'premium' and len(values) == 1):
+                column = f'+{column}'
+            conditions.append(f"{column} IN ({','.join('?' * len(values))})")
+            params.extend(values)
+        elif name in BOOLEAN_FILTERS:
+            conditions.append(f'{BOOLEAN_FILTERS[name]} = ?')
+            params.append(int(bool(value)))
+        elif name in RANGE_FILTERS:
+            column, operator = RANGE_FILTERS[name]
+            conditions.append(f'{column} {operator} ?')
+            params.append(value)
+        elif name == 'issuer':
+            names = _as_list(value)
+            conditions.append(ISSUER_SQL.format(','.join('?' * len(names))))
+            params.extend(names)
+        elif name == 'covers':
+            for benefit in _as_list(value):
+                conditions.append(COVERS_SQL)
+                params.append(benefit)
+        elif name == 'copay_max':
+            for benefit, amount in value.items():
+                conditions.append(COPAY_SQL)
+                params.extend([benefit, amount])
+        elif name == 'coinsurance_max':
+            for benefit, rate in value.items():
+                conditions.append(COINSURANCE_SQL)
+                params.extend([benefit, rate])
+        else:
+            raise ValueError(f"Unknown search filter: {name}")
+    return ' AND '.join(conditions) or '1', params
+
+
+class PlanSearch:
+    """
+    Filtered, sorted and keyset-paginated plan search.
+
+    Estimated-cost searches keep one `CostModel` of all plans, reloaded when
+    the database version changes, plus the sorted costs of the last few
+    (filters, profile) combinations so later pages do not re-price plans.
+    """
+
+    def __init__(self, db_path: str = 'marketplace.db', cost_cache_size: int = 32):
+        self.db_path = db_path
+        # Creates/migrates the schema, including plan_rollups and the sort indexes
+        MarketplaceDB(db_path)
+        self._lock = threading.Lock()
+        self._model: Optional[CostModel] = None
+        # change_counter.seq is bumped by the plans triggers on every insert, update and delete
+        self._model_seq: Optional[int] = None
+        self._watch = sqlite3.connect(db_path, check_same_thread=False)
+        self._cost_cache: OrderedDict = OrderedDict()
+        self.cost_cache_size = cost_cache_size
+
+    def search(self, sort: str = 'premium', limit: int = DEFAULT_LIMIT, after: Optional[Tuple[Any, int]] = None,
+               profile: Optional[Dict[str, float]] = None, **filters) -> Tuple[List[Dict[str, Any]], Optional[tuple]]:
+        """
+        Find plans matching `filters` (see `compile_filters`), cheapest first.
+
+        Plans without a value for the sort key are left out. Ties are broken
+        by plans.id for premium and estimated cost, by plan_id otherwise.
+
+        Args:
+            sort: 'premium', 'deductible', 'moop' or 'estimated_cost'
+            limit: Page size
+            after: Cursor returned with the previous page
+            profile: Utilization profile for sort='estimated_cost' (see cost_model)
+
+        Returns:
+            The page of plans (dicts of RESULT_COLUMNS, plus estimated_cost when
+            sorting by it) and the cursor for the next page (None on the last page)
+        """
+        if sort == ESTIMATED_COST:
+            if profile is None:
+                raise ValueError("sort='estimated_cost' needs a utilization profile")
+            where, params = compile_filters(**filters)
+            return self._search_by_cost(where, params, profile, limit, after)
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort key: {sort}")
+        where, params = compile_filters(sort, **filters)
+
+        key, tiebreak = SORT_KEYS[sort]
+        conditions = [where, f'{key} IS NOT NULL']
+        if after is not None:
+            conditions.append(f'({key}, {tiebreak}) > (?, ?)')
+            params = params + list(after)
+        with get_pool(self.db_path).connection() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(f'''
+                SELECT {key} AS _key, {tiebreak} AS _tiebreak, {', '.join(RESULT_COLUMNS)} {FROM_SQL}
+                WHERE {' AND '.join(conditions)} ORDER BY {key}, {tiebreak} LIMIT ?
+            ''', params + [limit + 1]).fetchall()
+
+        # One extra row tells whether there is a next page
+        page = rows[:limit]
+        cursor = (page[-1]['_key'], page[-1]['_tiebreak']) if len(rows) > limit else None
+        return [self._result(row) for row in page], cursor
+
+    def count(self, **filters) -> int:
+        """Number of plans matching the filters."""
+        where, params = compile_filters(**filters)
+        with get_pool(self.db_path).connection() as conn:
+            return conn.execute(f'SELECT COUNT(*) {FROM_SQL} WHERE {where}', params).fetchone()[0]
+
+    @staticmethod
+    def _result(row: sqlite3.Row) -> Dict[str, Any]:
+        return {key: row[key] for key in row.keys() if not key.startswith('_')}
+
+    def cost_model(self) -> CostModel:
+        """The CostModel of all plans, reloaded when the database changed."""
+        with self._lock:
+            seq = self._watch.execute('SELECT seq FROM change_counter').fetchone()[0]
+            if self._model is None or seq != self._model_seq:
+                self._model = CostModel.from_db(self.db_path)
+                self._model_seq = seq
+                self._cost_cache.clear()
+            return self._model
+
+    def _ranked_costs(self, where: str, params: List[Any], profile: Dict[str, float]) -> Tuple[np.ndarray, np.ndarray]:
+        """plans.id and estimated cost of every matching plan, sorted by (cost, id)."""
+        model = self.cost_model()
+        key = (where, tuple(params), json.dumps(profile, sort_keys=True))
+        with self._lock:
+            if key in self._cost_cache:
+                self._cost_cache.move_to_end(key)
+                return self._cost_cache[key]
+
+        with get_pool(self.db_path).connection() as conn:
+            ids = np.array([row[0] for row in conn.execute(f'SELECT p.id {FROM_SQL} WHERE {where}', params)],
+                           dtype=np.int64)
+        positions = np.searchsorted(model.row_ids, ids)
+        # Plans saved after the model was loaded are only priced after the next reload
+        known = (positions < len(model.row_ids)) & (model.row_ids[np.minimum(positions, len(model) - 1)] == ids)
+        ids, positions = ids[known], positions[known]
+        costs = model.estimate([profile], dtype=np.float64)[0][positions]
+        order = np.lexsort((ids, costs))
+        ranked = (ids[order], costs[order])
+
+        with self._lock:
+            self._cost_cache[key] = ranked
+            while len(self._cost_cache) > self.cost_cache_size:
+                self._cost_cache.popitem(last=False)
+        return ranked
+
+    def _search_by_cost(self, where: str, params: List[Any], profile: Dict[str, float], limit: int,
+                        after: Optional[Tuple[float, int]]) -> Tuple[List[Dict[str, Any]], Optional[tuple]]:
+        ids, costs = self._ranked_costs(where, params, profile)
+        start = 0
+        if after is not None:
+            # First plan after (cost, id): skip lower costs, then lower ids at the same cost
+            after_cost, after_id = after
+            low = np.searchsorted(costs, after_cost, side='left')
+            high = np.searchsorted(costs, after_cost, side='right')
+            start = low + int(np.searchsorted(ids[low:high], after_id, side='right'))
+        page_ids = ids[start:start + limit].tolist()
+        page_costs = costs[start:start + limit].tolist()
+
+        with get_pool(self.db_path).connection() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = {row['_id']: row for row in conn.execute(f'''
+                SELECT p.id AS _id, {', '.join(RESULT_COLUMNS)} {FROM_SQL}
+                WHERE p.id IN ({','.join('?' * len(page_ids))})
+            ''', page_ids)}
+
+        plans = []
+        for plan_id, cost in zip(page_ids, page_costs):
+            if plan_id in rows:
+                plan = self._result(rows[plan_id])
+                plan[ESTIMATED_COST] = round(cost, 2)
+                plans.append(plan)
+        cursor = (page_costs[-1], page_ids[-1]) if start + limit < len(ids) else None
+        return plans, cursor
+
+
+def _benefit_limits(values: Optional[Sequence[str]]) -> Optional[Dict[str, float]]:
+    """Parse repeated 'Benefit name=amount' arguments."""
+    if not values:
+        return None
+    limits = {}
+    for value in values:
+        benefit, _, amount = value.rpartition('=')
+        limits[benefit] = float(amount)
+    return limits
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search plans in the marketplace database')
+    parser.add_argument('--db', default='marketplace.db', help='SQLite database path')
+    for name in VALUE_FILTERS:
+        flag = '--type' if name == 'plan_type' else f"--{name.replace('_', '-')}"
+        parser.add_argument(flag, dest=name, action='append', help='Repeat to accept several values')
+    parser.add_argument('--issuer', action='append')
+    parser.add_argument('--hsa', dest='hsa_eligible', action='store_true', default=None)
+    for name in RANGE_FILTERS:
+        parser.add_argument(f"--{name.replace('_', '-')}", dest=name, type=float)
+    parser.add_argument('--covers', action='append', help='Benefit the plan must cover')
+    parser.add_argument('--copay-max', action='append', help='"Benefit name=amount"')
+    parser.add_argument('--coinsurance-max', action='append', help='"Benefit name=rate"')
+    parser.add_argument('--sort', default='premium', choices=list(SORT_KEYS) + [ESTIMATED_COST])
+    parser.add_argument('--profile', type=json.loads, help='Utilization profile as JSON, for --sort estimated_cost')
+    parser.add_argument('--limit', type=int, default=DEFAULT_LIMIT)
+    args = parser.parse_args()
+
+    filters = {name: getattr(args, name) for name in
+               list(VALUE_FILTERS) + ['issuer', 'hsa_eligible', 'covers'] + list(RANGE_FILTERS)}
+    filters['copay_max'] = _benefit_limits(args.copay_max)
+    filters['coinsurance_max'] = _benefit_limits(args.coinsurance_max)
+
+    search = PlanSearch(args.db)
+    plans, cursor = search.search(sort=args.sort, limit=args.limit, profile=args.profile, **filters)
+    print(f"{search.count(**filters)} matching plans")
+    for plan in plans:
+        value = plan.get(ESTIMATED_COST, plan.get(args.sort))
+        print(f"{plan['plan_id']}  {plan['metal_level']:<10} {plan['type'] or '':<4} {args.sort}={value}  {plan['name']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+"""
+Compact in-memory store of marketplace plans for read-heavy code paths.
+
+The dicts returned by `MarketplaceDB.get_plan` and written by
+`extract_json_to_csvs` repeat every key, every benefit/tier/CSR string and
+the created_at timestamps on every row. `PlanStore` keeps:
+
+- one `Plan` record (`__slots__`, interned category strings) per plan
+- benefits, cost_sharings, deductibles and moops as struct-of-arrays NumPy
+  columns, with repeated strings (benefit name, network tier, CSR, display
+  string, ...) stored as small integer codes into shared `Categories`
+- CSR-style offsets per table, so the rows of plan i are
+  `offsets[i]:offsets[i + 1]`
+
+Usage:
+    store = PlanStore.from_db('marketplace.db')
+    plan = store['11512NC0100031']
+    rows = store.rows('cost_sharings', plan.plan_id)
+    in_network = store.tables['cost_sharings'].where(network_tier='In-Network')
+"""
+import sys
+from array import array
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from db import MarketplaceDB
+
+# Column kinds: 'float' (float64, NaN for None), 'flag' (int8, -1 for None), or
+# the name of the category domain the column's strings are coded in
+TABLE_COLUMNS = {
+    'benefits': {
+        'name': 'benefit_name', 'covered': 'flag', 'has_limits': 'flag',
+        'limit_unit': 'limit_unit', 'limit_quantity': 'float',
+    },
+    'cost_sharings': {
+        'benefit_name': 'benefit_name', 'network_tier': 'network_tier', 'copay_amount': 'float',
+        'coinsurance_rate': 'float', 'display_string': 'display_string', 'csr': 'csr',
+    },
+    'deductibles': {
+        'type': 'amount_type', 'amount': 'float', 'network_tier': 'network_tier', 'family_cost': 'family_cost',
+    },
+    'moops': {
+        'type': 'amount_type', 'amount': 'float', 'network_tier': 'network_tier', 'family_cost': 'family_cost',
+    },
+}
+
+_BUFFER_TYPES = {'float': 'd', 'flag': 'b'}
+
+
+def _intern(value: Any) -> Any:
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Categories:
+    """Distinct values of a string column; code 0 is None."""
+
+    def __init__(self):
+        self.values: List[Optional[str]] = [None]
+        self._codes: Dict[Optional[str], int] = {None: 0}
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def code(self, value: Optional[str]) -> int:
+        """Code of a value, adding it if new."""
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(_intern(value))
+        return code
+
+    def lookup(self, value: Optional[str]) -> int:
+        """Code of a known value, -1 if it never occurred."""
+        return self._codes.get(value, -1)
+
+    def dtype(self) -> np.dtype:
+        """Smallest unsigned integer type holding every code."""
+        return np.min_scalar_type(max(len(self.values) - 1, 0))
+
+
+class Plan:
+    """Plan-level fields of one plan; its child rows live in the store's tables."""
+
+    __slots__ = ('index', 'plan_id', 'name', 'premium', 'metal_level', 'type', 'state', 'product_division',
+                 'insurance_market', 'hsa_eligible', 'has_national_network', 'max_age_child',
+                 'issuer_id', 'issuer_name', 'issuer_state', 'toll_free')
+
+    def __init__(self, index: int, **fields):
+        self.index = index
+        for field in self.__slots__[1:]:
+            setattr(self, field, fields.get(field))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in self.__slots__[1:]}
+
+    def __repr__(self) -> str:
+        return f"Plan({self.plan_id!r}, {self.name!r}, premium={self.premium!r})"
+
+
+class ChildTable:
+    """
+    One child table as NumPy columns, grouped by plan through `offsets`.
+
+    Rows are appended while the store is built; `finish` turns the build
+    buffers into arrays.
+    """
+
+    def __init__(self, name: str, categories: Dict[str, Categories]):
+        self.name = name
+        self.kinds = TABLE_COLUMNS[name]
+        self.categories = {column: categories.setdefault(kind, Categories())
+                           for column, kind in self.kinds.items() if kind not in _BUFFER_TYPES}
+        self._buffers = {column: array(_BUFFER_TYPES.get(kind, 'i')) for column, kind in self.kinds.items()}
+        self._offsets = array('q', [0])
+        self.columns: Dict[str, np.ndarray] = {}
+        self.offsets: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1]) if self.offsets is not None else self._offsets[-1]
+
+    def append_plan(self, rows: Iterable[Dict[str, Any]]) -> None:
+        """Add the rows of the next plan."""
+        count = 0
+        for row in rows:
+            for column, kind in self.kinds.items():
+                value = row.get(column)
+                if kind == 'float':
+                    self._buffers[column].append(np.nan if value is None else float(value))
+                elif kind == 'flag':
+                    self._buffers[column].append(-1 if value is None else int(bool(value)))
+                else:
+                    self._buffers[column].append(self.categories[column].code(value))
+            count += 1
+        self._offsets.append(self._offsets[-1] + count)
+
+    def finish(self) -> None:
+        """Convert the build buffers to NumPy columns with the smallest code types."""
+        for column, kind in self.kinds.items():
+            data = np.frombuffer(self._buffers[column], dtype=self._buffers[column].typecode)
+            if kind == 'float':
+                self.columns[column] = data.astype(np.float64)
+            elif kind == 'flag':
+                self.columns[column] = data.astype(np.int8)
+            else:
+                self.columns[column] = data.astype(self.categories[column].dtype())
+        self.offsets = np.frombuffer(self._offsets, dtype=np.int64).copy()
+        self._buffers, self._offsets = None, None
+
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in self.columns.values()) + self.offsets.nbytes
+
+    def rows(self, index: int) -> List[Dict[str, Any]]:
+        """Decoded rows of the plan at `index`."""
+        start, end = self.offsets[index], self.offsets[index + 1]
+        decoded = {column: self.decode(column, start, end) for column in self.kinds}
+        return [{column: values[i] for column, values in decoded.items()} for i in range(end - start)]
+
+    def decode(self, column: str, start: int = 0, end: Optional[int] = None) -> List[Any]:
+        """Python values of a column (or a row range of it)."""
+        data = self.columns[column][start:end]
+        kind = self.kinds[column]
+        if kind == 'float':
+            return [None if value != value else value for value in data.tolist()]
+        if kind == 'flag':
+            return [None if value < 0 else bool(value) for value in data.tolist()]
+        values = self.categories[column].values
+        return [values[code] for code in data.tolist()]
+
+    def where(self, **conditions) -> np.ndarray:
+        """Boolean mask over all rows where each category column equals the given value."""
+        mask = np.ones(len(self), dtype=bool)
+        for column, value in conditions.items():
+            if column not in self.categories:
+                raise ValueError(f"Not a category column of {self.name}: {column}")
+            mask &= self.columns[column] == self.categories[column].lookup(value)
+        return mask
+
+    def row_plans(self) -> np.ndarray:
+        """Plan index of every row."""
+        return np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+
+
+class PlanStore:
+    """Plans as `Plan` records plus array-backed child tables."""
+
+    def __init__(self):
+        self.plans: List[Plan] = []
+        self.index: Dict[str, int] = {}
+        self.categories: Dict[str, Categories] = {}
+        self.tables = {name: ChildTable(name, self.categories) for name in TABLE_COLUMNS}
+        self._finished = False
+
+    @classmethod
+    def from_plans(cls, plans: Iterable[Dict[str, Any]]) -> 'PlanStore':
+        """Build a store from API plan records or `get_plan` dicts."""
+        store = cls()
+        for plan in plans:
+            store.add(plan)
+        store.finish()
+        return store
+
+    @classmethod
+    def from_db(cls, db_path: str = 'marketplace.db', chunk_size: int = 1000, **filters) -> 'PlanStore':
+        """Build a store from the database, one chunk of plans at a time."""
+        store = cls()
+        for chunk in MarketplaceDB(db_path).iter_plan_chunks(chunk_size=chunk_size, **filters):
+            for plan in chunk:
+                store.add(plan)
+        store.finish()
+        return store
+
+    @classmethod
+    def from_json(cls, json_path: str) -> 'PlanStore':
+        """Build a store from a marketplace JSON dump, streamed with `ingest.iter_json_plans`."""
+        from ingest import iter_json_plans
+        return cls.from_plans(entry['plan'] for entry in iter_json_plans(json_path))
+
+    def add(self, plan: Dict[str, Any]) -> None:
+        """
+        Append one plan.
+
+        Accepts both the API shape (`id`, cost_sharings nested in benefits)
+        and the `get_plan` shape (`plan_id`, top-level cost_sharings).
+        """
+        if self._finished:
+            raise RuntimeError("PlanStore is read-only once finished")
+        plan_id = plan.get('plan_id') or plan.get('id')
+        if plan_id in self.index:
+            raise ValueError(f"Duplicate plan: {plan_id}")
+        issuer = plan.get('issuer') or {}
+        benefits = plan.get('benefits') or []
+        if 'cost_sharings' in plan:
+            cost_sharings = plan['cost_sharings'] or []
+        else:
+            cost_sharings = [dict(sharing, benefit_name=benefit.get('name'))
+                             for benefit in benefits for sharing in benefit.get('cost_sharings') or []]
+
+        record = Plan(
+            len(self.plans),
+            plan_id=plan_id,
+            name=plan.get('name'),
+            premium=plan.get('premium'),
+            metal_level=_intern(plan.get('metal_level')),
+            type=_intern(plan.get('type')),
+            state=_intern(plan.get('state')),
+            product_division=_intern(plan.get('product_division')),
+            insurance_market=_intern(plan.get('insurance_market')),
+            hsa_eligible=plan.get('hsa_eligible'),
+            has_national_network=plan.get('has_national_network'),
+            max_age_child=plan.get('max_age_child'),
+            issuer_id=_intern(issuer.get('issuer_id', issuer.get('id'))),
+            issuer_name=_intern(issuer.get('name')),
+            issuer_state=_intern(issuer.get('state')),
+            toll_free=_intern(issuer.get('toll_free')),
+        )
+        self.index[plan_id] = record.index
+        self.plans.append(record)
+        self.tables['benefits'].append_plan(benefits)
+        self.tables['cost_sharings'].append_plan(cost_sharings)
+        self.tables['deductibles'].append_plan(plan.get('deductibles') or [])
+        self.tables['moops'].append_plan(plan.get('moops') or [])
+
+    def finish(self) -> None:
+        """Freeze the child tables into NumPy arrays; no more plans can be added."""
+        if not self._finished:
+            for table in self.tables.values():
+                table.finish()
+            self._finished = True
+
+    def __len__(self) -> int:
+        return len(self.plans)
+
+    def __contains__(self, plan_id: str) -> bool:
+        return plan_id in self.index
+
+    def __iter__(self) -> Iterator[Plan]:
+        return iter(self.plans)
+
+    def __getitem__(self, plan_id: str) -> Plan:
+        return self.plans[self.index[plan_id]]
+
+    def get(self, plan_id: str) -> Optional[Plan]:
+        index = self.index.get(plan_id)
+        return None if index is None else self.plans[index]
+
+    def rows(self, table: str, plan_id: str) -> List[Dict[str, Any]]:
+        """Decoded rows of one plan in a child table."""
+        return self.tables[table].rows(self.index[plan_id])
+
+    def to_dict(self, plan_id: str) -> Dict[str, Any]:
+        """The plan in the nested shape of `get_plan`, without row ids and timestamps."""
+        plan = self[plan_id]
+        result = plan.to_dict()
+        result['issuer'] = {
+            'issuer_id': result.pop('issuer_id'), 'name': result.pop('issuer_name'),
+            'state': result.pop('issuer_state'), 'toll_free': result.pop('toll_free'),
+        }
+        for name, table in self.tables.items():
+            result[name] = table.rows(plan.index)
+        return result
+
+    def nbytes(self) -> int:
+        """Bytes held by the child table arrays."""
+        return sum(table.nbytes() for table in self.tables.values())
@@ -0,0 +1,370 @@
+"""
+Text-to-SQL question answering over marketplace.db.
+
+`SQLQA.ask` turns a question into one SQLite SELECT with the LLM, runs it on
+a read-only connection with a row limit and a timeout, and has the LLM
+summarize the rows. Answers are cached in SQLite keyed by the normalized
+question and the database version, so asking again after no new data was
+saved skips both generation and the query.
+
+Prompts follow the Llama-2 chat transcript format. Each prompt starts with
+the exact text of the previous one: the summary prompt extends the SQL
+prompt, and the next turn's SQL prompt extends the whole previous turn
+(question, SQL, rows, answer). ctransformers keeps the longest common token
+prefix of its evaluated context between calls, so only the new tail of each
+prompt is evaluated. Pass `on_token` to `ask` to stream output as it is
+generated.
+
+Any callable `llm(prompt, **kwargs) -> str` works; `StubLLM` answers without
+a model, e.g. in tests:
+
+    qa = SQLQA(StubLLM(), 'marketplace.db')
+    print(qa.ask("How many plans are there per metal level?")['answer'])
+"""
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from cache import SQLiteCache
+from db import MarketplaceDB, db_version
+
+DEFAULT_MAX_ROWS = 200
+DEFAULT_TIMEOUT = 5.0
+# Rows included in the summary prompt; the rest are only shown in the UI
+PROMPT_ROWS = 20
+ANSWER_TTL = 7 * 24 * 60 * 60
+# Oldest turns are dropped from the prompt past this size (~4 characters per token)
+MAX_PROMPT_CHARS = 6000
+
+SQL_GENERATION = {"max_new_tokens": 200, "temperature": 0.1, "stop": ["</s>", "[INST]"]}
+ANSWER_GENERATION = {"max_new_tokens": 256, "stop": ["</s>", "[INST]"]}
+
+# Tables described to the model; summary tables first since they answer most questions cheaply
+SCHEMA_TABLES = ['plan_rollups', 'metal_premium_stats', 'benefit_coverage', 'plans', 'issuers',
+                 'benefits', 'cost_sharings', 'deductibles', 'moops', 'collection_runs', 'plan_history']
+
+SYSTEM_PROMPT = """You answer questions about US healthcare marketplace plans using a SQLite database.
+Database schema:
+{schema}
+Rules: write exactly one SQLite SELECT statement, no comments, no explanation."""
+
+# Llama-2 transcript pieces: system + [question, result, answer] per turn
+SYSTEM_BLOCK = "[INST] <<SYS>>\n{system}\n<</SYS>>\n\n"
+QUESTION_BLOCK = "Question: {question}\nSQL: [/INST] "
+RESULT_BLOCK = ("{sql} </s><s>[INST] The query returned {row_count} rows:\n{rows}\n"
+                "Answer the question \"{question}\" in a few sentences using only these results. [/INST] ")
+ANSWER_BLOCK = "{answer} </s><s>[INST] "
+
+
+def normalize_question(question: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation."""
+    return re.sub(r'\s+', ' ', question).strip().rstrip('?!. ').lower()
+
+
+def describe_schema(db_path: str) -> str:
+    """
+    CREATE TABLE statements of the tables the model may query.
+
+    Views standing in for tables (the normalized layout) are described as a
+    plain table of their columns, so the model sees the same schema either way.
+    """
+    with closing(sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)) as conn:
+        rows = dict(conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table'").fetchall())
+        views = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'view'")]
+        for view in views:
+            columns = conn.execute(f'PRAGMA table_info({view})').fetchall()
+            rows[view] = f"CREATE TABLE {view} ({', '.join(f'{c[1]} {c[2]}'.strip() for c in columns)})"
+    return '\n'.join(re.sub(r'\s+', ' ', rows[table]) for table in SCHEMA_TABLES if table in rows)
+
+
+def extract_sql(text: str) -> str:
+    """
+    Pull the SELECT statement out of a model completion.
+
+    Raises:
+        ValueError: If the completion holds no SELECT (or WITH ... SELECT) statement
+    """
+    fenced = re.search(r'```(?:sql)?\s*(.*?)```', text, re.S | re.I)
+    if fenced:
+        text = fenced.group(1)
+    match = re.search(r'\b(SELECT|WITH)\b.*', text, re.S | re.I)
+    if not match:
+        raise ValueError(f"No SELECT statement in model output: {text[:200]!r}")
+    sql = match.group(0).split(';')[0].strip()
+    return sql
+
+
+def run_readonly(db_path: str, sql: str, max_rows: int = DEFAULT_MAX_ROWS,
+                 timeout: float = DEFAULT_TIMEOUT) -> Dict[str, Any]:
+    """
+    Run one statement on a read-only connection.
+
+    The connection is opened with mode=ro and query_only, so writes fail;
+    a progress handler interrupts the query after `timeout` seconds and at
+    most `max_rows` rows are fetched.
+
+    Returns:
+        {"columns", "rows", "truncated", "seconds"}
+    """
+    start = time.perf_counter()
+    deadline = start + timeout
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        conn.execute('PRAGMA query_only = ON')
+        # Called every 10k VM instructions; a non-zero return aborts the statement
+        conn.set_progress_handler(lambda: int(time.perf_counter() > deadline), 10000)
+        try:
+            cursor = conn.execute(sql)
+            rows = cursor.fetchmany(max_rows + 1)
+        except sqlite3.OperationalError as e:
+            if 'interrupted' in str(e):
+                raise TimeoutError(f"Query exceeded {timeout}s") from e
+            raise
+        columns = [description[0] for description in cursor.description or []]
+    finally:
+        conn.close()
+    return {
+        "columns": columns,
+        "rows": [list(row) for row in rows[:max_rows]],
+        "truncated": len(rows) > max_rows,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def format_rows(columns: List[str], rows: List[List[Any]], limit: int = PROMPT_ROWS) -> str:
+    """Render rows as a compact pipe-separated table for a prompt."""
+    lines = [' | '.join(columns)]
+    lines += [' | '.join('' if value is None else str(value) for value in row) for row in rows[:limit]]
+    if len(rows) > limit:
+        lines.append(f"... {len(rows) - limit} more rows")
+    return '\n'.join(lines)
+
+
+class StubLLM:
+    """
+    Deterministic stand-in for the local model.
+
+    SQL prompts are answered from `queries` (first keyword found in the
+    question wins, else `default_sql`); summary prompts echo the result rows.
+    """
+
+    default_sql = ("SELECT metal_level, COUNT(*) AS plans, ROUND(AVG(premium), 2) AS avg_premium "
+                   "FROM plans GROUP BY metal_level ORDER BY avg_premium")
+    queries = {
+        'deductible': "SELECT metal_level, ROUND(AVG(deductible), 2) AS avg_deductible "
+                      "FROM plan_rollups GROUP BY metal_level ORDER BY avg_deductible",
+        'benefit': "SELECT name, covered_count, plan_count FROM benefit_coverage ORDER BY name",
+        'issuer': "SELECT name, COUNT(DISTINCT plan_id) AS plans FROM issuers GROUP BY name ORDER BY plans DESC",
+        'cheapest': "SELECT name, metal_level, premium FROM plans ORDER BY premium LIMIT 5",
+    }
+
+    def __init__(self, queries: Optional[Dict[str, str]] = None):
+        if queries is not None:
+            self.queries = queries
+        self.calls = 0
+
+    def __call__(self, prompt: str, stream: bool = False, **kwargs):
+        self.calls += 1
+        tail = prompt.rsplit('[INST]', 1)[-1]
+        if tail.rstrip().endswith('SQL: [/INST]'):
+            question = re.search(r'Question: (.*)\nSQL:', tail).group(1).lower()
+            text = next((sql for keyword, sql in self.queries.items() if keyword in question), self.default_sql)
+        else:
+            rows = re.search(r'returned \d+ rows:\n(.*)\nAnswer the question', tail, re.S)
+            text = f"Here is what the data shows:\n{rows.group(1) if rows else ''}"
+        if stream:
+            # Word-sized pieces, like ctransformers' stream=True
+            return iter(re.findall(r'\S+\s*|\s+', text))
+        return text
+
+
+class _Yield(Exception):
+    """Raised inside a pre-warm generation to hand the model to an interactive question."""
+
+
+class SQLQA:
+    """
+    Answers questions from marketplace.db with generated SQL.
+
+    Args:
+        llm: Callable `llm(prompt, **kwargs) -> str`
+        db_path: SQLite database to query
+        cache: Answer cache; None disables caching
+        max_rows: Row limit of the generated query
+        timeout: Seconds before the generated query is interrupted
+        model_id: Identifies the model in cache keys, e.g. its model file
+    """
+
+    def __init__(self, llm: Callable[..., str], db_path: str = 'marketplace.db',
+                 cache: Optional[SQLiteCache] = None, max_rows: int = DEFAULT_MAX_ROWS,
+                 timeout: float = DEFAULT_TIMEOUT, model_id: str = ''):
+        self.llm = llm
+        self.db_path = db_path
+        self.cache = cache
+        self.max_rows = max_rows
+        self.timeout = timeout
+        self.model_id = model_id
+        self._schema = None
+        # Creates/migrates the schema, including the change counter behind db_version
+        MarketplaceDB(db_path).close()
+        # Set by the first interactive question; warm() stops for good once it is set
+        self._interactive = threading.Event()
+
+    @property
+    def schema(self) -> str:
+        if self._schema is None:
+            self._schema = describe_schema(self.db_path)
+        return self._schema
+
+    def _turn(self, result: Dict[str, Any]) -> str:
+        """Transcript of a completed turn, exactly as it was evaluated."""
+        return (QUESTION_BLOCK.format(question=result["question"].strip())
+                + self._result_block(result["question"], result["sql"], result)
+                + ANSWER_BLOCK.format(answer=result["answer"]))
+
+    def _result_block(self, question: str, sql: str, result: Dict[str, Any]) -> str:
+        return RESULT_BLOCK.format(
+            sql=sql,
+            row_count=len(result['rows']),
+            rows=format_rows(result['columns'], result['rows']),
+            question=question.strip(),
+        )
+
+    def _history(self, history: Sequence[Dict[str, Any]]) -> str:
+        """Transcript of the most recent answered turns that fit in MAX_PROMPT_CHARS."""
+        turns = [self._turn(result) for result in history if result.get("sql") and not result.get("error")]
+        budget = MAX_PROMPT_CHARS - len(SYSTEM_BLOCK.format(system=SYSTEM_PROMPT.format(schema=self.schema)))
+        while turns and sum(map(len, turns)) > budget:
+            turns.pop(0)
+        return ''.join(turns)
+
+    def sql_prompt(self, question: str, history: Sequence[Dict[str, Any]] = ()) -> str:
+        system = SYSTEM_PROMPT.format(schema=self.schema)
+        return (SYSTEM_BLOCK.format(system=system) + self._history(history)
+                + QUESTION_BLOCK.format(question=question.strip()))
+
+    def summary_prompt(self, question: str, sql: str, result: Dict[str, Any],
+                       history: Sequence[Dict[str, Any]] = ()) -> str:
+        return self.sql_prompt(question, history) + self._result_block(question, sql, result)
+
+    def cache_key(self, question: str, history: Sequence[Dict[str, Any]] = ()) -> str:
+        version = db_version(self.db_path)
+        context = hashlib.sha256(self._history(history).encode()).hexdigest() if history else ''
+        raw = f"{self.model_id}\n{version}\n{context}\n{normalize_question(question)}"
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _generate(self, prompt: str, kind: str, params: Dict[str, Any], metrics: Dict[str, Any],
+                  on_token: Optional[Callable[[str, str], None]]) -> str:
+        """Run the model, streaming pieces to `on_token(kind, text)` when given."""
+        start = time.perf_counter()
+        if on_token is None:
+            text = self.llm(prompt, **params)
+        else:
+            pieces = []
+            stream = self.llm(prompt, stream=True, **params)
+            try:
+                for piece in stream:
+                    if metrics.get("ttft") is None:
+                        metrics["ttft"] = time.perf_counter() - metrics["start"]
+                    pieces.append(piece)
+                    on_token(kind, piece)
+            finally:
+                # Stops generation (and releases CachedLLM's lock) when on_token raises
+                if hasattr(stream, 'close'):
+                    stream.close()
+            metrics["tokens"] = metrics.get("tokens", 0) + len(pieces)
+            text = ''.join(pieces)
+        metrics["generate_seconds"] = metrics.get("generate_seconds", 0.0) + time.perf_counter() - start
+        return text
+
+    def ask(self, question: str, history: Sequence[Dict[str, Any]] = (),
+            on_token: Optional[Callable[[str, str], None]] = None) -> Dict[str, Any]:
+        """
+        Answer a question.
+
+        Args:
+            question: The user's question
+            history: Earlier results of `ask` in this conversation, oldest first
+            on_token: Called as `on_token(kind, text)` with each streamed piece
+                of the SQL ("sql") and of the answer ("answer")
+
+        Returns:
+            {"question", "sql", "columns", "rows", "truncated", "answer",
+             "cached", "error", "timings"}; on a generation or query error,
+            "error" is set, "answer" explains it and nothing is cached.
+            When streaming, "timings" also has "ttft" (seconds to the first
+            piece), "tokens" and "tokens_per_sec".
+        """
+        self._interactive.set()
+        return self._answer(question, history, on_token)
+
+    def _answer(self, question: str, history: Sequence[Dict[str, Any]],
+                on_token: Optional[Callable[[str, str], None]]) -> Dict[str, Any]:
+        key = self.cache_key(question, history) if self.cache is not None else None
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return {**cached, "question": question, "cached": True}
+
+        timings = {"start": time.perf_counter()}
+        result = {"question": question, "sql": None, "columns": [], "rows": [], "truncated": False,
+                  "answer": None, "cached": False, "error": None, "timings": timings}
+        try:
+            start = time.perf_counter()
+            prompt = self.sql_prompt(question, history)
+            result["sql"] = extract_sql(self._generate(prompt, "sql", SQL_GENERATION, timings, on_token))
+            timings["generate_sql"] = time.perf_counter() - start
+
+            query = run_readonly(self.db_path, result["sql"], self.max_rows, self.timeout)
+            timings["query"] = query.pop("seconds")
+            result.update(query)
+
+            start = time.perf_counter()
+            prompt = self.summary_prompt(question, result["sql"], result, history)
+            result["answer"] = self._generate(prompt, "answer", ANSWER_GENERATION, timings, on_token).strip()
+            timings["summarize"] = time.perf_counter() - start
+        except (ValueError, TimeoutError, sqlite3.Error) as e:
+            result["error"] = str(e)
+            result["answer"] = f"Sorry, I couldn't answer that from the data: {e}"
+            return result
+        finally:
+            timings.pop("start")
+            if timings.get("tokens"):
+                timings["tokens_per_sec"] = timings["tokens"] / timings["generate_seconds"]
+
+        if key is not None:
+            self.cache.set(key, {k: v for k, v in result.items() if k != "question"}, ANSWER_TTL)
+        return result
+
+    def warm(self, questions: Sequence[str]) -> int:
+        """
+        Answer `questions` to fill the caches, e.g. from a background thread.
+
+        Warming yields to interactive use: it stops before the next question
+        once `ask` has been called, and a generation in progress is cut off
+        at the next token, so the first real question waits at most one
+        token for the model and later turns keep their evaluated context.
+        Questions answered in earlier sessions are answer-cache hits.
+
+        Returns:
+            Number of questions answered without an error
+        """
+        def check_priority(kind: str, text: str) -> None:
+            if self._interactive.is_set():
+                raise _Yield()
+
+        answered = 0
+        for question in questions:
+            if self._interactive.is_set():
+                break
+            try:
+                answered += self._answer(question, (), check_priority)["error"] is None
+            except _Yield:
+                break
+            except Exception as e:
+                print(f"Pre-warming {question!r} failed: {str(e)}")
+        return answered
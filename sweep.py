@@ -0,0 +1,204 @@
+"""
+Sweep engine for the daily collection job.
+
+Collects marketplace data for a whole grid of household profiles
+(zipcode, age, income, year) instead of the single hard-coded profile in
+`collect_marketplace_data.main()`:
+
+- each ZIP code's county FIPS is resolved once,
+- profiles that produce an identical `/plans/search` payload are searched once,
+- searches run in a thread pool sharing one rate limiter,
+- results are streamed into the database as each search completes,
+- every finished search is checkpointed (see checkpoint.py), so a failed
+  sweep rerun with `--resume` only repeats the searches that failed.
+
+Usage:
+    python collect_marketplace_data.py --sweep profiles.csv --drug ibuprof [--resume]
+"""
+import csv
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import collect_marketplace_data as collector
+from checkpoint import DEFAULT_JOURNAL_PATH, CheckpointJournal
+from db import MarketplaceDB
+
+DEFAULT_GENDER = "Female"
+
+
+def load_profiles(path):
+    """
+    Load a profile grid from a CSV file (with a header row) or a JSON list.
+
+    Each profile needs `zipcode`, `age`, `income` and `year`; `gender` and
+    `state` are optional (the state defaults to the ZIP code's county).
+    """
+    if str(path).endswith('.json'):
+        with open(path) as f:
+            rows = json.load(f)
+    else:
+        with open(path, newline='') as f:
+            rows = list(csv.DictReader(f))
+
+    profiles = []
+    for row in rows:
+        profiles.append({
+            "zipcode": str(row['zipcode']).strip().zfill(5),
+            "age": int(row['age']),
+            "income": int(float(row['income'])),
+            "year": int(row['year']),
+            "gender": row.get('gender') or DEFAULT_GENDER,
+            "state": row.get('state') or None,
+        })
+    return profiles
+
+
+def _payload_key(payload):
+    return json.dumps(payload, sort_keys=True)
+
+
+def run_sweep(profiles, drug_query, db_path='marketplace.db', max_workers=4,
+              max_in_flight=collector.MAX_IN_FLIGHT, rate_limit=5.0, resume=False, journal_path=DEFAULT_JOURNAL_PATH):
+    """
+    Collect every profile in the grid and stream the plans into the database.
+
+    Args:
+        profiles (list): Profiles as returned by `load_profiles`
+        drug_query (str | list): Drug search string(s) to check coverage for
+        db_path (str): SQLite database to write to
+        max_workers (int): Number of `/plans/search` payloads collected in parallel
+        max_in_flight (int): Per-search limit on plan-detail/coverage requests
+        rate_limit (float): Requests per second shared by all workers, None for unlimited
+        resume (bool): Skip the searches a previous run of the same sweep
+            already saved, and the plan details and coverage batches it fetched
+        journal_path (str): SQLite file of the checkpoint journal
+
+    Returns:
+        dict: Run statistics including profiles/sec and plans/sec
+    """
+    start = time.perf_counter()
+    limiter = collector.TokenBucket(rate_limit, capacity=max(1, max_workers)) if rate_limit else None
+    journal = CheckpointJournal({"sweep": profiles, "drugs": drug_query, "db": db_path}, journal_path, resume)
+
+    failed = 0
+
+    # 1. Resolve each ZIP code's county once; the profiles of a ZIP code that fails are skipped
+    def resolve_county(zipcode):
+        try:
+            return collector.get_county_fips(zipcode, limiter, journal)
+        except Exception as e:
+            journal.fail("county", zipcode, e)
+            print(f"County lookup failed for {zipcode}: {str(e)}")
+            return None
+
+    zipcodes = sorted({profile['zipcode'] for profile in profiles})
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        counties = dict(zip(zipcodes, executor.map(resolve_county, zipcodes)))
+    failed_zipcodes = [zipcode for zipcode, county in counties.items() if county is None]
+    skipped_profiles = sum(1 for profile in profiles if counties[profile['zipcode']] is None)
+    failed += len(failed_zipcodes)
+
+    # 2. Deduplicate identical search payloads
+    payloads = {}
+    for profile in profiles:
+        county = counties[profile['zipcode']]
+        if county is None:
+            continue
+        payload = collector.build_search_payload(
+            profile['zipcode'], county['fips'], profile['age'], profile['gender'],
+            profile['income'], profile['year'], profile['state'] or county.get('state')
+        )
+        payloads.setdefault(_payload_key(payload), payload)
+
+    # Drug queries that do not resolve are left out of the coverage checks
+    rxcuis = []
+    failed_drugs = []
+    for query in [drug_query] if isinstance(drug_query, str) else drug_query:
+        try:
+            rxcuis.extend(collector.resolve_rxcuis(query, limiter, journal))
+        except Exception as e:
+            journal.fail("rxcui", query, e)
+            failed_drugs.append(query)
+            print(f"Drug lookup failed for {query!r}: {str(e)}")
+    failed += len(failed_drugs)
+
+    # Coverage is per (year, plan), so it is shared across payloads of the same year; the lock
+    # lets only one search fetch a plan's coverage while the others wait for it
+    coverage_by_year = {}
+    coverage_lock = threading.Lock()
+
+    def collect(payload):
+        plans = collector.search_plans(payload, limiter, journal)
+        with coverage_lock:
+            known_coverage = coverage_by_year.setdefault(payload['year'], {})
+        collected = collector.collect_plans(plans, payload['year'], rxcuis, limiter, max_in_flight,
+                                            known_coverage, journal, coverage_lock)
+        return collected, len(plans) - len(collected)
+
+    # 3. Collect in a pool and stream results into the database as they finish
+    db = MarketplaceDB(db_path)
+    run_id = db.start_run('sweep')
+    summary = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    failed_plans = 0
+    # Searches whose plans a previous attempt of this sweep already saved
+    pending = {key: payload for key, payload in payloads.items() if not journal.done("saved", key)}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(collect, payload): key for key, payload in pending.items()}
+        for future in as_completed(futures):
+            try:
+                all_plans, missing = future.result()
+            except Exception as e:
+                failed += 1
+                journal.fail("saved", futures[future], e)
+                print(f"Search failed: {str(e)}")
+                continue
+            for key, count in db.save_plans((plan_wrapper['plan'] for plan_wrapper in all_plans),
+                                            run_id=run_id).items():
+                summary[key] += count
+            # A search is only done once all of its plans are saved
+            if missing:
+                failed += 1
+                failed_plans += missing
+                journal.fail("saved", futures[future], f"{missing} plans failed")
+            else:
+                journal.record("saved", futures[future], len(all_plans))
+    db.finish_run(run_id, summary)
+    db.close()
+    if not failed:
+        journal.finish()
+
+    elapsed = time.perf_counter() - start
+    plans_saved = sum(summary.values())
+    stats = {
+        "profiles": len(profiles),
+        "zipcodes": len(zipcodes),
+        "unique_searches": len(payloads),
+        "resumed_searches": len(payloads) - len(pending),
+        "failed_searches": failed - len(failed_zipcodes) - len(failed_drugs),
+        "failed_zipcodes": failed_zipcodes,
+        "skipped_profiles": skipped_profiles,
+        "failed_drugs": failed_drugs,
+        "failed_plans": failed_plans,
+        "plans_saved": plans_saved,
+        **summary,
+        "seconds": round(elapsed, 2),
+        "profiles_per_sec": round(len(profiles) / elapsed, 2) if elapsed else 0.0,
+        "plans_per_sec": round(plans_saved / elapsed, 2) if elapsed else 0.0,
+        "http_cache": collector.http.stats(),
+        "checkpoints": journal.stats(),
+    }
+    journal.close()
+    print(
+        f"Swept {stats['profiles']} profiles ({stats['unique_searches']} unique searches, "
+        f"{stats['zipcodes']} ZIP codes) in {stats['seconds']}s: "
+        f"{stats['profiles_per_sec']} profiles/sec, {stats['plans_per_sec']} plans/sec"
+    )
+    print(f"Plans: {summary['inserted']} inserted, {summary['updated']} updated, {summary['unchanged']} unchanged")
+    print(f"HTTP cache: {stats['http_cache']}")
+    if failed:
+        print(f"{stats['failed_searches']} searches failed ({failed_plans} plans), "
+              f"{len(failed_zipcodes)} ZIP codes failed ({skipped_profiles} profiles skipped), "
+              f"{len(failed_drugs)} drug queries failed; rerun with --resume to repeat only those")
+    return stats
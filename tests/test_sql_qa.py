@@ -0,0 +1,163 @@
+"""
+Tests for sql_qa: answer caching keyed by db_version, the read-only query
+guard and the query timeout, on a fresh database loaded from the sample
+healthcare_plans.json and answered by StubLLM.
+"""
+import copy
+import json
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from cache import CachedLLM, SQLiteCache  # noqa: E402
+from db import MarketplaceDB, db_version  # noqa: E402
+from sql_qa import SQLQA, StubLLM, run_readonly  # noqa: E402
+
+SAMPLE_FILE = Path(__file__).resolve().parent.parent / "healthcare_plans.json"
+
+# Counts to 10^8, far longer than the timeouts below
+SLOW_SQL = ("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 100000000) "
+            "SELECT COUNT(*) FROM n")
+
+
+def sample_plans():
+    with open(SAMPLE_FILE) as f:
+        return [entry["plan"] for entry in json.load(f)["all_plans"]]
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "marketplace.db")
+    db = MarketplaceDB(path)
+    db.save_plans(sample_plans())
+    db.close()
+    return path
+
+
+@pytest.fixture
+def qa(db_path, tmp_path):
+    return SQLQA(StubLLM(), db_path, cache=SQLiteCache(str(tmp_path / "cache.db"), table="sql_answers"))
+
+
+def test_repeated_question_is_answered_from_cache(qa):
+    first = qa.ask("How many plans are there per metal level?")
+    calls = qa.llm.calls
+    second = qa.ask("how many plans are there per metal level")
+
+    assert first["error"] is None and not first["cached"]
+    assert second["cached"]
+    assert second["rows"] == first["rows"]
+    assert qa.llm.calls == calls
+
+
+def test_cache_is_invalidated_when_plans_change(qa, db_path):
+    question = "How many plans are there per metal level?"
+    qa.ask(question)
+
+    plan = copy.deepcopy(sample_plans()[0])
+    plan["premium"] += 10
+    db = MarketplaceDB(db_path)
+    version = db_version(db_path)
+    db.save_plan_data(plan)
+    assert db_version(db_path) != version
+    assert not qa.ask(question)["cached"]
+
+    version = db_version(db_path)
+    db.delete_plan(plan["id"])
+    db.close()
+    assert db_version(db_path) != version
+    answer = qa.ask(question)
+    assert not answer["cached"]
+    assert sum(row[1] for row in answer["rows"]) == len(sample_plans()) - 1
+
+
+def test_version_is_unchanged_when_a_save_changes_nothing(db_path):
+    version = db_version(db_path)
+    db = MarketplaceDB(db_path)
+    db.save_plans(sample_plans())
+    db.close()
+    assert db_version(db_path) == version
+
+
+@pytest.mark.parametrize("sql", [
+    "DELETE FROM plans",
+    "UPDATE plans SET premium = 0",
+    "DROP TABLE plans",
+    "CREATE TABLE notes (text TEXT)",
+])
+def test_writes_are_rejected(db_path, sql):
+    with pytest.raises(sqlite3.Error):
+        run_readonly(db_path, sql)
+    assert run_readonly(db_path, "SELECT COUNT(*) FROM plans")["rows"] == [[len(sample_plans())]]
+
+
+def test_multiple_statements_are_rejected(db_path):
+    with pytest.raises(sqlite3.Error):
+        run_readonly(db_path, "SELECT 1; DELETE FROM plans")
+    assert run_readonly(db_path, "SELECT COUNT(*) FROM plans")["rows"] == [[len(sample_plans())]]
+
+
+def test_generated_write_is_answered_with_an_error(db_path):
+    # extract_sql keeps the first statement only, so the write has to hide behind a WITH
+    qa = SQLQA(StubLLM({"delete": "WITH old AS (SELECT 1) DELETE FROM plans"}), db_path)
+    result = qa.ask("Delete every plan")
+    assert result["error"] is not None
+    assert result["rows"] == []
+    assert run_readonly(db_path, "SELECT COUNT(*) FROM plans")["rows"] == [[len(sample_plans())]]
+
+
+def test_slow_query_times_out(db_path):
+    with pytest.raises(TimeoutError):
+        run_readonly(db_path, SLOW_SQL, timeout=0.1)
+
+
+def test_timed_out_answer_is_not_cached(db_path, tmp_path):
+    qa = SQLQA(StubLLM({"count": SLOW_SQL}), db_path, timeout=0.1,
+               cache=SQLiteCache(str(tmp_path / "cache.db"), table="sql_answers"))
+    first = qa.ask("Count to a hundred million")
+    assert first["error"] is not None and "0.1s" in first["error"]
+    assert not qa.ask("Count to a hundred million")["cached"]
+
+
+class SlowLLM(StubLLM):
+    """StubLLM that streams one piece per `delay` seconds once `started` is set."""
+
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+        self.started = threading.Event()
+
+    def __call__(self, prompt, stream=False, **kwargs):
+        pieces = super().__call__(prompt, stream=True, **kwargs)
+
+        def slow():
+            for piece in pieces:
+                self.started.set()
+                time.sleep(self.delay)
+                yield piece
+        return slow() if stream else ''.join(slow())
+
+
+def test_warm_yields_to_an_interactive_question(db_path, tmp_path):
+    llm = CachedLLM(SlowLLM(delay=0.05), model_id="slow", cache=SQLiteCache(str(tmp_path / "llm.db")))
+    qa = SQLQA(llm, db_path)
+    warmed = []
+    thread = threading.Thread(target=lambda: warmed.append(qa.warm(["Which plans are cheapest?"] * 5)))
+    thread.start()
+    llm.llm.started.wait(5)
+
+    start = time.perf_counter()
+    result = qa.ask("How many plans are there per metal level?")
+    asked = time.perf_counter() - start
+    thread.join(5)
+
+    assert result["error"] is None
+    assert warmed == [0]
+    # The first real question waits for about one warm-up token (0.05s), not a whole warm-up answer
+    assert asked - result["timings"]["generate_seconds"] < 0.5